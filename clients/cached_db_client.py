@@ -0,0 +1,102 @@
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import asyncpg
+
+from clients.db_client import DBClient
+from clients.lru_cache import LRUCache
+from logger import get_logger
+from models.FeedItem import FeedItemWithUploadReference
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+class CachedDBClient:
+    """
+    Read-through cache in front of DBClient read methods used by api polling endpoints.
+
+    Feed uploads in terminal state (and their items) never change, so they are cached until evicted
+    by LRU policy, in-flight ones are cached only for in_flight_ttl seconds. Status changes reported
+    by consumers (see FeedStatusListener) invalidate all cached entries of the feed upload - keys of every
+    feed upload are indexed, so the invalidation does not scan the whole cache.
+    """
+
+    TERMINAL_STATUSES = (FeedUploadStatus.FINISHED, FeedUploadStatus.FINISHED_ERROR)
+
+    def __init__(self, db: DBClient, max_size: int = 10000, in_flight_ttl: float = 1.0):
+        self.db = db
+        self.in_flight_ttl = in_flight_ttl
+        self.cache: LRUCache = LRUCache(max_size, on_evict=self._forget_key)
+        # cached keys by feed upload id (all cache keys start with it)
+        self.feed_upload_keys: dict[int, set[tuple]] = {}
+
+    def invalidate_feed_upload(self, feed_upload_id: int, status: Optional[FeedUploadStatus] = None):
+        removed = sum(self.cache.delete(key) for key in self.feed_upload_keys.pop(feed_upload_id, ()))
+        if removed:
+            logger.info(f"Invalidated {removed} cached entries of feed upload {feed_upload_id}")
+
+    def _set(self, key: tuple, value, ttl: Optional[float]):
+        # indexed before set, which may evict the key right away
+        self.feed_upload_keys.setdefault(key[0], set()).add(key)
+        self.cache.set(key, value, ttl=ttl)
+
+    def _forget_key(self, key: tuple):
+        keys = self.feed_upload_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.feed_upload_keys[key[0]]
+
+    def _ttl(self, job: Optional[FeedUpload]) -> Optional[float]:
+        if job is not None and job.status in self.TERMINAL_STATUSES:
+            return None
+        return self.in_flight_ttl
+
+    async def get_feed_upload_job(self, feed_upload_id: int) -> FeedUpload | None:
+        key = (feed_upload_id, "job")
+        job = self.cache.get(key)
+        if job is None:
+            job = await self.db.get_feed_upload_job(feed_upload_id)
+            if job is not None:
+                self._set(key, job, self._ttl(job))
+        return job
+
+    async def _get_feed_upload_data(
+        self, feed_upload_id: int, key: tuple, load: Callable[[], Awaitable[T]]
+    ) -> T:
+        value = self.cache.get(key)
+        if value is None:
+            # status has to be known before loading, items of terminal feed upload are final
+            job = await self.get_feed_upload_job(feed_upload_id)
+            value = await load()
+            self._set(key, value, self._ttl(job))
+        return value
+
+    async def get_feed_upload_items(
+        self, feed_upload_id: int, item_id: Optional[str] = None
+    ) -> list[FeedItemWithUploadReference]:
+        return await self._get_feed_upload_data(
+            feed_upload_id,
+            (feed_upload_id, "items", item_id),
+            lambda: self.db.get_feed_upload_items(feed_upload_id, item_id),
+        )
+
+    async def get_feed_item_ids(
+        self, feed_upload_id: int, limit: int, after: Optional[int] = None
+    ) -> list[asyncpg.Record]:
+        return await self._get_feed_upload_data(
+            feed_upload_id,
+            (feed_upload_id, "item_ids", limit, after),
+            lambda: self.db.get_feed_item_ids(feed_upload_id, limit, after),
+        )
+
+    async def get_feed_image_ids(
+        self, feed_upload_id: int, limit: int, after: tuple[int, int] = (0, -1)
+    ) -> list[asyncpg.Record]:
+        return await self._get_feed_upload_data(
+            feed_upload_id,
+            (feed_upload_id, "image_ids", limit, after),
+            lambda: self.db.get_feed_image_ids(feed_upload_id, limit, after),
+        )
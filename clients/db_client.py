@@ -1,9 +1,18 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
+from itertools import islice
+import json
+import time
+from operator import attrgetter
+from pathlib import Path
 import asyncpg
-from typing import Optional
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, Sequence
 
 from logger import get_logger
-from models.FeedItem import FeedItemWithUploadReference
+from metrics import DB_POOL_ACQUIRE_WAIT, DB_QUERY_DURATION
+from models.FeedImage import FeedImage
+from models.FeedItem import FEED_ITEM_READ_COLUMNS, FEED_ITEM_ROW_COLUMNS, FeedItemWithUploadReference
 from models.FeedUpload import FeedUpload, FeedUploadStatus
 
 logger = get_logger(__name__)
@@ -12,37 +21,136 @@ logger = get_logger(__name__)
 class DBClient:
     FEED_ITEMS_TABLE = "feed_items"
     FEED_UPLOADS_TABLE = "feed_uploads"
+    FEED_IMAGES_TABLE = "feed_images"
+    FEED_UPLOAD_OUTBOX_TABLE = "feed_upload_outbox"
+    FEED_UPLOAD_PROFILES_TABLE = "feed_upload_profiles"
+    MIGRATIONS_TABLE = "schema_migrations"
+    MIGRATIONS_LOCK_ID = 4242_0001  # pg advisory lock held while migrating
 
-    def __init__(self, dsn: str):
+    def __init__(
+        self,
+        dsn: str,
+        job_batch_window: Optional[float] = None,
+        job_batch_max_size: int = 100,
+    ):
+        """
+        :param job_batch_window: opt-in coalescing of create_feed_upload_job calls - calls arriving within
+            this many seconds are inserted by single multi-row INSERT, None (or 0) inserts every job on its own
+        :param job_batch_max_size: max number of jobs inserted together, full batch is inserted right away
+        """
         self.dsn = dsn
         self.pool: Optional[asyncpg.Pool] = None
+        self.job_batch_window = job_batch_window
+        self.job_batch_max_size = job_batch_max_size
+        self._pending_jobs: list[tuple[asyncio.Future, Optional[dict], Optional[str]]] = []
+        self._jobs_flush_timer: Optional[asyncio.TimerHandle] = None
+        self._jobs_flush_tasks: set[asyncio.Task] = set()
+        self.acquire_stats = {"acquired": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
 
-    async def connect(self):
+    async def connect(self, min_size: int = 5, max_size: int = 8):
         if self.pool is not None and not self.pool._closed:
             logger.info("Reusing existing connection pool")
             return self.pool
-        logger.info(f"Creating connection pool using {self.dsn} dsn")
-        self.pool = await asyncpg.create_pool(dsn=self.dsn, min_size=5, max_size=8)
+        logger.info(f"Creating connection pool ({min_size}-{max_size} connections) using {self.dsn} dsn")
+        self.pool = await asyncpg.create_pool(
+            dsn=self.dsn, min_size=min_size, max_size=max_size, init=self._init_connection
+        )
         logger.info("Connection pool created")
 
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection):
+        conn.add_query_logger(DBClient._observe_query)
+
+    @staticmethod
+    def _observe_query(record: asyncpg.connection.LoggedQuery):
+        # command (SELECT, INSERT, ...) keeps the label cardinality low
+        DB_QUERY_DURATION.labels(record.query.lstrip().split(None, 1)[0].rstrip(";").upper()).observe(record.elapsed)
+
     async def close(self):
         if self.pool:
             await self.pool.close()
             logger.info("Connection pool closed")
 
+    async def apply_migrations(self, migrations_dir: str | Path):
+        """
+        Applies not yet applied .sql migrations from provided dir in the order of their version prefix
+        (e.g. 0002_feed_items_indexes.sql), every migration runs in its own transaction.
+        Services migrate on startup, thus advisory lock makes sure only one of them is migrating at a time.
+        """
+        migrations = sorted(
+            (int(path.name.split("_", 1)[0]), path)
+            for path in Path(migrations_dir).glob("*.sql")
+        )
+
+        async with self.acquire() as conn:
+            await conn.execute("SELECT pg_advisory_lock($1)", self.MIGRATIONS_LOCK_ID)
+            try:
+                await conn.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {self.MIGRATIONS_TABLE} (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    )
+                """
+                )
+                applied = {
+                    row["version"]
+                    for row in await conn.fetch(f"SELECT version FROM {self.MIGRATIONS_TABLE}")
+                }
+
+                for version, path in migrations:
+                    if version in applied:
+                        continue
+                    async with conn.transaction():
+                        await conn.execute(path.read_text())
+                        await conn.execute(
+                            f"INSERT INTO {self.MIGRATIONS_TABLE} (version, name) VALUES ($1, $2)",
+                            version,
+                            path.name,
+                        )
+                    logger.info(f"Applied migration {path.name}")
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", self.MIGRATIONS_LOCK_ID)
+
     def get_connection_pool(self) -> asyncpg.Pool:
         if self.pool is None:
             raise RuntimeError("Connection pool is None")
         return self.pool
 
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Acquires connection from the pool, time spent waiting for it is tracked in acquire_stats
+        """
+        started = time.perf_counter()
+        async with self.get_connection_pool().acquire() as conn:
+            wait = time.perf_counter() - started
+            DB_POOL_ACQUIRE_WAIT.observe(wait)
+            self.acquire_stats["acquired"] += 1
+            self.acquire_stats["wait_seconds"] += wait
+            self.acquire_stats["max_wait_seconds"] = max(self.acquire_stats["max_wait_seconds"], wait)
+            yield conn
+
+    def pool_stats(self) -> dict:
+        """
+        :return: current pool size and utilization (share of max_size connections in use) with acquire_stats
+        """
+        pool = self.get_connection_pool()
+        in_use = pool.get_size() - pool.get_idle_size()
+        return {
+            "size": pool.get_size(),
+            "max_size": pool.get_max_size(),
+            "in_use": in_use,
+            "utilization": round(in_use / pool.get_max_size(), 3),
+            **self.acquire_stats,
+        }
+
     async def get_feed_upload_items(
         self, feed_upload_id: int, item_id: Optional[str] = None
     ) -> list[FeedItemWithUploadReference]:
         sql = f"""
-            SELECT 
-                feed_upload_id, id, feed_item_id, title, description, link, image_link,
-                additional_image_link, price, condition, availability,
-                brand, gtin, item_group_id, sale_price
+            SELECT {', '.join(FEED_ITEM_READ_COLUMNS)}
             FROM {self.FEED_ITEMS_TABLE}
             WHERE feed_upload_id = $1
         """
@@ -52,8 +160,9 @@ class DBClient:
         if item_id:
             sql += " AND feed_item_id = $2"
             params.append(item_id)
+        sql += " ORDER BY id"
 
-        async with self.get_connection_pool().acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch(sql, *params)
         logger.info(
             f"{len(rows)} records were retrieved for feed_upload_id {feed_upload_id} and item_id {item_id}"
@@ -62,60 +171,306 @@ class DBClient:
             FeedItemWithUploadReference.model_construct(**dict(row)) for row in rows
         ]
 
-    async def save_feed_items(self, feed_items: list[FeedItemWithUploadReference], upload_feed_finished_at: Optional[datetime] = None):
-        if not feed_items:
-            return
+    def _feed_item_ids_sql(self) -> str:
+        return f"""
+            SELECT id, feed_item_id
+            FROM {self.FEED_ITEMS_TABLE}
+            WHERE feed_upload_id = $1 AND id > $2
+            ORDER BY id
+        """
 
-        update_sql = f"""
-                    UPDATE {self.FEED_UPLOADS_TABLE}
-                    SET status = $1, error = $2, successfully_finished_at = $4
-                    WHERE id = $3
-                """
+    def _feed_image_ids_sql(self) -> str:
+        # image_link is prepended to additional_image_link, so position 0 always belongs to image_link
+        return f"""
+            SELECT i.id, image.position - 1 AS position, image.image_id
+            FROM {self.FEED_ITEMS_TABLE} i
+            CROSS JOIN LATERAL unnest(
+                array_prepend(i.image_link, coalesce(i.additional_image_link, '{{}}'))
+            ) WITH ORDINALITY AS image(image_id, position)
+            WHERE i.feed_upload_id = $1 AND i.id >= $2
+                AND (i.id, image.position - 1) > ($2, $3)
+                AND image.image_id IS NOT NULL
+            ORDER BY i.id, image.position
+        """
 
-        columns = FeedItemWithUploadReference.db_columns()
-        placeholders = ", ".join(f"${i+1}" for i in range(len(columns)))
-        insert_feed_items_sql = f"""
-            INSERT INTO {self.FEED_ITEMS_TABLE} ({', '.join(columns)})
-            VALUES ({placeholders})
+    async def get_feed_item_ids(
+        self, feed_upload_id: int, limit: int, after: Optional[int] = None
+    ) -> list[asyncpg.Record]:
         """
+        :param limit: max number of returned records (page size)
+        :param after: keyset cursor - only items with greater feed_items.id are returned
+        :return: (id, feed_item_id) records ordered by id, thus in the order of their appearance in the feed
+        """
+        async with self.acquire() as conn:
+            return await conn.fetch(
+                f"{self._feed_item_ids_sql()} LIMIT $3", feed_upload_id, after or 0, limit
+            )
 
-        rows = [
-            tuple(feed_item.to_db_dict().get(col) for col in columns)
-            for feed_item in feed_items
-        ]
+    async def iter_feed_item_ids(
+        self, feed_upload_id: int, after: Optional[int] = None, chunk_size: int = 500
+    ) -> AsyncIterator[asyncpg.Record]:
+        """
+        Same as get_feed_item_ids, but all the records are streamed page by page of chunk_size records,
+        a connection is held only while a page is fetched, not while the consumer reads the records
+        """
+        while True:
+            rows = await self.get_feed_item_ids(feed_upload_id, limit=chunk_size, after=after)
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1]["id"]
 
-        logger.info(f"Saving {len(feed_items)} feed_items")
+    async def get_feed_image_ids(
+        self, feed_upload_id: int, limit: int, after: tuple[int, int] = (0, -1)
+    ) -> list[asyncpg.Record]:
+        """
+        Image ids of the feed are unnested in SQL - image_link first, then additional_image_link of each item
 
-        async with self.get_connection_pool().acquire() as conn:
+        :param limit: max number of returned records (page size)
+        :param after: keyset cursor - (feed_items.id, position) of the last already returned image
+        :return: (id, position, image_id) records ordered by id and position
+        """
+        async with self.acquire() as conn:
+            return await conn.fetch(
+                f"{self._feed_image_ids_sql()} LIMIT $4", feed_upload_id, *after, limit
+            )
+
+    async def iter_feed_image_ids(
+        self, feed_upload_id: int, after: tuple[int, int] = (0, -1), chunk_size: int = 500
+    ) -> AsyncIterator[asyncpg.Record]:
+        """
+        Same as get_feed_image_ids, but all the records are streamed page by page (see iter_feed_item_ids)
+        """
+        while True:
+            rows = await self.get_feed_image_ids(feed_upload_id, limit=chunk_size, after=after)
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = (rows[-1]["id"], rows[-1]["position"])
+
+    @asynccontextmanager
+    async def feed_items_writer(
+        self, feed_upload_id: int, chunk_size: Optional[int] = None
+    ) -> AsyncIterator["FeedItemsWriter"]:
+        """
+        Opens transaction in which feed items of the feed upload are written batch by batch, nothing
+        is visible until the writer is finished and the context exits, any exception rolls everything back
+
+        :param chunk_size: number of rows sent by one COPY command, all rows of a batch are sent by single command if None
+        """
+        async with self.acquire() as conn:
             async with conn.transaction():
-                await conn.executemany(insert_feed_items_sql, rows)
-                await conn.execute(
-                    update_sql,
-                    FeedUploadStatus.FINISHED,
-                    None,
-                    feed_items[0].feed_upload_id,
-                    upload_feed_finished_at or datetime.now()
-                )
+                yield FeedItemsWriter(self, conn, feed_upload_id, chunk_size)
+
+    @staticmethod
+    def _chunks(rows: Iterable[tuple], chunk_size: Optional[int]) -> Iterable[Iterable[tuple]]:
+        if chunk_size is None:
+            yield rows
+            return
+        rows = iter(rows)
+        while chunk := list(islice(rows, chunk_size)):
+            yield chunk
 
-    async def create_feed_upload_job(self) -> int:
+    async def get_previous_feed_upload(self, feed_upload_id: int) -> Optional[asyncpg.Record]:
+        """
+        :return: (feed_key, previous_id) record - previous_id is the last successfully finished upload
+            with the same feed key or None, None if the feed upload does not exist
+        """
+        # status is inlined - partial feed_uploads_finished_feed_key_idx is not usable by generic plan with parameter
         sql = f"""
-            INSERT INTO {self.FEED_UPLOADS_TABLE} (status, error)
-            VALUES ($1, $2)
-            RETURNING id
+            SELECT c.feed_key, (
+                SELECT p.id
+                FROM {self.FEED_UPLOADS_TABLE} p
+                WHERE p.feed_key = c.feed_key AND p.status = {FeedUploadStatus.FINISHED.value} AND p.id < c.id
+                ORDER BY p.id DESC
+                LIMIT 1
+            ) AS previous_id
+            FROM {self.FEED_UPLOADS_TABLE} c
+            WHERE c.id = $1
         """
-        async with self.get_connection_pool().acquire() as conn:
-            row = await conn.fetchrow(sql, FeedUploadStatus.QUEUED, None)
-            logger.info(f"Created feed upload job with {row['id']} id")
-            return row["id"]
+        async with self.acquire() as conn:
+            return await conn.fetchrow(sql, feed_upload_id)
+
+    async def get_feed_image(self, feed_upload_id: int, image_id: str) -> FeedImage | None:
+        sql = f"""
+            SELECT {', '.join(FeedImage.db_columns())}
+            FROM {self.FEED_IMAGES_TABLE}
+            WHERE feed_upload_id = $1 AND image_id = $2
+        """
+
+        async with self.acquire() as conn:
+            row = await conn.fetchrow(sql, feed_upload_id, image_id)
+
+        if not row:
+            return None
+
+        return FeedImage(**dict(row))
+
+    async def has_feed_images(self, feed_upload_id: int) -> bool:
+        """
+        :return: whether any image of the feed upload is indexed in feed_images
+        """
+        sql = f"SELECT EXISTS (SELECT 1 FROM {self.FEED_IMAGES_TABLE} WHERE feed_upload_id = $1)"
+        async with self.acquire() as conn:
+            return await conn.fetchval(sql, feed_upload_id)
+
+    async def save_feed_upload_profile(self, feed_upload_id: int, profile: dict):
+        """
+        Stores profile of feed upload processing, profile of re-processed upload replaces the previous one
+        """
+        sql = f"""
+            INSERT INTO {self.FEED_UPLOAD_PROFILES_TABLE} (feed_upload_id, profile)
+            VALUES ($1, $2::jsonb)
+            ON CONFLICT (feed_upload_id) DO UPDATE SET profile = EXCLUDED.profile, created_at = NOW()
+        """
+        async with self.acquire() as conn:
+            await conn.execute(sql, feed_upload_id, json.dumps(profile))
+
+    async def get_feed_upload_profile(self, feed_upload_id: int) -> Optional[dict]:
+        sql = f"""
+            SELECT profile FROM {self.FEED_UPLOAD_PROFILES_TABLE} WHERE feed_upload_id = $1
+        """
+        async with self.acquire() as conn:
+            profile = await conn.fetchval(sql, feed_upload_id)
+        return json.loads(profile) if profile is not None else None
+
+    async def create_feed_upload_job(
+        self, message: Optional[dict] = None, feed_key: Optional[str] = None
+    ) -> int:
+        """
+        :param message: outbox message of the job (see relay_outbox), written in the same transaction as the job
+        :param feed_key: stable key of merchant feed, items of keyed upload are diffed against its previous upload
+        :return: id of created job
+        """
+        if not self.job_batch_window:
+            return (await self.create_feed_upload_jobs([message], [feed_key]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_jobs.append((future, message, feed_key))
+        if len(self._pending_jobs) >= self.job_batch_max_size:
+            self._flush_feed_upload_jobs()
+        elif self._jobs_flush_timer is None:
+            self._jobs_flush_timer = loop.call_later(
+                self.job_batch_window, self._flush_feed_upload_jobs
+            )
+        return await future
+
+    def _flush_feed_upload_jobs(self):
+        if self._jobs_flush_timer is not None:
+            self._jobs_flush_timer.cancel()
+            self._jobs_flush_timer = None
+        pending, self._pending_jobs = self._pending_jobs, []
+
+        task = asyncio.create_task(self._resolve_feed_upload_jobs(pending))
+        self._jobs_flush_tasks.add(task)
+        task.add_done_callback(self._jobs_flush_tasks.discard)
+
+    async def _resolve_feed_upload_jobs(
+        self, pending: list[tuple[asyncio.Future, Optional[dict], Optional[str]]]
+    ):
+        try:
+            ids = await self.create_feed_upload_jobs(
+                [message for _, message, _ in pending], [feed_key for _, _, feed_key in pending]
+            )
+        except Exception as e:
+            for future, _, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (future, _, _), feed_upload_id in zip(pending, ids):
+            # caller may have been cancelled meanwhile (e.g. client disconnected)
+            if not future.done():
+                future.set_result(feed_upload_id)
+
+    async def create_feed_upload_jobs(
+        self, messages: list[Optional[dict]], feed_keys: Optional[list[Optional[str]]] = None
+    ) -> list[int]:
+        """
+        Creates one queued feed upload job per provided outbox message by single INSERT, jobs and their
+        outbox messages are written in one transaction
+
+        :param feed_keys: feed key of every job, in the order of messages
+        :return: ids of created jobs in the order of provided messages
+        """
+        feed_keys = feed_keys or [None] * len(messages)
+        sql = f"""
+            INSERT INTO {self.FEED_UPLOADS_TABLE} (status, error, feed_key)
+            SELECT $1, NULL, feed_key FROM unnest($2::text[]) AS job(feed_key)
+            RETURNING id, feed_key
+        """
+        outbox_sql = f"""
+            INSERT INTO {self.FEED_UPLOAD_OUTBOX_TABLE} (feed_upload_id, message)
+            SELECT * FROM unnest($1::integer[], $2::jsonb[])
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(sql, FeedUploadStatus.QUEUED, feed_keys)
+                # job rows with the same feed key are the same, thus any of their ids can be handed to any caller
+                ids_by_key: dict[Optional[str], list[int]] = {}
+                for row in rows:
+                    ids_by_key.setdefault(row["feed_key"], []).append(row["id"])
+                ids = [ids_by_key[feed_key].pop() for feed_key in feed_keys]
+                outbox = [
+                    (feed_upload_id, json.dumps(message))
+                    for feed_upload_id, message in zip(ids, messages)
+                    if message is not None
+                ]
+                if outbox:
+                    await conn.execute(outbox_sql, *map(list, zip(*outbox)))
+            logger.info(f"Created feed upload jobs with {ids} ids")
+            return ids
+
+    async def relay_outbox(
+        self, publish: Callable[[list[dict]], Awaitable[None]], limit: int = 100
+    ) -> int:
+        """
+        Publishes batch of not yet sent outbox messages through provided callable and marks them as sent.
+        Rows are locked (SKIP LOCKED) until publishing is over, so concurrent relays never publish the same batch,
+        failed publish leaves the whole batch unsent (at-least-once delivery).
+
+        :param publish: awaitable publishing list of {id, feed_upload_id, message} dicts
+        :return: number of published messages
+        """
+        select_sql = f"""
+            SELECT id, feed_upload_id, message::text AS message
+            FROM {self.FEED_UPLOAD_OUTBOX_TABLE}
+            WHERE sent_at IS NULL
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        """
+        update_sql = f"""
+            UPDATE {self.FEED_UPLOAD_OUTBOX_TABLE}
+            SET sent_at = NOW()
+            WHERE id = ANY($1::bigint[])
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(select_sql, limit)
+                if not rows:
+                    return 0
+                await publish(
+                    [
+                        {**dict(row), "message": json.loads(row["message"])}
+                        for row in rows
+                    ]
+                )
+                await conn.execute(update_sql, [row["id"] for row in rows])
+        logger.info(f"Relayed {len(rows)} outbox messages")
+        return len(rows)
 
     async def get_feed_upload_job(self, feed_upload_id: int) -> FeedUpload | None:
         sql = f"""
-            SELECT id, status, error, created_at, successfully_finished_at
+            SELECT id, status, error, created_at, processing_started_at, successfully_finished_at, feed_key,
+                items_added, items_changed, items_removed, items_unchanged, stage_seconds
             FROM {self.FEED_UPLOADS_TABLE}
             WHERE id = $1
         """
 
-        async with self.get_connection_pool().acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow(sql, feed_upload_id)
             logger.info(
                 f"Retrieved feed upload job with {feed_upload_id} id {'succsessfuly' if row is not None else 'unsuccessfuly'}"
@@ -124,7 +479,39 @@ class DBClient:
         if not row:
             return None
 
-        return FeedUpload(**dict(row))
+        stage_seconds = row["stage_seconds"]
+        return FeedUpload(
+            **{**dict(row), "stage_seconds": json.loads(stage_seconds) if stage_seconds is not None else None}
+        )
+
+    async def claim_feed_upload_job(self, feed_upload_id: int, lease: float) -> bool:
+        """
+        Marks queued job as processing, so it is processed by a single consumer only - messages are delivered
+        at-least-once, so a duplicate message of the job must not be processed again (or concurrently).
+        Job processed for longer than the lease is considered abandoned (e.g. its consumer was killed)
+        and can be claimed again.
+
+        :param lease: seconds after which processing job can be claimed again
+        :return: whether the job was claimed
+        """
+        sql = f"""
+            UPDATE {self.FEED_UPLOADS_TABLE}
+            SET status = {FeedUploadStatus.PROCESSING.value}, processing_started_at = NOW()
+            WHERE id = $1 AND (
+                status = {FeedUploadStatus.QUEUED.value}
+                OR (
+                    status = {FeedUploadStatus.PROCESSING.value}
+                    AND processing_started_at < NOW() - make_interval(secs => $2)
+                )
+            )
+            RETURNING id
+        """
+        async with self.acquire() as conn:
+            row = await conn.fetchrow(sql, feed_upload_id, lease)
+        logger.info(
+            f"Feed upload job with {feed_upload_id} id {'claimed' if row is not None else 'not claimable'}"
+        )
+        return row is not None
 
     async def update_feed_upload_job(
         self,
@@ -153,8 +540,158 @@ class DBClient:
             WHERE id = ${i}
         """
 
-        async with self.get_connection_pool().acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(sql, *values)
             logger.info(
                 f"Updated feed upload job with {feed_upload_id} id, with {status} - {status.name if status is not None else None} as status and {error} as error"
             )
+
+
+class FeedItemsWriter:
+    """
+    Writes batches of feed items and their images within the transaction of DBClient.feed_items_writer
+    """
+
+    def __init__(
+        self, db: DBClient, conn: asyncpg.Connection, feed_upload_id: int, chunk_size: Optional[int]
+    ):
+        self.db = db
+        self.conn = conn
+        self.feed_upload_id = feed_upload_id
+        self.chunk_size = chunk_size
+        self.columns = [*FEED_ITEM_ROW_COLUMNS, "feed_upload_id"]
+        self.image_columns = FeedImage.db_columns()
+        self.image_ids: set[str] = set()
+        self.items_written = 0
+        # the connection is shared by pipeline stages (see FeedItemsDiff), it runs one query at a time
+        self.lock = asyncio.Lock()
+
+    async def write(self, feed_items: list[Sequence], feed_images: list[FeedImage]):
+        """
+        Bulk loads feed items and the images not yet written by previous batches using binary COPY
+
+        :param feed_items: rows of FEED_ITEM_ROW_COLUMNS values, image links already replaced by image ids
+        """
+        async with self.lock:
+            rows = ((*feed_item, self.feed_upload_id) for feed_item in feed_items)
+            for chunk in self.db._chunks(rows, self.chunk_size):
+                await self.conn.copy_records_to_table(
+                    self.db.FEED_ITEMS_TABLE, records=chunk, columns=self.columns
+                )
+
+            # the same image may be referenced by items of different batches, or be both carried over
+            # and downloaded within one batch of a delta upload
+            new_images = list(
+                {image.image_id: image for image in feed_images if image.image_id not in self.image_ids}.values()
+            )
+            if new_images:
+                to_image_row = attrgetter(*self.image_columns)
+                await self.conn.copy_records_to_table(
+                    self.db.FEED_IMAGES_TABLE,
+                    records=(to_image_row(image) for image in new_images),
+                    columns=self.image_columns,
+                )
+                self.image_ids.update(image.image_id for image in new_images)
+
+        self.items_written += len(feed_items)
+        logger.info(f"Saved {len(feed_items)} feed_items of feed upload {self.feed_upload_id}")
+
+    async def get_previous_items(self, previous_id: int, feed_item_ids: list[str]) -> dict[str, asyncpg.Record]:
+        """
+        :return: (feed_item_id, content_hash, image_link, additional_image_link) records of provided items
+            of the previous upload by feed_item_id
+        """
+        sql = f"""
+            SELECT feed_item_id, content_hash, image_link, additional_image_link
+            FROM {self.db.FEED_ITEMS_TABLE}
+            WHERE feed_upload_id = $1 AND feed_item_id = ANY($2::text[])
+        """
+        async with self.lock:
+            rows = await self.conn.fetch(sql, previous_id, feed_item_ids)
+        return {row["feed_item_id"]: row for row in rows}
+
+    async def get_previous_images(self, previous_id: int, image_ids: list[str]) -> dict[str, FeedImage]:
+        """
+        :return: provided images of the previous upload by image_id
+        """
+        sql = f"""
+            SELECT {', '.join(self.image_columns)}
+            FROM {self.db.FEED_IMAGES_TABLE}
+            WHERE feed_upload_id = $1 AND image_id = ANY($2::text[])
+        """
+        async with self.lock:
+            rows = await self.conn.fetch(sql, previous_id, image_ids)
+        return {row["image_id"]: FeedImage(**dict(row)) for row in rows}
+
+    async def carry_over(self, previous_id: int, feed_item_ids: list[str]) -> int:
+        """
+        Copies unchanged items of the previous upload of the same feed key into this feed upload within the db,
+        so their rows are neither loaded nor sent back. Copied items keep image ids of their previous version,
+        the caller writes the images (see write).
+
+        :return: number of copied items
+        """
+        columns = ", ".join(FEED_ITEM_ROW_COLUMNS)
+        sql = f"""
+            INSERT INTO {self.db.FEED_ITEMS_TABLE} ({columns}, feed_upload_id)
+            SELECT {columns}, $1
+            FROM {self.db.FEED_ITEMS_TABLE}
+            WHERE feed_upload_id = $2 AND feed_item_id = ANY($3::text[])
+            ORDER BY id
+        """
+        async with self.lock:
+            status = await self.conn.execute(sql, self.feed_upload_id, previous_id, feed_item_ids)
+        carried = int(status.rsplit(" ", 1)[-1])  # INSERT 0 <rows>
+        self.items_written += carried
+        logger.info(f"Carried over {carried} feed_items of feed upload {previous_id} to {self.feed_upload_id}")
+        return carried
+
+    async def count_removed(self, previous_id: int) -> int:
+        """
+        :return: number of item ids of the previous upload missing from the items written so far
+        """
+        sql = f"""
+            SELECT count(DISTINCT p.feed_item_id)
+            FROM {self.db.FEED_ITEMS_TABLE} p
+            WHERE p.feed_upload_id = $1 AND NOT EXISTS (
+                SELECT 1 FROM {self.db.FEED_ITEMS_TABLE} c
+                WHERE c.feed_upload_id = $2 AND c.feed_item_id = p.feed_item_id
+            )
+        """
+        async with self.lock:
+            return await self.conn.fetchval(sql, previous_id, self.feed_upload_id)
+
+    async def finish(
+        self,
+        delta: Optional[dict[str, int]] = None,
+        finished_at: Optional[datetime] = None,
+        stage_seconds: Optional[dict[str, float]] = None,
+    ):
+        """
+        Marks the feed upload as finished, becomes visible together with written items on commit
+
+        :param delta: items_added, items_changed, items_removed and items_unchanged counts of keyed upload
+        :param stage_seconds: busy seconds of processing stages by stage name
+        """
+        delta = delta or {}
+        update_sql = f"""
+                    UPDATE {self.db.FEED_UPLOADS_TABLE}
+                    SET status = $1, error = $2, successfully_finished_at = $4,
+                        items_added = $5, items_changed = $6, items_removed = $7, items_unchanged = $8,
+                        stage_seconds = $9
+                    WHERE id = $3
+                """
+        async with self.lock:
+            await self.conn.execute(
+                update_sql,
+                FeedUploadStatus.FINISHED,
+                None,
+                self.feed_upload_id,
+                finished_at or datetime.now(),
+                delta.get("items_added"),
+                delta.get("items_changed"),
+                delta.get("items_removed"),
+                delta.get("items_unchanged"),
+                json.dumps(stage_seconds) if stage_seconds is not None else None,
+            )
+        logger.info(f"Saved {self.items_written} feed_items of finished feed upload {self.feed_upload_id}")
@@ -0,0 +1,89 @@
+import asyncio
+from contextlib import contextmanager
+import json
+from typing import Callable, Iterator, Optional
+
+import asyncpg
+
+from logger import get_logger
+from models.FeedUpload import FeedUploadStatus
+
+logger = get_logger(__name__)
+
+
+class FeedStatusListener:
+    """
+    Holds single dedicated connection LISTENing on feed upload status changes (see feed_uploads_status_notify
+    trigger) and fans every change out to all subscribed callbacks and watchers of the feed upload within the process.
+    """
+
+    CHANNEL = "feed_upload_status"
+    RECONNECT_DELAY = 5
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.connection: Optional[asyncpg.Connection] = None
+        self.callbacks: list[Callable[[int, FeedUploadStatus], None]] = []
+        self.watchers: dict[int, set[asyncio.Queue]] = {}
+        self.reconnect_task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def subscribe(self, callback: Callable[[int, FeedUploadStatus], None]):
+        self.callbacks.append(callback)
+
+    @contextmanager
+    def watch(self, feed_upload_id: int) -> Iterator[asyncio.Queue]:
+        """
+        :return: queue receiving every status change of provided feed upload until the context is exited
+        """
+        queue: asyncio.Queue[FeedUploadStatus] = asyncio.Queue()
+        self.watchers.setdefault(feed_upload_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            watchers = self.watchers[feed_upload_id]
+            watchers.discard(queue)
+            if not watchers:
+                del self.watchers[feed_upload_id]
+
+    async def connect(self):
+        logger.info(f"Listening on {self.CHANNEL} channel")
+        self.connection = await asyncpg.connect(dsn=self.dsn)
+        self.connection.add_termination_listener(self._on_termination)
+        await self.connection.add_listener(self.CHANNEL, self._on_notification)
+
+    async def close(self):
+        self.closed = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.connection is not None and not self.connection.is_closed():
+            await self.connection.close()
+            logger.info(f"Stopped listening on {self.CHANNEL} channel")
+
+    def _on_notification(self, connection, pid, channel, payload: str):
+        notification = json.loads(payload)
+        feed_upload_id = notification["id"]
+        status = FeedUploadStatus(notification["status"])
+        for callback in list(self.callbacks):
+            try:
+                callback(feed_upload_id, status)
+            except Exception as e:
+                logger.warning(f"Feed status callback failed: {str(e)}")
+        # callbacks (e.g. cache invalidation) go first, so watchers read already fresh data
+        for queue in self.watchers.get(feed_upload_id, ()):
+            queue.put_nowait(status)
+
+    def _on_termination(self, connection):
+        if self.closed:
+            return
+        logger.warning("Listening connection was terminated, reconnecting")
+        self.reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self.closed:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                await self.connect()
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning(f"Unable to reconnect listening connection: {str(e)}")
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import mimetypes
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterable, Optional
+from uuid import uuid4
+
+import aiofiles
+
+from logger import get_logger
+from models.FeedImage import FeedImage
+
+logger = get_logger(__name__)
+
+
+class ImageStore:
+    """
+    Content addressed image storage shared by all feed uploads.
+
+    Layout inside base_dir:
+    - blobs/{hash[:2]}/{hash}{ext} - every distinct image content is stored exactly once
+    - urls/{url_hash[:2]}/{url_hash}.json - index of already downloaded urls pointing to their blob
+    - {feed_upload_id}/{hash}{ext} - hard link to the blob, so images can be still served per feed
+
+    Hard links also serve as reference counting - blob's st_nlink minus one is the number of feeds
+    referencing it, thus the blob can be removed when its last feed is removed.
+
+    Url index works as HTTP cache - entries keep ETag/Last-Modified of the response, entries younger
+    than ttl are used without any request, older ones should be revalidated by conditional request.
+    Index file's mtime tracks the last usage of the entry for LRU eviction.
+    """
+
+    BLOBS_DIR = "blobs"
+    URLS_DIR = "urls"
+    TMP_DIR = "tmp"
+
+    def __init__(self, base_dir: str | Path, ttl: float = 0):
+        self.base_dir = Path(base_dir)
+        self.ttl = ttl
+        self.stats = {
+            "hits": 0,  # fresh entry used without any request
+            "revalidated": 0,  # entry confirmed by 304 Not Modified
+            "misses": 0,  # whole image downloaded
+            "bytes_downloaded": 0,
+            "bytes_saved": 0,
+        }
+
+    def feed_dir(self, feed_upload_id: int) -> Path:
+        return self.base_dir / str(feed_upload_id)
+
+    def blob_path(self, blob: str) -> Path:
+        return self.base_dir / self.BLOBS_DIR / blob[:2] / blob
+
+    def _url_index_path(self, url: str) -> Path:
+        url_hash = hashlib.sha256(url.encode()).hexdigest()
+        return self.base_dir / self.URLS_DIR / url_hash[:2] / f"{url_hash}.json"
+
+    async def lookup(self, url: str) -> Optional[dict]:
+        """
+        :return: url index entry of already downloaded url, None if url is unknown or its blob was removed
+        """
+        index_path = self._url_index_path(url)
+        try:
+            async with aiofiles.open(index_path, "r") as f:
+                entry = json.loads(await f.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if not self.blob_path(entry["blob"]).exists():
+            return None
+
+        os.utime(index_path)
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["validated_at"] < self.ttl
+
+    def conditional_headers(self, entry: dict) -> dict[str, str]:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def record_hit(self, entry: dict):
+        self.stats["hits"] += 1
+        self.stats["bytes_saved"] += entry["size"]
+
+    async def revalidate(self, entry: dict):
+        """
+        Marks entry as valid again after the server responded with 304 Not Modified
+        """
+        self.stats["revalidated"] += 1
+        self.stats["bytes_saved"] += entry["size"]
+        await self._index_url({**entry, "validated_at": time.time()})
+
+    async def save(
+        self,
+        url: str,
+        chunks: AsyncIterable[bytes],
+        ext: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        content_type: Optional[str] = None,
+    ) -> dict:
+        """
+        Streams image content into a temporary file while hashing it, then publishes it as blob
+        (if not stored yet) and indexes it by provided url. Temporary file is removed if the stream fails,
+        so partially downloaded images are never visible.
+
+        :return: url index entry of the stored image
+        """
+        content_hash = hashlib.sha256()
+        size = 0
+        tmp_path = self._tmp_path()
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    content_hash.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        self.stats["misses"] += 1
+        self.stats["bytes_downloaded"] += size
+
+        blob = f"{content_hash.hexdigest()}{ext}"
+        self._publish(tmp_path, self.blob_path(blob))
+
+        entry = {
+            "url": url,
+            "blob": blob,
+            "size": size,
+            "content_type": content_type,
+            "etag": etag,
+            "last_modified": last_modified,
+            "validated_at": time.time(),
+        }
+        await self._index_url(entry)
+        return entry
+
+    def link(self, entry: dict, feed_upload_id: int) -> FeedImage:
+        """
+        References the blob of url index entry from the feed upload dir
+
+        :raises FileNotFoundError: blob was removed in the meantime
+        :return: image of the feed, its path is relative to base_dir
+        """
+        blob = entry["blob"]
+        return self.link_blob(
+            blob,
+            feed_upload_id,
+            entry.get("content_type") or mimetypes.guess_type(blob)[0] or "application/octet-stream",
+            entry["size"],
+        )
+
+    def link_blob(self, blob: str, feed_upload_id: int, content_type: str, size: int) -> FeedImage:
+        """
+        References already stored blob from the feed upload dir (e.g. image carried over from previous upload)
+
+        :raises FileNotFoundError: blob does not exist
+        :return: image of the feed, its path is relative to base_dir
+        """
+        feed_dir = self.feed_dir(feed_upload_id)
+        feed_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(self.blob_path(blob), feed_dir / blob)
+        except FileExistsError:
+            pass  # same image is referenced multiple times within the feed
+
+        return FeedImage(
+            feed_upload_id=feed_upload_id,
+            image_id=Path(blob).stem,
+            path=f"{feed_upload_id}/{blob}",
+            content_type=content_type,
+            size=size,
+        )
+
+    def remove_feed(self, feed_upload_id: int):
+        """
+        Removes feed upload dir and all the blobs which are no longer referenced by any feed
+        """
+        feed_dir = self.feed_dir(feed_upload_id)
+        if not feed_dir.exists():
+            return
+
+        removed_blobs = 0
+        for image_path in feed_dir.iterdir():
+            links = image_path.stat().st_nlink
+            image_path.unlink()
+            if links == 2:  # only this feed and the blob itself
+                self.blob_path(image_path.name).unlink(missing_ok=True)
+                removed_blobs += 1
+        feed_dir.rmdir()
+        logger.info(
+            f"Removed images of feed upload {feed_upload_id}, {removed_blobs} blobs were no longer referenced"
+        )
+
+    def evict(self, max_bytes: int) -> int:
+        """
+        Evicts least recently used url index entries until the blobs held by the index fit into max_bytes.
+        Blob of evicted entry is removed as well, unless it is still referenced by some feed.
+
+        :return: number of evicted entries
+        """
+        entries = []
+        for index_path in (self.base_dir / self.URLS_DIR).rglob("*.json"):
+            try:
+                last_used = index_path.stat().st_mtime
+                entry = json.loads(index_path.read_text())
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            entries.append((last_used, index_path, entry["blob"]))
+
+        entries_per_blob: dict[str, int] = {}
+        blob_sizes: dict[str, int] = {}
+        for _, _, blob in entries:
+            entries_per_blob[blob] = entries_per_blob.get(blob, 0) + 1
+            if blob not in blob_sizes:
+                try:
+                    blob_sizes[blob] = self.blob_path(blob).stat().st_size
+                except FileNotFoundError:
+                    blob_sizes[blob] = 0
+
+        total_bytes = sum(blob_sizes.values())
+        evicted = 0
+        for _, index_path, blob in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            index_path.unlink(missing_ok=True)
+            evicted += 1
+            entries_per_blob[blob] -= 1
+            if entries_per_blob[blob] > 0:
+                continue
+
+            total_bytes -= blob_sizes[blob]
+            blob_path = self.blob_path(blob)
+            try:
+                if blob_path.stat().st_nlink == 1:
+                    blob_path.unlink()
+            except FileNotFoundError:
+                pass
+
+        logger.info(
+            f"Evicted {evicted} url index entries, {total_bytes} bytes are held by the index"
+        )
+        return evicted
+
+    def _tmp_path(self) -> Path:
+        tmp_dir = self.base_dir / self.TMP_DIR
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir / uuid4().hex
+
+    def _publish(self, tmp_path: Path, path: Path):
+        # link instead of rename, blob which already exists must keep its inode (and its references)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+
+    async def _index_url(self, entry: dict):
+        index_path = self._url_index_path(entry["url"])
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._tmp_path()
+        async with aiofiles.open(tmp_path, "w") as f:
+            await f.write(json.dumps(entry))
+        os.replace(tmp_path, index_path)
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """
+    Simple in-process cache bounded by number of entries, least recently used entry is evicted first.
+    Entries may optionally expire after provided ttl.
+    """
+
+    def __init__(self, max_size: int, on_evict: Optional[Callable[[Hashable], None]] = None):
+        """
+        :param on_evict: called with the key of every entry evicted by LRU policy or expired, not on delete
+        """
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.entries: OrderedDict[Hashable, tuple[V, Optional[float]]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.entries[key]
+            if self.on_evict is not None:
+                self.on_evict(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None):
+        """
+        :param ttl: seconds after which the entry expires, entry is evicted only by LRU policy if None
+        """
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+    def delete(self, key: Hashable) -> bool:
+        """
+        :return: whether the entry was present
+        """
+        return self.entries.pop(key, None) is not None
@@ -0,0 +1,67 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from clients.db_client import DBClient
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class OutboxRelay:
+    """
+    Background task publishing feed upload outbox messages (see DBClient.relay_outbox) in batches.
+
+    Relay is woken up right after a job was created within the process, poll_interval is the fallback
+    for messages left behind by failed publishes or by other api processes.
+    """
+
+    ERROR_DELAY = 5
+
+    def __init__(
+        self,
+        db: DBClient,
+        publish: Callable[[list[dict]], Awaitable[None]],
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+    ):
+        self.db = db
+        self.publish = publish
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wake_up = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        logger.info("Outbox relay started")
+
+    def wake(self):
+        self.wake_up.set()
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        logger.info("Outbox relay stopped")
+
+    async def _run(self):
+        while True:
+            self.wake_up.clear()
+            try:
+                relayed = await self.db.relay_outbox(self.publish, self.batch_size)
+            except Exception as e:
+                logger.warning(f"Relaying outbox failed: {str(e)}")
+                await asyncio.sleep(self.ERROR_DELAY)
+                continue
+
+            # full batch means there are probably more messages waiting
+            if relayed == self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self.wake_up.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -1,7 +1,9 @@
+import time
 from typing import Optional
 import aio_pika
 
 from logger import get_logger
+from metrics import PUBLISH_DURATION
 
 logger = get_logger(__name__)
 
@@ -20,6 +22,8 @@ class RabbitMQClient:
         self.host = host
         self.exchange = exchange
         self.queue = queue
+        # messages to be processed later wait here until they expire and are dead-lettered back into the queue
+        self.retry_queue = f"{queue}.retry"
         self.routing_key = routing_key
         self.connection = None
         self.channel = None
@@ -45,16 +49,53 @@ class RabbitMQClient:
         )
         logger.info("Connection for publishing created")
 
-    async def connect_for_consuming(self):
+    async def connect_for_consuming(self, prefetch_count: Optional[int] = None):
+        """
+        :param prefetch_count: max number of unacknowledged messages delivered to the consumer, unlimited if None
+        """
         logger.info(f"Creating connection for consuming using {f'amqp://{self.user}:{self.password}@{self.host}/'}")
         self.connection = await aio_pika.connect_robust(
             f"amqp://{self.user}:{self.password}@{self.host}/"
         )
         self.channel = await self.connection.channel()
+        if prefetch_count is not None:
+            await self.channel.set_qos(prefetch_count=prefetch_count)
 
-        self.queue_declared = await self.channel.declare_queue(self.queue, durable=True)     
+        self.queue_declared = await self.channel.declare_queue(self.queue, durable=True)
+        await self.channel.declare_queue(
+            self.retry_queue,
+            durable=True,
+            arguments={"x-dead-letter-exchange": "", "x-dead-letter-routing-key": self.queue},
+        )
         logger.info("Connection for consuming created")   
 
+    async def retry_later(self, message: aio_pika.abc.AbstractIncomingMessage, delay: float):
+        """
+        Publishes copy of consumed message into the retry queue, the copy is delivered again once the delay elapses
+        (the same delay for all messages, so no message waits behind one expiring later), returns once the broker
+        confirmed it - the original can be acknowledged afterwards
+        """
+        await self.get_channel().default_exchange.publish(
+            aio_pika.Message(
+                message.body,
+                headers=message.headers,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                delivery_mode=message.delivery_mode,
+                message_id=message.message_id,
+                expiration=delay,
+            ),
+            routing_key=self.retry_queue,
+        )
+
+    async def publish(self, message: aio_pika.Message, routing_key: str):
+        """
+        Publishes message through the default exchange, returns once the broker confirmed it
+        """
+        started = time.perf_counter()
+        await self.get_channel().default_exchange.publish(message, routing_key=routing_key)
+        PUBLISH_DURATION.labels(routing_key).observe(time.perf_counter() - started)
+
     async def close(self):
         if self.connection:
             await self.connection.close()
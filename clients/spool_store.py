@@ -0,0 +1,75 @@
+import gzip
+import os
+from pathlib import Path
+from typing import AsyncIterable, BinaryIO, Optional
+from uuid import uuid4
+
+import aiofiles
+import zstandard
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class SpoolStore:
+    """
+    Claim-check storage of uploaded feed payloads - api streams the payload into the store and publishes
+    only its reference, consumers read the payload by the reference and delete it once processed.
+
+    Local filesystem implementation (directory shared between api and consumers), other blob stores
+    should provide the same write/open/delete interface.
+
+    Payloads are stored as received (e.g. gzip compressed), they are decompressed only while being read.
+    """
+
+    PARTIAL_SUFFIX = ".part"
+    CONTENT_ENCODINGS = ("identity", "gzip", "zstd")
+
+    def __init__(self, base_dir: str | Path):
+        self.base_dir = Path(base_dir)
+
+    def path(self, ref: str) -> Path:
+        if Path(ref).name != ref:
+            raise ValueError(f"Invalid spool reference {ref}")
+        return self.base_dir / ref
+
+    async def write(self, chunks: AsyncIterable[bytes]) -> str:
+        """
+        Streams payload chunk by chunk into the store, payload becomes visible under its reference only when complete
+
+        :return: reference of stored payload
+        """
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        ref = uuid4().hex
+        partial_path = self.base_dir / f"{ref}{self.PARTIAL_SUFFIX}"
+        size = 0
+        try:
+            async with aiofiles.open(partial_path, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        os.replace(partial_path, self.path(ref))
+        logger.info(f"Spooled {size} bytes payload as {ref}")
+        return ref
+
+    def open(self, ref: str, content_encoding: Optional[str] = None) -> BinaryIO:
+        """
+        :param content_encoding: encoding of stored payload (one of CONTENT_ENCODINGS), None means identity
+        :return: binary file object incrementally decompressing the payload while being read
+        """
+        path = self.path(ref)
+        if content_encoding in (None, "identity"):
+            return open(path, "rb")
+        if content_encoding == "gzip":
+            return gzip.open(path, "rb")
+        if content_encoding == "zstd":
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        raise ValueError(f"Unsupported content encoding {content_encoding}")
+
+    def delete(self, ref: str):
+        self.path(ref).unlink(missing_ok=True)
@@ -1,10 +1,21 @@
 import asyncio
 import os
+import signal
+
+import aio_pika
 
 from clients.db_client import DBClient
 from clients.rabbitmq_client import RabbitMQClient
-from consumer.processing_utils import process_feeds
+from clients.spool_store import SpoolStore
+from consumer.processing_utils import (
+    FEED_UPLOAD_CLAIM_LEASE,
+    FeedUploadInProgressException,
+    process_feeds,
+    process_spooled_feeds,
+    shutdown_parsing_executor,
+)
 from logger import get_logger
+from metrics import start_metrics_server
 
 logger = get_logger("CONSUMER SERVICE")
 
@@ -20,6 +31,99 @@ pg_password = os.getenv("POSTGRES_PASSWORD", "pass")
 pg_port = os.getenv("POSTGRES_PORT", "5432")
 
 images_dir = os.getenv("SHARED_IMAGES_DIR", "./app/images")
+spool_dir = os.getenv("SHARED_SPOOL_DIR", "./app/spool")
+migrations_dir = os.getenv("MIGRATIONS_DIR", "./db_init/migrations")
+db_pool_min_size = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+db_pool_max_size = int(os.getenv("DB_POOL_MAX_SIZE", "8"))
+metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+
+# number of feeds processed concurrently, it is also the channel prefetch so the broker
+# never delivers more messages than can be processed at once
+consumer_concurrency = int(os.getenv("CONSUMER_CONCURRENCY", "4"))
+# message of a job being processed by another consumer is delivered again after this delay (seconds), capped
+# by the claim lease, so a job of killed consumer is claimed again soon after its lease expires
+feed_upload_retry_delay = min(float(os.getenv("FEED_UPLOAD_RETRY_DELAY", "60")), FEED_UPLOAD_CLAIM_LEASE)
+
+
+async def handle_message(
+    message: aio_pika.abc.AbstractIncomingMessage,
+    spool_store: SpoolStore,
+    db: DBClient,
+    rabbitmq_client: RabbitMQClient,
+):
+    """
+    Method processes single feed upload message, the message is acknowledged once the processing is over
+    """
+    try:
+        async with message.process():
+
+            feed_upload_id = message.headers.get("feed_upload_id")
+            if not isinstance(
+                feed_upload_id, int
+            ):  # was unable to type it into the int
+                raise ValueError(
+                    "Expected an integer value as feed_upload_id from header"
+                )
+            logger.info(f"Started processing feed upload with id {feed_upload_id}")
+
+            try:
+                spool_ref = message.headers.get("spool_ref")
+                if spool_ref is not None:
+                    await process_spooled_feeds(
+                        feed_upload_id,
+                        spool_ref,
+                        spool_store,
+                        images_dir,
+                        logger,
+                        db,
+                        message.content_encoding,
+                        bool(message.headers.get("profile")),
+                    )
+                else:
+                    # messages published before claim check carry the feed in the body
+                    await process_feeds(
+                        feed_upload_id, message.body, images_dir, logger, db
+                    )
+            except FeedUploadInProgressException as e:
+                # duplicate message or redelivered message of killed consumer's job - the job is skipped once
+                # finished or claimed again once the lease of the other consumer expires
+                await rabbitmq_client.retry_later(message, feed_upload_retry_delay)
+                logger.info(f"Message {message.message_id} retried in {feed_upload_retry_delay}s: {str(e)}")
+    except Exception as e:
+        # message was already rejected by message.process()
+        logger.warning(f"Processing of message {message.message_id} failed: {str(e)}")
+
+
+async def consume(
+    rabbitmq_client: RabbitMQClient, db: DBClient, spool_store: SpoolStore, stopping: asyncio.Event
+):
+    """
+    Method processes up to consumer_concurrency messages at once until stopping is set, then it stops
+    deliveries, waits for in-flight feed uploads and closes the connections
+    """
+    await rabbitmq_client.connect_for_consuming(prefetch_count=consumer_concurrency)
+
+    in_flight: set[asyncio.Task] = set()
+
+    async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+        task = asyncio.create_task(handle_message(message, spool_store, db, rabbitmq_client))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    queue = rabbitmq_client.get_queue()
+    consumer_tag = await queue.consume(on_message)
+    logger.info(f"Ready for processing up to {consumer_concurrency} feeds concurrently")
+
+    await stopping.wait()
+
+    # stop deliveries first, then let in-flight feeds finish before closing the connections
+    logger.info(f"Stopping, waiting for {len(in_flight)} in-flight feed uploads")
+    await queue.cancel(consumer_tag)
+    await asyncio.gather(*in_flight)
+    shutdown_parsing_executor()
+    await rabbitmq_client.close()
+    await db.close()
+    logger.info("Consumer service stopped")
 
 
 async def main():
@@ -37,26 +141,18 @@ async def main():
         dsn=f"postgresql://{pg_user}:{pg_password}@{db_host}:{pg_port}/{pg_db}"
     )
 
-    await db.connect()
-    await rabbitmq_client.connect_for_consuming()
+    spool_store = SpoolStore(spool_dir)
+    start_metrics_server(metrics_port)
 
-    async with rabbitmq_client.get_queue().iterator() as queue_iter:
-        logger.info("Ready for processing")
-        async for message in queue_iter:
-            async with message.process():
+    await db.connect(min_size=db_pool_min_size, max_size=db_pool_max_size)
+    await db.apply_migrations(migrations_dir)
 
-                feed_upload_id = message.headers.get("feed_upload_id")
-                if not isinstance(
-                    feed_upload_id, int
-                ):  # was unable to type it into the int
-                    raise ValueError(
-                        "Expected an integer value as feed_upload_id from header"
-                    )
-                logger.info(f"Started processing feed upload with id {feed_upload_id}")
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
 
-                await process_feeds(
-                    feed_upload_id, message.body.decode(), images_dir, logger, db
-                )
+    await consume(rabbitmq_client, db, spool_store, stopping)
 
 
 if __name__ == "__main__":
@@ -1,43 +1,194 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import AsyncExitStack, ExitStack, aclosing, nullcontext
+from functools import partial
+import hashlib
+from itertools import islice
 import json
 from logging import Logger
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+import pickle
+import struct
+import time
 from pathlib import Path
-from pyexpat import ExpatError
-import shutil
-from uuid import uuid4
-import aiofiles
+from pyexpat import ExpatError, ParserCreate
+from typing import AsyncIterator, BinaryIO, Callable, Iterator, Optional, Sequence
 import aiohttp
 from pydantic import ValidationError
-import xmltodict
 
-from clients.db_client import DBClient
-from models.FeedItem import FeedItem, FeedItemWithUploadReference
+from clients.db_client import DBClient, FeedItemsWriter
+from clients.image_store import ImageStore
+from clients.spool_store import SpoolStore
+from consumer.profiling import FeedProfile, SamplingProfiler, should_profile
+from logger import get_logger
+from metrics import (
+    FEED_IMAGES,
+    FEED_ITEMS,
+    FEED_UPLOADS,
+    FEED_UPLOADS_IN_PROGRESS,
+    IMAGE_BYTES,
+    STAGE_DURATION,
+)
+from models.FeedImage import FeedImage
+from models.FeedItem import (
+    FEED_ITEM_ROW_COLUMNS,
+    FEED_ITEM_ROWS_ADAPTER,
+    FeedItem,
+)
 from models.FeedUpload import FeedUploadStatus
 
+logger = get_logger(__name__)
+
+
+FEED_ITEM_PATH = ["rss", "channel", "item"]
+XML_CHUNK_SIZE = 64 * 1024
+
+# global and per-host limit of simultaneously opened connections while downloading feed images
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "32"))
+IMAGE_DOWNLOAD_PER_HOST = int(os.getenv("IMAGE_DOWNLOAD_PER_HOST", "8"))
+
+# already downloaded images younger than ttl (seconds) are reused without any request, older ones are revalidated
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "3600"))
+# disk budget (bytes) of images held by the url cache, 0 means unbounded
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", "0"))
+IMAGE_CACHE_EVICTION_INTERVAL = float(os.getenv("IMAGE_CACHE_EVICTION_INTERVAL", "300"))
+_last_cache_eviction = 0.0
+
+# number of processes parsing and validating feeds off the event loop, 0 means parsing on the event loop
+PARSING_PROCESSES = int(os.getenv("PARSING_PROCESSES", "1"))
+_parsing_executor: Optional[ProcessPoolExecutor] = None
+# parsed items are validated (and their rows built) in batches of this size by a single pydantic call
+VALIDATION_BATCH_SIZE = 1000
+# length prefix of pickled row batches streamed back from parsing process
+_BATCH_HEADER = struct.Struct("!Q")
+
+# positions of the columns read or replaced by the pipeline within feed item rows (see FEED_ITEM_ROW_COLUMNS)
+ROW_FEED_ITEM_ID, ROW_IMAGE_LINK, ROW_ADDITIONAL_IMAGE_LINK, ROW_CONTENT_HASH = (
+    FEED_ITEM_ROW_COLUMNS.index(column)
+    for column in ("feed_item_id", "image_link", "additional_image_link", "content_hash")
+)
+
+# feed items flow from parsing through image downloads into db writes in batches of this size,
+# every stage holds at most PIPELINE_QUEUE_SIZE batches waiting for the next stage
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", "500"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+
+# seconds after which job still being processed is considered abandoned and its redelivered message
+# may claim it again, has to exceed processing time of the biggest feed
+FEED_UPLOAD_CLAIM_LEASE = float(os.getenv("FEED_UPLOAD_CLAIM_LEASE", "3600"))
+
+# invalid spool reference (e.g. whole feed of an old message) is reported by its prefix of this length
+SPOOL_REF_ERROR_LENGTH = 64
+
+# xml itself or a picklable callable opening it as binary file (e.g. spooled feed), so that
+# parsing process reads the feed on its own instead of receiving its content
+FeedSource = str | bytes | Callable[[], BinaryIO]
+
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_ALLOWED_CONTENT_TYPES = os.getenv(
+    "IMAGE_ALLOWED_CONTENT_TYPES",
+    "image/jpeg,image/png,image/gif,image/webp,image/avif,image/bmp,image/tiff",
+).split(",")
+
 
 class FeedParsingException(Exception):
     def __init__(self, message="An error occurred while parsing the feed."):
         super().__init__(message)
 
-async def process_feeds(feed_upload_id: int, xml_string: str, images_dir: str, logger: Logger, db: DBClient):
+
+class FeedUploadInProgressException(Exception):
+    """
+    Feed upload job is being processed by another consumer - message should be retried later,
+    it is skipped once the job is finished or claimed again once the lease of the other consumer expires
+    """
+
+    def __init__(self, feed_upload_id: int):
+        super().__init__(f"Feed upload {feed_upload_id} is being processed by another consumer")
+
+
+async def process_spooled_feeds(
+    feed_upload_id: int,
+    spool_ref: str,
+    spool_store: SpoolStore,
+    images_dir: str,
+    logger: Logger,
+    db: DBClient,
+    content_encoding: Optional[str] = None,
+    profile: bool = False,
+):
+    """
+    Method processes xml feed stored in spool store under provided reference (claim check), the feed is streamed
+    (and incrementally decompressed) from the spool file while parsing and the file is deleted once the processing is over
+
+    :param content_encoding: Content-Encoding the feed was uploaded with, None means identity
+    :param profile: whether the processing should be profiled (X-Profile header of the upload)
+    """
+    try:
+        spool_path = spool_store.path(spool_ref)
+    except ValueError:
+        # e.g. /feeds-v2 message published before claim check carries the feed itself instead of its reference,
+        # retrying such message would never succeed
+        spool_path = None
+
+    if spool_path is None or not spool_path.exists():
+        # duplicate message of already processed (thus deleted) feed is not an error
+        if await db.claim_feed_upload_job(feed_upload_id, FEED_UPLOAD_CLAIM_LEASE):
+            if spool_path is None:
+                error = f"Invalid spool reference {spool_ref[:SPOOL_REF_ERROR_LENGTH]!r}"
+            else:
+                error = f"Spooled feed {spool_ref} not found"
+            await db.update_feed_upload_job(feed_upload_id, status=FeedUploadStatus.FINISHED_ERROR, error=error)
+            logger.warning(f"{error} (feed upload {feed_upload_id})")
+        return
+
+    await process_feeds(
+        feed_upload_id, partial(spool_store.open, spool_ref, content_encoding), images_dir, logger, db, profile
+    )
+    spool_store.delete(spool_ref)
+
+
+async def process_feeds(
+    feed_upload_id: int,
+    feed: FeedSource,
+    images_dir: str,
+    logger: Logger,
+    db: DBClient,
+    profile: bool = False,
+):
     """
     Method processes whole background logic on provided xml feed
+
+    :param profile: whether the processing should be profiled, PROFILE_SAMPLE_RATE share of the other
+        uploads is profiled as well. Profile is stored even if the processing fails.
     """
+    feed_profile = None
     try:
-        # update associated feed upload job
-        await db.update_feed_upload_job(
-            feed_upload_id, status=FeedUploadStatus.PROCESSING
-        )
+        # update associated feed upload job, duplicate message of already finished one is skipped
+        if not await db.claim_feed_upload_job(feed_upload_id, FEED_UPLOAD_CLAIM_LEASE):
+            feed_upload_job = await db.get_feed_upload_job(feed_upload_id)
+            if feed_upload_job is not None and feed_upload_job.status == FeedUploadStatus.PROCESSING:
+                raise FeedUploadInProgressException(feed_upload_id)
+            logger.info(f"Feed upload {feed_upload_id} already finished, skipping")
+            return
 
-        # parse xml and save images
-        feed_items = await download_images_for_whole_feed(
-            feed_upload_id,
-            xml_string,
-            images_dir,
-        )
+        if should_profile(profile):
+            feed_profile = FeedProfile(feed_upload_id)
+            feed_profile.start()
 
-        # save feed items + update the associated upload job
-        await db.save_feed_items(feed_items)
+        started = time.perf_counter()
+        with FEED_UPLOADS_IN_PROGRESS.track_inprogress():
+            # parse xml, save images (of changed items only, if it is a keyed upload) and save feed items
+            # and index of their images + update the associated upload job, stages run overlapped
+            await run_feed_pipeline(feed_upload_id, feed, images_dir, db, profile=feed_profile)
+        STAGE_DURATION.labels("total").observe(time.perf_counter() - started)
+        FEED_UPLOADS.labels(FeedUploadStatus.FINISHED.name).inc()
     except FeedParsingException as e:
+        FEED_UPLOADS.labels(FeedUploadStatus.FINISHED_ERROR.name).inc()
         await db.update_feed_upload_job(
             feed_upload_id,
             status=FeedUploadStatus.FINISHED_ERROR,
@@ -45,7 +196,11 @@ async def process_feeds(feed_upload_id: int, xml_string: str, images_dir: str, l
         )
         cleanup_images_dir(images_dir, feed_upload_id)
         logger.warning(f"FeedParsingException has occured - {str(e)}")
+    except FeedUploadInProgressException:
+        # the job belongs to the other consumer, its status must not be touched
+        raise
     except Exception as e:
+        FEED_UPLOADS.labels(FeedUploadStatus.FINISHED_ERROR.name).inc()
         await db.update_feed_upload_job(
             feed_upload_id,
             status=FeedUploadStatus.FINISHED_ERROR,
@@ -55,128 +210,703 @@ async def process_feeds(feed_upload_id: int, xml_string: str, images_dir: str, l
         logger.warning(
             f"Non xml-processing exception has occured: {str(e)}"
         )
+    finally:
+        if feed_profile is not None:
+            await save_feed_profile(feed_profile, db)
 
-def parse_xml_to_feed_items(msg_xml: str) -> list[FeedItem]:
-    try:
-        xml_as_dict = xmltodict.parse(msg_xml)
-    except ExpatError:
-        raise FeedParsingException("Unable to parse XML structure")
 
+async def save_feed_profile(feed_profile: FeedProfile, db: DBClient):
+    feed_profile.stop()
     try:
-        items = xml_as_dict["rss"]["channel"]["item"]
-    except (KeyError, TypeError):
-        raise FeedParsingException("Missing 'rss.channel.item' structure in XML")
+        await db.save_feed_upload_profile(feed_profile.feed_upload_id, feed_profile.to_dict())
+        logger.info(
+            f"Saved profile of feed upload {feed_profile.feed_upload_id} ({feed_profile.profiler.samples} samples)"
+        )
+    except Exception as e:
+        # profile is only a diagnostic, it must not fail the upload
+        logger.warning(f"Saving profile of feed upload {feed_profile.feed_upload_id} failed: {str(e)}")
 
-    # adjust possible dict to list, or single g:additional_image_link to list
-    if isinstance(items, dict):
-        items = [items]
-    for item in items:
-        try:
-            additional_image_link = item["g:additional_image_link"]
-            if isinstance(additional_image_link, str):
-                item["g:additional_image_link"] = [additional_image_link]
-        except KeyError:
-            # no need to do anything
-            continue
 
+class _FeedItemsHandler:
+    """
+    Expat handlers which build one rss.channel.item at a time into the same dict
+    shape xmltodict would produce (prefixed keys like "g:id", repeated elements as
+    lists, attributes as "@name" and mixed text as "#text").
+    """
+
+    def __init__(self):
+        self.path: list[str] = []
+        self.stack: list[tuple[dict, list[str]]] = []
+        self.items: deque[dict] = deque()
+        self.items_seen = 0
+
+    def start_element(self, name: str, attrs: dict[str, str]):
+        self.path.append(name)
+        if self.stack or self.path == FEED_ITEM_PATH:
+            self.stack.append(({f"@{key}": value for key, value in attrs.items()}, []))
+
+    def end_element(self, name: str):
+        self.path.pop()
+        if not self.stack:
+            return
+
+        node, text = self.stack.pop()
+        data = "".join(text).strip()
+        if node:
+            if data:
+                node["#text"] = data
+            value = node
+        else:
+            value = data or None
+
+        if not self.stack:
+            self.items_seen += 1
+            self.items.append(value if isinstance(value, dict) else {})
+            return
+
+        parent = self.stack[-1][0]
+        if name not in parent:
+            parent[name] = value
+        elif isinstance(parent[name], list):
+            parent[name].append(value)
+        else:
+            parent[name] = [parent[name], value]
+
+    def character_data(self, data: str):
+        if self.stack:
+            self.stack[-1][1].append(data)
+
+
+def _iter_xml_chunks(xml: str | bytes | BinaryIO, chunk_size: int):
+    if isinstance(xml, (str, bytes)):
+        for i in range(0, len(xml), chunk_size):
+            yield xml[i : i + chunk_size]
+        return
+
+    while chunk := xml.read(chunk_size):
+        yield chunk
+
+
+def _normalize_item(item: dict) -> dict:
+    # single g:additional_image_link is parsed as a string, adjust it to list
+    additional_image_link = item.get("g:additional_image_link")
+    if isinstance(additional_image_link, str):
+        item["g:additional_image_link"] = [additional_image_link]
+    return item
+
+
+def _to_feed_item(item: dict) -> FeedItem:
     try:
-        return [FeedItem(**item) for item in items]
+        return FeedItem(**item)
     except ValidationError as ve:
         raise FeedParsingException(json.dumps(ve.errors()[0]))
 
 
-async def download_images(
-    feed_items: list[FeedItemWithUploadReference], base_dir: str
-) -> dict[str, tuple[str, list[str]]]:  # horrible output struct :/
+def _iter_parsed_items(xml: str | bytes | BinaryIO, chunk_size: int = XML_CHUNK_SIZE) -> Iterator[dict]:
+    """
+    :return: iterator of not yet validated items (dicts in xmltodict shape) in the order of their appearance in the feed
+    """
+    handler = _FeedItemsHandler()
+    parser = ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start_element
+    parser.EndElementHandler = handler.end_element
+    parser.CharacterDataHandler = handler.character_data
+
+    chunks = _iter_xml_chunks(xml, chunk_size)
+    while True:
+        chunk = next(chunks, None)
+        try:
+            if chunk is None:
+                parser.Parse(b"", True)
+            else:
+                parser.Parse(chunk, False)
+        except ExpatError:
+            raise FeedParsingException("Unable to parse XML structure")
+
+        while handler.items:
+            yield _normalize_item(handler.items.popleft())
+
+        if chunk is None:
+            break
+
+    if handler.items_seen == 0:
+        raise FeedParsingException("Missing 'rss.channel.item' structure in XML")
+
+
+def iter_feed_items(
+    xml: str | bytes | BinaryIO, chunk_size: int = XML_CHUNK_SIZE
+) -> Iterator[FeedItem]:
     """
-    Method iterates over all feed items, and saves image references into the feed upload id dir.
+    Method incrementally parses provided xml and yields validated feed items one <item> at a time,
+    so only the currently read chunk and the item being built are held in memory
 
-    :feed_items: feed items to iterate
-    :param base_dir: directory should contain feed upload directory by its' id and associated images
-    :return: dict where key represents feed_item.feed_item_id and the value represents tuple of image_link and list of additional_image_link with new image IDs
+    :param xml: whole xml as str/bytes or binary file-like object which will be read in chunks
+    :param chunk_size: number of characters/bytes fed to the parser at once
+    :return: iterator of FeedItem in the order of their appearance in the feed
     """
-    if len(feed_items) == 0:
-        return {}
+    for item in _iter_parsed_items(xml, chunk_size):
+        yield _to_feed_item(item)
 
-    images_dir = Path(base_dir) / str(feed_items[0].feed_upload_id)
-    images_dir.mkdir(parents=True, exist_ok=True)
-    output_dict = {}
 
-    for feed_item in feed_items:
-        image_link = None
-        additional_image_link = None
+def parse_xml_to_feed_items(msg_xml: str | bytes | BinaryIO) -> list[FeedItem]:
+    return list(iter_feed_items(msg_xml))
 
-        if feed_item.image_link:
-            image_link = feed_item.image_link
-        if feed_item.additional_image_link:
-            additional_image_link = feed_item.additional_image_link
-        output_dict[feed_item.feed_item_id] = (image_link, additional_image_link)
 
-    async with aiohttp.ClientSession() as session:
-        for feed_item_id, tpl in output_dict.items():
-            new_image_link = None
-            new_additional_image_link = None
-            if tpl[0] is not None:
-                new_image_link = await download_image(session, tpl[0], images_dir)
-            if tpl[1] is not None:
-                new_additional_image_link = [
-                    await download_image(session, url, images_dir) for url in tpl[1]
-                ]
+def get_parsing_executor() -> Optional[ProcessPoolExecutor]:
+    """
+    :return: lazily created process pool of PARSING_PROCESSES size shared by all feeds of the process, None if disabled
+    """
+    global _parsing_executor
+    if PARSING_PROCESSES <= 0:
+        return None
+    if _parsing_executor is None:
+        # spawn - forking process with running event loop (and dramatiq worker threads) is not safe
+        _parsing_executor = ProcessPoolExecutor(
+            PARSING_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _parsing_executor
 
-            # update output_dict
-            output_dict[feed_item_id] = (new_image_link, new_additional_image_link)
 
-    return output_dict
+def shutdown_parsing_executor():
+    global _parsing_executor
+    if _parsing_executor is not None:
+        _parsing_executor.shutdown()
+        _parsing_executor = None
 
 
-async def download_image(session: aiohttp.ClientSession, url: str, images_dir: Path):
-    async with session.get(url) as resp:
-        if resp.status == 200:
-            ext = Path(url).suffix
-            new_image_id = uuid4().hex
-            filename = f"{new_image_id}{ext}"
-            file_path = Path(images_dir / filename)
+# control characters can not occur in XML 1.0 text (not even as character references), so separated values
+# of a row are encoded unambiguously - unlike JSON encoding of the row, it costs about a join
+_HASH_VALUE_SEPARATOR = "\x00"
+_HASH_LIST_TERMINATOR = "\x01"
+_HASH_NONE = "\x02"
 
-            async with aiofiles.open(file_path, "wb") as f:
-                content = await resp.read()
-                await f.write(content)
 
+def content_hash(row: Sequence) -> bytes:
+    """
+    :param row: values of FeedItem.db_columns() - strings, lists of strings or None
+    """
+    values = []
+    for value in row:
+        if value is None:
+            values.append(_HASH_NONE)
+        elif type(value) is list:
+            values.append("".join(item + _HASH_LIST_TERMINATOR for item in value))
         else:
-            raise FeedParsingException(f"Unable to download image from: {url}")
-        return new_image_id
+            values.append(value)
+    return hashlib.blake2b(_HASH_VALUE_SEPARATOR.join(values).encode(), digest_size=16).digest()
 
 
-async def download_images_for_whole_feed(
-    feed_upload_id: int, xml_to_parse: str, base_dir: str
-) -> list[FeedItemWithUploadReference]:
+def stream_feed_rows(
+    feed: FeedSource, pipe: Connection, batch_size: int, profile_interval: Optional[float] = None
+) -> Optional[dict[str, int]]:
     """
-    Method parses provided xml string and feed items' associated images
+    Method runs in parsing process - parses and validates the feed and writes batches of its rows into the pipe
+    as they are parsed (each pickled batch prefixed by its length), empty batch marks the end of the feed.
+    Writes block while the consumer of the pipe does not keep up, so only a few batches are held at once.
 
-    :param feed_upload_id: feed upload id which will be referenced by every feed_item
-    :param xml_to_parse: xml as string which will be parsed
-    :base_dir: directory which will store downloaded images in {feed_upload_id} dir
+    :param pipe: write end of the pipe read by iter_feed_batches
+    :param profile_interval: parsing is sampled by SamplingProfiler within the parsing process if provided
+    :return: sampled stacks if profile_interval is provided
+    """
+    with ExitStack() as stack:
+        stack.callback(pipe.close)
+        profiler = None
+        if profile_interval is not None:
+            profiler = stack.enter_context(SamplingProfiler(profile_interval))
+        out = stack.enter_context(open(pipe.fileno(), "wb", closefd=False))
+        rows = iter_feed_rows(stack.enter_context(feed() if callable(feed) else nullcontext(feed)))
+        while True:
+            batch = list(islice(rows, batch_size))
+            data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+            out.write(_BATCH_HEADER.pack(len(data)))
+            out.write(data)
+            out.flush()
+            if not batch:
+                break
+    return dict(profiler.stacks) if profiler is not None else None
+
+
+async def _read_batch(stream: asyncio.StreamReader) -> list[list]:
+    (size,) = _BATCH_HEADER.unpack(await stream.readexactly(_BATCH_HEADER.size))
+    return pickle.loads(await stream.readexactly(size))
+
+
+def validate_feed_rows(items: list[dict], offset: int = 0) -> Iterator[list]:
+    """
+    Method validates batch of parsed items by single FEED_ITEM_ROWS_ADAPTER call and builds rows of them directly,
+    without FeedItem models - rows are all the pipeline needs. Row is a list of FEED_ITEM_ROW_COLUMNS values
+    (FeedItem.db_columns() in their order followed by content hash of these values), which is cheap to send back
+    from parsing process compared to pickled model and is written into db as it is
 
-    :return: list of FeedItemWithUploadReference ready to save
+    :param offset: index of the first item of the batch in the feed, reported in location of validation error
+    :return: iterator of rows in the order of the items
     """
-    feed_items = [
-        FeedItemWithUploadReference.model_construct(
-            feed_upload_id=feed_upload_id, **dict(item)
+    try:
+        validated = FEED_ITEM_ROWS_ADAPTER.validate_python(items)
+    except ValidationError as ve:
+        error = ve.errors()[0]
+        index, *loc = error["loc"]
+        raise FeedParsingException(json.dumps({**error, "loc": [offset + index, *loc]}))
+
+    columns = FeedItem.db_columns()
+    for item in validated:
+        row = list(map(item.get, columns))
+        row.append(content_hash(row))
+        yield row
+
+
+def iter_feed_rows(xml: str | bytes | BinaryIO, batch_size: int = VALIDATION_BATCH_SIZE) -> Iterator[list]:
+    items = _iter_parsed_items(xml)
+    offset = 0
+    while batch := list(islice(items, batch_size)):
+        yield from validate_feed_rows(batch, offset)
+        offset += len(batch)
+
+
+async def iter_feed_batches(
+    feed: FeedSource,
+    executor: Optional[Executor] = None,
+    batch_size: int = VALIDATION_BATCH_SIZE,
+    profile: Optional[FeedProfile] = None,
+) -> AsyncIterator[list[list]]:
+    """
+    Method parses and validates feed in provided executor, so CPU-bound parsing of a big feed does not stall
+    other coroutines - image downloads of other feeds, broker heartbeats etc. Parsing process streams the batches
+    back through a pipe as they are parsed (see stream_feed_rows), so they flow into the pipeline while the rest
+    of the feed is still being parsed, and the parsing process waits while the pipeline does not keep up. Without
+    executor the feed is parsed on the event loop and every batch is handed over as soon as it is parsed.
+
+    :param profile: profile of the feed upload, parsing process samples itself and its stacks are merged into the profile
+    :return: async iterator of feed item row batches (see validate_feed_rows) in the order of their appearance in the feed
+    """
+    if executor is None:
+        with (feed() if callable(feed) else nullcontext(feed)) as xml:
+            rows = iter_feed_rows(xml)
+            while batch := list(islice(rows, batch_size)):
+                yield batch
+                await asyncio.sleep(0)
+        return
+
+    loop = asyncio.get_running_loop()
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    stream = asyncio.StreamReader()
+    try:
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stream), open(os.dup(reader.fileno()), "rb", buffering=0)
         )
-        for item in parse_xml_to_feed_items(xml_to_parse)
-    ]
-    new_image_ids = await download_images(feed_items, base_dir)
-    for feed_item in feed_items:
-        try:
-            image_ids = new_image_ids[feed_item.feed_item_id]
-            feed_item.image_link = image_ids[0]
-            feed_item.additional_image_link = image_ids[1]
-        except KeyError:
-            pass
+    finally:
+        reader.close()
+
+    interval = profile.profiler.interval if profile is not None else None
+    future = loop.run_in_executor(executor, stream_feed_rows, feed, writer, batch_size, interval)
+    read = None
+    try:
+        while True:
+            read = asyncio.ensure_future(_read_batch(stream))
+            await asyncio.wait((read, future), return_when=asyncio.FIRST_COMPLETED)
+            if future.done() and future.exception() is not None:
+                # parsing failed - no more batches will come (write end held here never reaches EOF)
+                await future
+            batch = await read
+            if not batch:
+                break
+            yield batch
+
+        stacks = await future
+        if profile is not None:
+            profile.add_stacks(stacks, "parsing-process")
+    except BrokenProcessPool:
+        # e.g. parsing process was killed by OOM killer, following feeds get a new pool
+        if executor is _parsing_executor:
+            shutdown_parsing_executor()
+        raise
+    finally:
+        if read is not None:
+            read.cancel()
+        # closed read end makes blocked parsing process fail with BrokenPipeError instead of waiting forever
+        future.cancel()
+        transport.close()
+        writer.close()
+
+
+async def store_images(
+    urls: list[str],
+    feed_upload_id: int,
+    base_dir: str,
+    max_concurrency: int = IMAGE_DOWNLOAD_CONCURRENCY,
+    max_per_host: int = IMAGE_DOWNLOAD_PER_HOST,
+    cache_ttl: float = IMAGE_CACHE_TTL,
+    stored_images: Optional[dict[str, FeedImage]] = None,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> tuple[dict[str, str], list[FeedImage]]:
+    """
+    Method concurrently downloads provided image urls, and references them from the feed upload id dir.
+    Every distinct url is downloaded only once, urls already known to the image store are reused while fresh
+    and revalidated by conditional request otherwise.
+    If any of the downloads fails, the remaining ones are cancelled and the exception is re-raised.
+
+    :param stored_images: images by url already stored for the feed upload (e.g. by previous batch), they are
+        not requested again, the dict is updated with newly stored images
+    :param session: session (and its connection limits) shared by multiple calls, max_concurrency and
+        max_per_host are ignored if provided
+    :return: tuple of image ids by url and distinct images newly stored for the feed
+    """
+    store = ImageStore(base_dir, ttl=cache_ttl)
+    store.feed_dir(feed_upload_id).mkdir(parents=True, exist_ok=True)
+
+    stored_images = {} if stored_images is None else stored_images
+    unique_urls = [url for url in dict.fromkeys(urls) if url not in stored_images]
+    feed_images = []
+    if unique_urls:
+        async with AsyncExitStack() as stack:
+            if session is None:
+                connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_per_host)
+                session = await stack.enter_async_context(aiohttp.ClientSession(connector=connector))
+            images = await gather_or_cancel(
+                *(download_image(session, url, store, feed_upload_id) for url in unique_urls)
+            )
+        feed_images = list({image.image_id: image for image in images}.values())
+        stored_images.update(zip(unique_urls, images))
+        logger.info(f"Image cache stats for feed upload {feed_upload_id}: {store.stats}")
+        observe_image_stats(store.stats)
+        await evict_image_cache(store)
+    return {url: stored_images[url].image_id for url in urls}, feed_images
+
+
+def observe_image_stats(stats: dict[str, int]):
+    FEED_IMAGES.labels("downloaded").inc(stats["misses"])
+    FEED_IMAGES.labels("revalidated").inc(stats["revalidated"])
+    FEED_IMAGES.labels("cached").inc(stats["hits"])
+    IMAGE_BYTES.labels("downloaded").inc(stats["bytes_downloaded"])
+    IMAGE_BYTES.labels("saved").inc(stats["bytes_saved"])
+
+
+async def gather_or_cancel(*coros):
+    """
+    Same as asyncio.gather, but the first raised exception cancels all the other still running tasks
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def download_image(
+    session: aiohttp.ClientSession,
+    url: str,
+    store: ImageStore,
+    feed_upload_id: int,
+    use_cache: bool = True,
+) -> FeedImage:
+    """
+    Method references image from provided url in the feed upload dir. Fresh cached image is used as is,
+    stale one is revalidated with conditional request and downloaded again only if it has changed.
+
+    :return: stored image with its new image id
+    """
+    entry = await store.lookup(url) if use_cache else None
+    try:
+        if entry is not None and store.is_fresh(entry):
+            image = store.link(entry, feed_upload_id)
+            store.record_hit(entry)
+            return image
+
+        headers = store.conditional_headers(entry) if entry is not None else {}
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304 and entry is not None:
+                image = store.link(entry, feed_upload_id)
+                await store.revalidate(entry)
+                return image
+            if resp.status != 200:
+                raise FeedParsingException(f"Unable to download image from: {url}")
+            check_image_response(url, resp)
+            entry = await store.save(
+                url,
+                iter_image_chunks(url, resp),
+                Path(url).suffix,
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+                resp.content_type,
+            )
+    except FileNotFoundError:
+        # cached blob was removed in the meantime, download it again
+        return await download_image(session, url, store, feed_upload_id, use_cache=False)
+
+    return store.link(entry, feed_upload_id)
+
+
+def check_image_response(url: str, resp: aiohttp.ClientResponse):
+    """
+    Method rejects image before its body is read, if it is not an allowed image type or it is declared too big
+    """
+    if resp.content_type not in IMAGE_ALLOWED_CONTENT_TYPES:
+        raise FeedParsingException(
+            f"Unsupported content type {resp.content_type} of image: {url}"
+        )
+    if resp.content_length is not None and resp.content_length > IMAGE_MAX_BYTES:
+        raise FeedParsingException(
+            f"Image exceeds {IMAGE_MAX_BYTES} bytes limit: {url}"
+        )
+
+
+async def iter_image_chunks(url: str, resp: aiohttp.ClientResponse):
+    size = 0
+    async for chunk in resp.content.iter_chunked(IMAGE_CHUNK_SIZE):
+        size += len(chunk)
+        if size > IMAGE_MAX_BYTES:  # content-length may be missing or wrong
+            raise FeedParsingException(
+                f"Image exceeds {IMAGE_MAX_BYTES} bytes limit: {url}"
+            )
+        yield chunk
+
+
+async def evict_image_cache(store: ImageStore):
+    global _last_cache_eviction
+
+    if IMAGE_CACHE_MAX_BYTES <= 0:
+        return
+    if time.monotonic() - _last_cache_eviction < IMAGE_CACHE_EVICTION_INTERVAL:
+        return
+    _last_cache_eviction = time.monotonic()
+    await asyncio.to_thread(store.evict, IMAGE_CACHE_MAX_BYTES)
+
+
+async def run_feed_pipeline(
+    feed_upload_id: int,
+    feed: FeedSource,
+    base_dir: str,
+    db: DBClient,
+    batch_size: int = PIPELINE_BATCH_SIZE,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+    profile: Optional[FeedProfile] = None,
+):
+    """
+    Method parses provided xml (in parsing process pool), downloads feed items' associated images and saves
+    the items as a pipeline of stages connected by bounded queues, so images of a batch are downloaded while
+    the previous batch is written and the next one is parsed.
+    Unchanged items of keyed upload are carried over from the previous upload of the same feed key within
+    the db together with their images, so only added and changed items are downloaded and sent to the db.
+
+    All batches are written within single transaction which commits together with finishing the feed upload,
+    so nothing is visible if any of the stages fails - the exception cancels the other stages and is re-raised.
+
+    :param feed_upload_id: feed upload id which will be referenced by every feed_item
+    :param feed: xml as string, bytes or callable opening it as binary file which will be parsed
+    :param base_dir: directory which will store downloaded images in {feed_upload_id} dir
+    :param batch_size: number of feed items flowing through the stages at once
+    :param queue_size: max number of batches waiting for the next stage
+    :param profile: profile of the feed upload, every batch of every stage is recorded into its timeline
+    """
+    store = ImageStore(base_dir)
+    diff = await FeedItemsDiff.for_upload(feed_upload_id, db, store)
+    # batches of feed item rows (see validate_feed_rows), downloaded ones together with their images to be indexed
+    # and ids of the unchanged items to be carried over
+    parsed: asyncio.Queue[Optional[list[list]]] = asyncio.Queue(queue_size)
+    downloaded: asyncio.Queue[Optional[tuple[list[list], list[FeedImage], list[str]]]] = asyncio.Queue(queue_size)
+    # busy time of every stage, waiting for the neighbouring stages is not included
+    stage_seconds = {"parse": 0.0, "download": 0.0, "insert": 0.0}
+    if profile is not None:
+        profile.stage_seconds = stage_seconds
+
+    def account(stage: str, started: float, items: int):
+        ended = time.perf_counter()
+        stage_seconds[stage] += ended - started
+        if profile is not None:
+            profile.record(stage, started, ended, items)
+
+    async def parse_stage():
+        batches = iter_feed_batches(feed, get_parsing_executor(), batch_size, profile)
+        async with aclosing(batches):
+            while True:
+                started = time.perf_counter()
+                batch = await anext(batches, None)
+                account("parse", started, len(batch) if batch is not None else 0)
+                if batch is None:
+                    break
+                await parsed.put(batch)
+        await parsed.put(None)
+
+    async def download_stage():
+        stored_images: dict[str, FeedImage] = {}
+        connector = aiohttp.TCPConnector(limit=IMAGE_DOWNLOAD_CONCURRENCY, limit_per_host=IMAGE_DOWNLOAD_PER_HOST)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while (rows := await parsed.get()) is not None:
+                started = time.perf_counter()
+                to_download, carried_ids, feed_images = rows, [], []
+                if diff is not None:
+                    to_download, carried_ids, feed_images = await diff.carry_over(rows)
+                    FEED_IMAGES.labels("carried_over").inc(len(feed_images))
+
+                urls = []
+                for row in to_download:
+                    if row[ROW_IMAGE_LINK]:
+                        urls.append(row[ROW_IMAGE_LINK])
+                    urls.extend(row[ROW_ADDITIONAL_IMAGE_LINK] or [])
+                new_images = []
+                if urls:
+                    image_ids, new_images = await store_images(
+                        urls, feed_upload_id, base_dir, stored_images=stored_images, session=session
+                    )
+                    # image links of the rows are replaced by ids of the stored images
+                    for row in to_download:
+                        if row[ROW_IMAGE_LINK]:
+                            row[ROW_IMAGE_LINK] = image_ids[row[ROW_IMAGE_LINK]]
+                        if row[ROW_ADDITIONAL_IMAGE_LINK]:
+                            row[ROW_ADDITIONAL_IMAGE_LINK] = [image_ids[url] for url in row[ROW_ADDITIONAL_IMAGE_LINK]]
+                account("download", started, len(rows))
+                await downloaded.put((to_download, [*feed_images, *new_images], carried_ids))
+        await downloaded.put(None)
+
+    async def write_stage():
+        # connection is not held while the first batch is being parsed and downloaded,
+        # unless the diff looks up previous items through it
+        looks_up = diff is not None and diff.previous_id is not None
+        batch = await downloaded.get() if not looks_up else None
+        started = time.perf_counter()
+        async with db.feed_items_writer(feed_upload_id) as writer:
+            if looks_up:
+                diff.writer.set_result(writer)
+                batch = await downloaded.get()
+                started = time.perf_counter()
+            while batch is not None:
+                rows, feed_images, carried_ids = batch
+                await writer.write(rows, feed_images)
+                if carried_ids:
+                    await writer.carry_over(diff.previous_id, carried_ids)
+                account("insert", started, len(rows) + len(carried_ids))
+                batch = await downloaded.get()
+                started = time.perf_counter()
+
+            delta = await diff.delta() if diff is not None else None
+            if delta is not None:
+                logger.info(f"Feed upload {feed_upload_id} of {diff.feed_key} feed key: {delta}")
+            logger.info(f"Feed upload {feed_upload_id} stage seconds: {stage_seconds}")
+            await writer.finish(delta, stage_seconds=stage_seconds)
+
+        for stage, seconds in stage_seconds.items():
+            STAGE_DURATION.labels(stage).observe(seconds)
+        FEED_ITEMS.inc(writer.items_written)
+
+    await gather_or_cancel(parse_stage(), download_stage(), write_stage())
+
+
+class FeedItemsDiff:
+    """
+    Diffs batches of keyed upload's feed items against the items of previous upload of the same feed key
+    by feed_item_id and content_hash. Unchanged items are copied from the previous upload within the db
+    (see FeedItemsWriter.carry_over) and their images are linked into the feed upload dir, items whose
+    previous images are gone are downloaded again.
+
+    Previous items and images are looked up batch by batch through the connection of the upload's writer,
+    so they are never held in memory all at once and the diff never waits for a pool connection while
+    the writer of the same upload holds one.
+    """
+
+    def __init__(self, feed_upload_id: int, feed_key: str, previous_id: Optional[int], store: ImageStore):
+        self.feed_upload_id = feed_upload_id
+        self.feed_key = feed_key
+        self.previous_id = previous_id
+        self.store = store
+        # writer of the feed upload, set by its write stage once it is open
+        self.writer: asyncio.Future[FeedItemsWriter] = asyncio.get_running_loop().create_future()
+        self.added = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    @classmethod
+    async def for_upload(cls, feed_upload_id: int, db: DBClient, store: ImageStore) -> Optional["FeedItemsDiff"]:
+        """
+        :return: diff against previous upload of the same feed key (every item is added if there is none),
+            None if the upload is not keyed
+        """
+        previous = await db.get_previous_feed_upload(feed_upload_id)
+        if previous is None or previous["feed_key"] is None:
+            return None
+        return cls(feed_upload_id, previous["feed_key"], previous["previous_id"], store)
+
+    async def carry_over(self, rows: list[list]) -> tuple[list[list], list[str], list[FeedImage]]:
+        """
+        :param rows: batch of feed item rows (see validate_feed_rows)
+        :return: tuple of rows whose images have to be downloaded, ids of unchanged items to be carried over
+            and their images
+        """
+        if self.previous_id is None:
+            self.added += len(rows)
+            return rows, [], []
+
+        writer = await self.writer
+        previous_items = await writer.get_previous_items(self.previous_id, [row[ROW_FEED_ITEM_ID] for row in rows])
+        to_download = []
+        unchanged = {}
+        for row in rows:
+            previous_item = previous_items.get(row[ROW_FEED_ITEM_ID])
+            if previous_item is None:
+                self.added += 1
+                to_download.append(row)
+            elif previous_item["content_hash"] != row[ROW_CONTENT_HASH]:
+                self.changed += 1
+                to_download.append(row)
+            else:
+                self.unchanged += 1
+                if row[ROW_FEED_ITEM_ID] in unchanged:
+                    # the previous item is copied once per batch, its duplicate is written as it is
+                    to_download.append(row)
+                else:
+                    unchanged[row[ROW_FEED_ITEM_ID]] = (row, previous_item)
+        if not unchanged:
+            return to_download, [], []
+
+        image_ids = {
+            image_id
+            for _, previous_item in unchanged.values()
+            for image_id in [previous_item["image_link"], *(previous_item["additional_image_link"] or [])]
+            if image_id
+        }
+        previous_images = await writer.get_previous_images(self.previous_id, list(image_ids))
+
+        def link_previous_images() -> tuple[list[str], dict[str, FeedImage]]:
+            carried_ids = []
+            carried_images = {}
+            for feed_item_id, (row, previous_item) in unchanged.items():
+                item_image_ids = [previous_item["image_link"], *(previous_item["additional_image_link"] or [])]
+                try:
+                    for image_id in filter(None, item_image_ids):
+                        if image_id not in carried_images:
+                            image = previous_images[image_id]
+                            carried_images[image_id] = self.store.link_blob(
+                                Path(image.path).name, self.feed_upload_id, image.content_type, image.size
+                            )
+                except (KeyError, FileNotFoundError):
+                    # image of previous upload is gone (or was never indexed), download it again
+                    to_download.append(row)
+                    continue
+                carried_ids.append(feed_item_id)
+            return carried_ids, carried_images
+
+        carried_ids, carried_images = await asyncio.to_thread(link_previous_images)
+        return to_download, carried_ids, list(carried_images.values())
 
-    return feed_items
+    async def delta(self) -> dict[str, int]:
+        """
+        :return: items_added/changed/removed/unchanged counts of the items diffed so far, removed items are
+            counted against the items written by the writer
+        """
+        removed = 0
+        if self.previous_id is not None:
+            writer = await self.writer
+            removed = await writer.count_removed(self.previous_id)
+        return {
+            "items_added": self.added,
+            "items_changed": self.changed,
+            "items_removed": removed,
+            "items_unchanged": self.unchanged,
+        }
 
 
 def cleanup_images_dir(images_dir, feed_upload_id):
-    dir_to_delete = Path(images_dir) / str(feed_upload_id)
-    if dir_to_delete.exists():
-        shutil.rmtree(dir_to_delete)
+    ImageStore(images_dir).remove_feed(feed_upload_id)
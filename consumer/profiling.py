@@ -0,0 +1,132 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+# share of feed uploads profiled even without being requested by X-Profile header, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+# innermost frames of threads waiting for work, their samples are folded into "<idle>"
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("connection.py", "wait"),
+}
+
+
+def should_profile(requested: bool = False) -> bool:
+    return requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+
+def fold_stack(frame, thread_name: str) -> str:
+    """
+    :return: stack in collapsed format (root first, frames separated by ";") used by flame graph tools
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append((os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    if frames and frames[0] in IDLE_FRAMES:
+        return f"{thread_name};<idle>"
+    return ";".join([thread_name, *(f"{filename}:{name}" for filename, name in reversed(frames))])
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler - daemon thread samples stacks of all the other threads of the process every interval
+    and counts them in collapsed format. Profiled code is not instrumented, so the overhead is only the sampling.
+
+    Note that coroutines of other feeds processed on the same event loop are sampled as well.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.stacks[fold_stack(frame, thread_names.get(ident, str(ident)))] += 1
+            self.samples += 1
+
+
+class FeedProfile:
+    """
+    Sampling profile and stage timeline of single feed upload processing
+    """
+
+    def __init__(self, feed_upload_id: int, interval: float = PROFILE_INTERVAL):
+        self.feed_upload_id = feed_upload_id
+        self.profiler = SamplingProfiler(interval)
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.timeline: list[dict] = []
+        self.stage_seconds: dict[str, float] = {}
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+        self.duration = time.perf_counter() - self.started
+
+    def record(self, stage: str, started: float, ended: float, items: int):
+        """
+        Adds one batch of the stage into the timeline, times are time.perf_counter() values
+        """
+        self.timeline.append(
+            {
+                "stage": stage,
+                "start": round(started - self.started, 6),
+                "end": round(ended - self.started, 6),
+                "items": items,
+            }
+        )
+
+    def add_stacks(self, stacks: dict[str, int], prefix: str):
+        """
+        Merges stacks sampled elsewhere (e.g. in parsing process) under provided root frame
+        """
+        for stack, count in stacks.items():
+            self.profiler.stacks[f"{prefix};{stack}"] += count
+
+    def to_dict(self) -> dict:
+        return {
+            "feed_upload_id": self.feed_upload_id,
+            "interval_seconds": self.profiler.interval,
+            "samples": self.profiler.samples,
+            "duration_seconds": round(self.duration, 6) if self.duration is not None else None,
+            "stage_seconds": self.stage_seconds,
+            "timeline": self.timeline,
+            "stacks": dict(self.profiler.stacks.most_common()),
+        }
@@ -0,0 +1,160 @@
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from typing import Optional
+
+from clients.spool_store import SpoolStore
+from consumer import consumer, processing_utils
+from consumer.test_images import ImageServer
+from consumer.test_pipeline import StubDB, feed
+from models.FeedUpload import FeedUploadStatus
+
+
+class StubMessage:
+    """
+    Incoming message acknowledged when processed without exception, rejected (without requeue) otherwise
+    """
+
+    def __init__(self, headers: dict, body: bytes = b"", message_id: str = "message"):
+        self.headers = headers
+        self.body = body
+        self.message_id = message_id
+        self.content_encoding = None
+        self.acked = False
+        self.rejected = False
+
+    @asynccontextmanager
+    async def process(self):
+        try:
+            yield
+        except Exception:
+            self.rejected = True
+            raise
+        self.acked = True
+
+
+class StubQueue:
+    def __init__(self, events: list[str]):
+        self.events = events
+        self.callback = None
+
+    async def consume(self, callback):
+        self.callback = callback
+        return "consumer-tag"
+
+    async def cancel(self, consumer_tag):
+        self.events.append(f"cancel {consumer_tag}")
+
+
+class StubChannel:
+    def __init__(self):
+        self.prefetch_count = None
+
+    async def set_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+
+class StubRabbitMQClient:
+    """
+    Consuming client with fake channel and queue, deliveries are made by calling queue.callback
+    """
+
+    def __init__(self, events: Optional[list[str]] = None):
+        self.events = events if events is not None else []
+        self.retried: list[tuple[StubMessage, float]] = []
+        self.channel = StubChannel()
+        self.queue = StubQueue(self.events)
+
+    async def connect_for_consuming(self, prefetch_count=None):
+        await self.channel.set_qos(prefetch_count=prefetch_count)
+
+    def get_queue(self):
+        return self.queue
+
+    async def retry_later(self, message, delay):
+        self.retried.append((message, delay))
+
+    async def close(self):
+        self.events.append("rabbitmq closed")
+
+
+def test_redelivered_message_of_killed_consumer_reclaims_job_once_lease_expires(tmp_path, monkeypatch):
+    monkeypatch.setattr(processing_utils, "FEED_UPLOAD_CLAIM_LEASE", 0.2)
+    monkeypatch.setattr(consumer, "images_dir", str(tmp_path / "images"))
+
+    async def run():
+        db = StubDB(max_size=2)
+        rabbitmq_client = StubRabbitMQClient()
+        spool_store = SpoolStore(tmp_path / "spool")
+        async with ImageServer(delay=0) as server:
+
+            async def chunks():
+                yield feed(server.url, [("I0", "a")]).encode()
+
+            spool_ref = await spool_store.write(chunks())
+            feed_upload_id = db.create_upload()
+            # consumer which claimed the job was killed, broker redelivers its message right away
+            db.uploads[feed_upload_id].update(status=FeedUploadStatus.PROCESSING, claimed_at=time.monotonic())
+            redelivered = StubMessage({"feed_upload_id": feed_upload_id, "spool_ref": spool_ref})
+            await consumer.handle_message(redelivered, spool_store, db, rabbitmq_client)
+            status_within_lease = db.uploads[feed_upload_id]["status"]
+
+            await asyncio.sleep(0.3)
+            retried, _ = rabbitmq_client.retried[0]
+            await consumer.handle_message(retried, spool_store, db, rabbitmq_client)
+        return db, rabbitmq_client, redelivered, status_within_lease, spool_store.path(spool_ref)
+
+    db, rabbitmq_client, redelivered, status_within_lease, spool_path = asyncio.run(run())
+
+    # message within the lease was put aside for later, not dropped
+    assert redelivered.acked and not redelivered.rejected
+    assert [message for message, _ in rabbitmq_client.retried] == [redelivered]
+    assert status_within_lease == FeedUploadStatus.PROCESSING
+    # its retry claimed the abandoned job and processed it
+    assert db.uploads[1]["status"] == FeedUploadStatus.FINISHED
+    assert [item["feed_item_id"] for item in db.feed_items] == ["I0"]
+    assert not spool_path.exists()
+
+
+def test_stopping_consumer_finishes_in_flight_feeds_before_closing_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(consumer, "consumer_concurrency", 3)
+    events = []
+    finish = asyncio.Event()
+
+    async def handle_message(message, spool_store, db, rabbitmq_client):
+        events.append(f"started {message.message_id}")
+        await finish.wait()
+        events.append(f"finished {message.message_id}")
+
+    monkeypatch.setattr(consumer, "handle_message", handle_message)
+
+    class ClosingDB:
+        async def close(self):
+            events.append("db closed")
+
+    async def run():
+        rabbitmq_client = StubRabbitMQClient(events)
+        stopping = asyncio.Event()
+        consuming = asyncio.create_task(
+            consumer.consume(rabbitmq_client, ClosingDB(), SpoolStore(tmp_path), stopping)
+        )
+        while rabbitmq_client.queue.callback is None:
+            await asyncio.sleep(0.01)
+        for message_id in ("a", "b"):
+            await rabbitmq_client.queue.callback(StubMessage({}, message_id=message_id))
+        await asyncio.sleep(0.01)
+
+        # SIGTERM sets stopping
+        stopping.set()
+        await asyncio.sleep(0.05)
+        events_before_finish = list(events)
+        finish.set()
+        await asyncio.wait_for(consuming, 5)
+        return rabbitmq_client, events_before_finish
+
+    rabbitmq_client, events_before_finish = asyncio.run(run())
+
+    assert rabbitmq_client.channel.prefetch_count == 3
+    # deliveries were stopped right away, connections were held until in-flight feeds finished
+    assert events_before_finish == ["started a", "started b", "cancel consumer-tag"]
+    assert events[3:] == ["finished a", "finished b", "rabbitmq closed", "db closed"]
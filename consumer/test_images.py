@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from clients.image_store import ImageStore
+from consumer import processing_utils
+from consumer.processing_utils import FeedParsingException, cleanup_images_dir, store_images
+
+
+class ImageServer:
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.not_modified = 0
+
+    async def handle(self, request: web.Request):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        name = request.match_info["name"]
+        if name.startswith("missing"):
+            raise web.HTTPNotFound()
+        if name.startswith("page"):
+            return web.Response(text="<html></html>", content_type="text/html")
+        if name.startswith("big"):
+            response = web.StreamResponse(headers={"Content-Type": "image/png"})
+            await response.prepare(request)
+            for _ in range(64):
+                await response.write(b"x" * 1024)
+            return response
+        etag = f'"{name}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304)
+        return web.Response(body=name.encode(), content_type="image/jpeg", headers={"ETag": etag})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/images/{name}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/images"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def image_urls(url: str, names: list[str]) -> list[str]:
+    return [f"{url}/{name}" for name in names]
+
+
+def test_store_images_respects_per_host_limit_and_keeps_mapping(tmp_path):
+    async def run():
+        async with ImageServer() as server:
+            names = [name for i in range(10) for name in (f"{i}.jpg", f"{i}-a.jpg", f"{i}-b.jpg")]
+            urls = image_urls(server.url, names)
+            image_ids, _ = await store_images(urls, 1, str(tmp_path), max_per_host=4)
+            return server, urls, image_ids
+
+    server, urls, image_ids = asyncio.run(run())
+
+    assert server.requests == 30
+    assert server.max_in_flight <= 4
+    assert list(image_ids) == urls
+    assert [(tmp_path / "1" / f"{image_ids[url]}.jpg").read_bytes() for url in urls[9:12]] == [
+        b"3.jpg",
+        b"3-a.jpg",
+        b"3-b.jpg",
+    ]
+
+
+def test_store_images_fails_whole_feed_on_unavailable_image(tmp_path):
+    async def run():
+        async with ImageServer() as server:
+            urls = image_urls(server.url, [*(f"{i}.jpg" for i in range(5)), "missing.jpg"])
+            await store_images(urls, 1, str(tmp_path))
+
+    with pytest.raises(FeedParsingException, match="Unable to download image"):
+        asyncio.run(run())
+
+
+def test_store_images_stores_each_distinct_image_once(tmp_path):
+    async def run():
+        async with ImageServer() as server:
+            # the shared image is referenced by every item
+            names = [name for i in range(3) for name in ("mens-t-shirt-black-p.jpg", f"{i}.jpg")]
+            urls = image_urls(server.url, names)
+            first, first_images = await store_images(urls, 1, str(tmp_path))
+            requests_after_first_feed = server.requests
+
+            second, _ = await store_images(urls, 2, str(tmp_path))
+            return server, requests_after_first_feed, urls, first, second, first_images
+
+    server, requests_after_first_feed, urls, first, second, first_images = asyncio.run(run())
+
+    assert requests_after_first_feed == 4
+    assert server.requests == 4
+    assert first == second
+    image_id = first[urls[0]]
+    assert len(set(first.values())) == 4
+    assert len(first_images) == 4
+    assert {image.path for image in first_images if image.image_id == image_id} == {f"1/{image_id}.jpg"}
+    assert {image.content_type for image in first_images} == {"image/jpeg"}
+    shared_image = tmp_path / "1" / f"{image_id}.jpg"
+    assert shared_image.stat().st_ino == (tmp_path / "2" / f"{image_id}.jpg").stat().st_ino
+    assert len(list((tmp_path / "blobs").rglob("*.jpg"))) == 4
+
+    cleanup_images_dir(str(tmp_path), 1)
+    assert not (tmp_path / "1").exists()
+    assert len(list((tmp_path / "blobs").rglob("*.jpg"))) == 4
+
+    cleanup_images_dir(str(tmp_path), 2)
+    assert len(list((tmp_path / "blobs").rglob("*.jpg"))) == 0
+
+
+def test_store_images_revalidates_stale_images_with_conditional_requests(tmp_path):
+    async def run():
+        async with ImageServer() as server:
+            urls = image_urls(server.url, [f"{i}.jpg" for i in range(3)])
+            first, _ = await store_images(urls, 1, str(tmp_path), cache_ttl=0)
+            second, _ = await store_images(urls, 2, str(tmp_path), cache_ttl=0)
+            return server, urls, first, second
+
+    server, urls, first, second = asyncio.run(run())
+
+    assert server.requests == 6
+    assert server.not_modified == 3
+    assert first == second
+    assert (tmp_path / "2" / f"{second[urls[1]]}.jpg").read_bytes() == b"1.jpg"
+
+    # evicted entries keep blobs referenced by feeds
+    assert ImageStore(tmp_path).evict(max_bytes=0) == 3
+    assert len(list((tmp_path / "urls").rglob("*.json"))) == 0
+    assert len(list((tmp_path / "blobs").rglob("*.jpg"))) == 3
+
+
+@pytest.mark.parametrize(
+    "image_name, error",
+    [("page.jpg", "Unsupported content type text/html"), ("big.png", "exceeds 4096 bytes limit")],
+)
+def test_store_images_rejects_invalid_images_without_leaving_partial_files(
+    tmp_path, monkeypatch, image_name, error
+):
+    monkeypatch.setattr(processing_utils, "IMAGE_MAX_BYTES", 4096)
+
+    async def run():
+        async with ImageServer(delay=0) as server:
+            await store_images(image_urls(server.url, [image_name]), 1, str(tmp_path))
+
+    with pytest.raises(FeedParsingException, match=error):
+        asyncio.run(run())
+    assert list((tmp_path / "1").iterdir()) == []
+    assert not (tmp_path / "tmp").exists() or list((tmp_path / "tmp").iterdir()) == []
@@ -1,6 +1,22 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from functools import partial
+import gzip
+import multiprocessing
+
 import pytest
+import zstandard
 
-from consumer.processing_utils import parse_xml_to_feed_items, FeedParsingException
+from clients.spool_store import SpoolStore
+from consumer.processing_utils import (
+    content_hash,
+    iter_feed_batches,
+    iter_feed_items,
+    iter_feed_rows,
+    parse_xml_to_feed_items,
+    FeedParsingException,
+)
 from models.FeedItem import FeedItem
 
 def test_valid_xml_with_multiple_items():
@@ -79,3 +95,134 @@ def test_validation_error_raises_feed_parsing_exception():
     '''
     with pytest.raises(FeedParsingException):
         parse_xml_to_feed_items(xml)
+
+def test_batch_validation_reports_index_of_invalid_item_in_feed():
+    with open("feed_example.xml", "r", encoding="utf-8") as f:
+        xml = f.read()
+
+    # drop title of the last item, the item is in the second batch
+    last_title = xml.rindex("<title>")
+    xml = xml[:last_title] + xml[xml.index("</title>", last_title) + len("</title>") :]
+    with pytest.raises(FeedParsingException, match=r'"loc": \[2, "title"\]'):
+        list(iter_feed_rows(xml, batch_size=2))
+
+def test_streaming_parser_yields_same_items_for_chunked_binary_input():
+    with open("feed_example.xml", "rb") as f:
+        xml = f.read()
+
+    expected = parse_xml_to_feed_items(xml.decode("utf-8"))
+    with open("feed_example.xml", "rb") as f:
+        result = list(iter_feed_items(f, chunk_size=16))
+
+    assert result == expected
+    assert result[1].additional_image_link is None
+
+def test_streaming_parser_raises_on_truncated_xml_after_valid_items():
+    with open("feed_example.xml", "r", encoding="utf-8") as f:
+        xml = f.read()
+
+    truncated_xml = xml[: xml.index("</item>") + len("</item>")]
+    items = iter_feed_items(truncated_xml)
+    assert next(items).feed_item_id == "M0296"
+    with pytest.raises(FeedParsingException, match="Unable to parse XML structure"):
+        list(items)
+
+def test_spooled_feed_is_streamed_back_to_the_parser(tmp_path):
+    async def chunks():
+        with open("feed_example.xml", "rb") as f:
+            while chunk := f.read(100):
+                yield chunk
+
+    spool_store = SpoolStore(tmp_path)
+    spool_ref = asyncio.run(spool_store.write(chunks()))
+    assert [path.name for path in tmp_path.iterdir()] == [spool_ref]
+
+    with open("feed_example.xml", "r", encoding="utf-8") as f:
+        expected = parse_xml_to_feed_items(f.read())
+    with spool_store.open(spool_ref) as feed:
+        assert list(iter_feed_items(feed, chunk_size=16)) == expected
+
+    spool_store.delete(spool_ref)
+    assert not any(tmp_path.iterdir())
+
+@pytest.mark.parametrize(
+    "content_encoding, compress",
+    [
+        ("identity", lambda data: data),
+        ("gzip", gzip.compress),
+        ("zstd", lambda data: zstandard.ZstdCompressor().compress(data)),
+    ],
+)
+def test_compressed_spooled_feed_is_decompressed_while_parsing(tmp_path, content_encoding, compress):
+    with open("feed_example.xml", "rb") as f:
+        xml = f.read()
+
+    async def chunks():
+        yield compress(xml)
+
+    spool_store = SpoolStore(tmp_path)
+    spool_ref = asyncio.run(spool_store.write(chunks()))
+
+    with spool_store.open(spool_ref, content_encoding) as feed:
+        assert list(iter_feed_items(feed, chunk_size=16)) == parse_xml_to_feed_items(xml.decode("utf-8"))
+
+def test_feed_batches_of_process_pool_read_spooled_feed_itself(tmp_path):
+    with open("feed_example.xml", "rb") as f:
+        xml = f.read()
+
+    async def chunks():
+        yield gzip.compress(xml)
+
+    spool_store = SpoolStore(tmp_path)
+    spool_ref = asyncio.run(spool_store.write(chunks()))
+
+    async def parse(feed, executor) -> list[list]:
+        async with aclosing(iter_feed_batches(feed, executor)) as batches:
+            return [row async for batch in batches for row in batch]
+
+    async def run():
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            rows = await parse(partial(spool_store.open, spool_ref, "gzip"), executor)
+            with pytest.raises(FeedParsingException, match="Unable to parse XML structure"):
+                await parse(xml[:-10], executor)
+        return rows
+
+    rows = asyncio.run(run())
+    expected = parse_xml_to_feed_items(xml)
+    assert all(len(row[-1]) == 16 for row in rows)
+    assert [row[:-1] for row in rows] == [list(map(item.model_dump().get, FeedItem.db_columns())) for item in expected]
+
+def test_parsing_process_streams_batches_and_is_released_when_feed_is_abandoned():
+    with open("feed_example.xml", "rb") as f:
+        xml = f.read()
+    # items of the example repeated, so the feed is far bigger than what the pipe buffers
+    items_start, items_end = xml.index(b"<item>"), xml.rindex(b"</item>") + len(b"</item>")
+    big_xml = xml[:items_start] + xml[items_start:items_end] * 20_000 + xml[items_end:]
+
+    async def run():
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            async with aclosing(iter_feed_batches(big_xml, executor, batch_size=100)) as batches:
+                first_batch = await anext(batches)
+            # the only parsing process must not stay blocked on the pipe of the abandoned feed
+            batches = [batch async for batch in iter_feed_batches(xml, executor, batch_size=2)]
+        return first_batch, batches
+
+    first_batch, batches = asyncio.run(asyncio.wait_for(run(), 60))
+    assert len(first_batch) == 100
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [row for batch in batches for row in batch] == list(iter_feed_rows(xml))
+
+
+def test_content_hash_tells_apart_values_joining_into_the_same_text():
+    rows = [
+        ["a", None, None],
+        ["a", "", None],
+        ["a", None, []],
+        ["a", None, [""]],
+        ["a", None, ["b", "c"]],
+        ["a", None, ["bc"]],
+        ["a", "b", ["c"]],
+        ["ab", None, ["c"]],
+    ]
+    assert len({content_hash(row) for row in rows}) == len(rows)
+    assert content_hash(["a", None, ["b"]]) == content_hash(("a", None, ["b"]))
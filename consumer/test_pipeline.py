@@ -0,0 +1,411 @@
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
+import logging
+import time
+
+import pytest
+
+from clients.db_client import DBClient
+from clients.image_store import ImageStore
+from clients.spool_store import SpoolStore
+from consumer.processing_utils import (
+    ROW_ADDITIONAL_IMAGE_LINK,
+    ROW_FEED_ITEM_ID,
+    ROW_IMAGE_LINK,
+    FeedItemsDiff,
+    FeedParsingException,
+    FeedUploadInProgressException,
+    process_feeds,
+    process_spooled_feeds,
+    run_feed_pipeline,
+)
+from consumer.test_images import ImageServer
+from models.FeedImage import FeedImage
+from models.FeedItem import FEED_ITEM_ROW_COLUMNS
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+
+
+class StubTransaction:
+    def __init__(self, db: "StubDB"):
+        self.db = db
+
+    async def __aenter__(self):
+        self.db.pending = {"feed_items": [], "feed_images": [], "feed_uploads": {}}
+
+    async def __aexit__(self, exc_type, *exc):
+        pending, self.db.pending = self.db.pending, None
+        if exc_type is None:
+            self.db.feed_items.extend(pending["feed_items"])
+            self.db.feed_images.extend(pending["feed_images"])
+            for feed_upload_id, status in pending["feed_uploads"].items():
+                self.db.uploads[feed_upload_id]["status"] = status
+
+
+class StubConnection:
+    """
+    Connection of StubDB - only what FeedItemsWriter uses, COPY into feed_images checks the primary key.
+    Lookups of the previous upload's items and images are told apart by the table they read.
+    """
+
+    def __init__(self, db: "StubDB"):
+        self.db = db
+
+    def transaction(self):
+        return StubTransaction(self.db)
+
+    async def copy_records_to_table(self, table, records, columns):
+        rows = [dict(zip(columns, record)) for record in records]
+        self.db.copies += 1
+        if table == DBClient.FEED_IMAGES_TABLE:
+            images = [*self.db.feed_images, *self.db.pending[table], *rows]
+            keys = [(image["feed_upload_id"], image["image_id"]) for image in images]
+            if len(keys) != len(set(keys)):
+                raise ValueError('duplicate key value violates unique constraint "feed_images_pkey"')
+        self.db.pending[table].extend(rows)
+
+    async def fetch(self, sql, previous_id, ids):
+        self.db.queries += 1
+        table = DBClient.FEED_IMAGES_TABLE if DBClient.FEED_IMAGES_TABLE in sql else DBClient.FEED_ITEMS_TABLE
+        key = "image_id" if table == DBClient.FEED_IMAGES_TABLE else "feed_item_id"
+        rows = self.db.feed_images if table == DBClient.FEED_IMAGES_TABLE else self.db.feed_items
+        return [row for row in rows if row["feed_upload_id"] == previous_id and row[key] in ids]
+
+    async def fetchval(self, sql, previous_id, feed_upload_id):
+        # FeedItemsWriter.count_removed
+        written = [*self.db.items(feed_upload_id), *self.db.pending[DBClient.FEED_ITEMS_TABLE]]
+        previous_ids = {item["feed_item_id"] for item in self.db.items(previous_id)}
+        return len(previous_ids - {item["feed_item_id"] for item in written})
+
+    async def execute(self, sql, *args):
+        if sql.lstrip().startswith("INSERT"):
+            # FeedItemsWriter.carry_over - feed upload id, previous id, feed item ids
+            feed_upload_id, previous_id, ids = args
+            carried = [
+                {**item, "feed_upload_id": feed_upload_id}
+                for item in self.db.items(previous_id)
+                if item["feed_item_id"] in ids
+            ]
+            self.db.pending[DBClient.FEED_ITEMS_TABLE].extend(carried)
+            return f"INSERT 0 {len(carried)}"
+        # FeedItemsWriter.finish - status, error, id, ...
+        self.db.pending["feed_uploads"][args[2]] = args[0]
+
+
+class StubPool:
+    def __init__(self, conn: StubConnection, max_size: int):
+        self.conn = conn
+        self.semaphore = asyncio.Semaphore(max_size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.semaphore:
+            yield self.conn
+
+
+class StubDB(DBClient):
+    """
+    In-memory DBClient with pool of max_size connections, feed uploads are created by create_upload
+    """
+
+    def __init__(self, max_size: int = 1):
+        super().__init__("stub")
+        self.pool = StubPool(StubConnection(self), max_size)
+        self.uploads: dict[int, dict] = {}
+        self.feed_items: list[dict] = []
+        self.feed_images: list[dict] = []
+        self.pending = None
+        self.copies = 0
+        self.queries = 0
+
+    def create_upload(self, feed_key=None) -> int:
+        feed_upload_id = len(self.uploads) + 1
+        self.uploads[feed_upload_id] = {"feed_key": feed_key, "status": FeedUploadStatus.QUEUED, "error": None}
+        return feed_upload_id
+
+    def items(self, feed_upload_id: int) -> list[dict]:
+        return [item for item in self.feed_items if item["feed_upload_id"] == feed_upload_id]
+
+    async def get_previous_feed_upload(self, feed_upload_id):
+        async with self.acquire():
+            feed_key = self.uploads[feed_upload_id]["feed_key"]
+            previous_ids = [
+                id
+                for id, upload in self.uploads.items()
+                if upload["feed_key"] == feed_key
+                and upload["status"] == FeedUploadStatus.FINISHED
+                and id < feed_upload_id
+            ]
+            return {"feed_key": feed_key, "previous_id": max(previous_ids, default=None)}
+
+    async def claim_feed_upload_job(self, feed_upload_id, lease):
+        async with self.acquire():
+            upload = self.uploads[feed_upload_id]
+            if upload["status"] == FeedUploadStatus.QUEUED or (
+                upload["status"] == FeedUploadStatus.PROCESSING and upload["claimed_at"] < time.monotonic() - lease
+            ):
+                upload.update(status=FeedUploadStatus.PROCESSING, claimed_at=time.monotonic())
+                return True
+            return False
+
+    async def get_feed_upload_job(self, feed_upload_id):
+        async with self.acquire():
+            upload = self.uploads[feed_upload_id]
+            return FeedUpload(id=feed_upload_id, status=upload["status"], error=upload["error"])
+
+    async def update_feed_upload_job(self, feed_upload_id, status=None, error=None):
+        async with self.acquire():
+            self.uploads[feed_upload_id].update(status=status, error=error)
+
+
+def feed_image(feed_upload_id: int, image_id: str) -> FeedImage:
+    return FeedImage(
+        feed_upload_id=feed_upload_id,
+        image_id=image_id,
+        path=f"{feed_upload_id}/{image_id}.jpg",
+        content_type="image/jpeg",
+        size=1,
+    )
+
+
+def row(feed_item_id: str, content_hash: bytes, image_link=None, additional_image_link=None) -> list:
+    values = dict.fromkeys(FEED_ITEM_ROW_COLUMNS)
+    values.update(
+        feed_item_id=feed_item_id,
+        title="title",
+        content_hash=content_hash,
+        image_link=image_link,
+        additional_image_link=additional_image_link,
+    )
+    return list(values.values())
+
+
+def feed(url: str, items: list[tuple[str, str]]) -> str:
+    body = "".join(
+        f"""<item><g:id>{feed_item_id}</g:id><title>{title}</title><description>d</description><link>l</link>
+        <g:image_link>{url}/shared.jpg</g:image_link>
+        <g:additional_image_link>{url}/{feed_item_id}.jpg</g:additional_image_link></item>"""
+        for feed_item_id, title in items
+    )
+    return f'<?xml version="1.0"?><rss xmlns:g="x"><channel>{body}</channel></rss>'
+
+
+def test_keyed_upload_does_not_wait_for_connection_held_by_its_writer(tmp_path):
+    items = [(f"I{i}", "title") for i in range(5)]
+
+    async def run():
+        db = StubDB(max_size=1)
+        async with ImageServer(delay=0) as server:
+            for _ in range(2):
+                feed_upload_id = db.create_upload(feed_key="merchant")
+                await asyncio.wait_for(
+                    run_feed_pipeline(feed_upload_id, feed(server.url, items), str(tmp_path), db, batch_size=1),
+                    timeout=10,
+                )
+        return db, server
+
+    db, server = asyncio.run(run())
+
+    assert [upload["status"] for upload in db.uploads.values()] == [FeedUploadStatus.FINISHED] * 2
+    # the second upload carried over all the items with their images, looked up batch by batch
+    assert server.requests == 6
+    assert db.queries == 2 * len(items)
+    assert [(item["feed_item_id"], item["image_link"]) for item in db.items(2)] == [
+        (item["feed_item_id"], item["image_link"]) for item in db.items(1)
+    ]
+    assert len([image for image in db.feed_images if image["feed_upload_id"] == 2]) == 6
+
+
+def test_carry_over_diffs_items_against_previous_upload(tmp_path):
+    store = ImageStore(tmp_path)
+    db = StubDB()
+    previous_id = db.create_upload(feed_key="merchant")
+    db.uploads[previous_id]["status"] = FeedUploadStatus.FINISHED
+    for feed_item_id, content_hash, image_link, additional_image_link in [
+        ("unchanged", b"a", "img1", ["img2"]),
+        ("changed", b"b", "img3", None),
+        ("blob-gone", b"c", "img4", None),
+        ("removed", b"d", "img1", None),
+    ]:
+        db.feed_items.append(
+            {
+                "feed_upload_id": previous_id,
+                "feed_item_id": feed_item_id,
+                "content_hash": content_hash,
+                "image_link": image_link,
+                "additional_image_link": additional_image_link,
+            }
+        )
+    db.feed_images.extend(feed_image(previous_id, f"img{i}").model_dump() for i in range(1, 5))
+    for blob in ["img1.jpg", "img2.jpg", "img3.jpg"]:  # img4 blob was removed meanwhile
+        store.blob_path(blob).parent.mkdir(parents=True, exist_ok=True)
+        store.blob_path(blob).write_bytes(b"x")
+
+    feed_upload_id = db.create_upload(feed_key="merchant")
+    rows = [
+        row("unchanged", b"a", "http://img/1.jpg", ["http://img/2.jpg"]),
+        row("changed", b"B", "http://img/3.jpg"),
+        row("blob-gone", b"c", "http://img/4.jpg"),
+        row("added", b"e", "http://img/5.jpg"),
+    ]
+
+    async def run():
+        diff = await FeedItemsDiff.for_upload(feed_upload_id, db, store)
+        async with db.feed_items_writer(feed_upload_id) as writer:
+            diff.writer.set_result(writer)
+            to_download, carried_ids, carried_images = await diff.carry_over(rows)
+            await writer.write(to_download, carried_images)
+            await writer.carry_over(previous_id, carried_ids)
+            delta = await diff.delta()
+            await writer.finish(delta)
+        return diff, to_download, carried_ids, carried_images, delta
+
+    diff, to_download, carried_ids, carried_images, delta = asyncio.run(run())
+
+    assert diff.previous_id == previous_id
+    assert [r[ROW_FEED_ITEM_ID] for r in to_download] == ["changed", "added", "blob-gone"]
+    assert (rows[2][ROW_IMAGE_LINK], rows[2][ROW_ADDITIONAL_IMAGE_LINK]) == ("http://img/4.jpg", None)
+    assert carried_ids == ["unchanged"]
+    assert sorted(image.image_id for image in carried_images) == ["img1", "img2"]
+    assert {image.feed_upload_id for image in carried_images} == {feed_upload_id}
+    assert sorted(path.name for path in store.feed_dir(feed_upload_id).iterdir()) == ["img1.jpg", "img2.jpg"]
+    # only the unchanged item was copied from the previous upload, with image ids of its previous version
+    assert db.copies == 2
+    carried = db.items(feed_upload_id)[-1]
+    assert (carried["feed_item_id"], carried["image_link"], carried["additional_image_link"]) == (
+        "unchanged",
+        "img1",
+        ["img2"],
+    )
+    assert delta == {"items_added": 1, "items_changed": 1, "items_removed": 1, "items_unchanged": 2}
+
+
+def test_upload_without_feed_key_is_not_diffed(tmp_path):
+    db = StubDB()
+    db.uploads[db.create_upload()]["status"] = FeedUploadStatus.FINISHED
+    assert asyncio.run(FeedItemsDiff.for_upload(db.create_upload(), db, ImageStore(tmp_path))) is None
+
+
+def test_writer_indexes_image_referenced_multiple_times_once():
+    db = StubDB()
+    feed_upload_id = db.create_upload()
+    # same image carried over by one item and downloaded by another one of the batch, then again in the next batch
+    batches = [
+        ([row("1", b"1", "shared"), row("2", b"2", "shared")], [feed_image(feed_upload_id, "shared")] * 2),
+        (
+            [row("3", b"3", "shared", ["other"])],
+            [feed_image(feed_upload_id, "shared"), feed_image(feed_upload_id, "other")],
+        ),
+    ]
+
+    async def run():
+        async with db.feed_items_writer(feed_upload_id) as writer:
+            for rows, feed_images in batches:
+                await writer.write(rows, feed_images)
+            await writer.finish()
+
+    asyncio.run(run())
+
+    assert [item["feed_item_id"] for item in db.items(feed_upload_id)] == ["1", "2", "3"]
+    assert {item["feed_upload_id"] for item in db.items(feed_upload_id)} == {feed_upload_id}
+    assert sorted(image["image_id"] for image in db.feed_images) == ["other", "shared"]
+    assert db.uploads[feed_upload_id]["status"] == FeedUploadStatus.FINISHED
+
+
+def test_keyed_upload_carries_over_unchanged_items_and_downloads_the_rest(tmp_path):
+    async def run():
+        db = StubDB(max_size=2)
+        async with ImageServer(delay=0) as server:
+            first = db.create_upload(feed_key="merchant")
+            first_feed = feed(server.url, [("I0", "a"), ("I1", "b"), ("I2", "c")])
+            await run_feed_pipeline(first, first_feed, str(tmp_path), db)
+            requests = server.requests
+            # I1 changed and downloads the shared image which unchanged I0 carries over within the same batch
+            second = db.create_upload(feed_key="merchant")
+            second_feed = feed(server.url, [("I0", "a"), ("I1", "B"), ("I3", "d")])
+            await run_feed_pipeline(second, second_feed, str(tmp_path), db)
+        return db, server.requests - requests
+
+    db, requests = asyncio.run(run())
+
+    assert db.uploads[2]["status"] == FeedUploadStatus.FINISHED
+    assert requests == 1  # only I3.jpg is new, images of changed I1 are still fresh in the url cache
+    first, second = db.items(1), db.items(2)
+    # unchanged I0 is copied by the db after the rows of its batch sent by the writer
+    assert [item["feed_item_id"] for item in second] == ["I1", "I3", "I0"]
+    assert db.copies == 2 + 2
+    assert second[2]["additional_image_link"] == first[0]["additional_image_link"]
+    assert {item["image_link"] for item in [*first, *second]} == {first[0]["image_link"]}
+    images = [image for image in db.feed_images if image["feed_upload_id"] == 2]
+    assert len(images) == 4
+    assert sorted(path.name for path in (tmp_path / "2").iterdir()) == sorted(
+        image["path"].split("/")[1] for image in images
+    )
+
+
+def test_failing_stage_rolls_back_written_batches_and_cleans_up(tmp_path):
+    items = [("I0", "a"), ("I1", "b"), ("I2", "c"), ("missing", "d")]
+
+    async def run():
+        db = StubDB(max_size=2)
+        async with ImageServer(delay=0) as server:
+            failed = db.create_upload()
+            with pytest.raises(FeedParsingException, match="Unable to download image"):
+                await run_feed_pipeline(failed, feed(server.url, items), str(tmp_path), db, batch_size=1)
+            copies = db.copies
+
+            processed = db.create_upload()
+            await process_feeds(processed, feed(server.url, items), str(tmp_path), logging.getLogger(__name__), db)
+        return db, copies
+
+    db, copies = asyncio.run(run())
+
+    # first batches were written before the download failed, nothing of them was committed
+    assert copies > 0
+    assert db.feed_items == [] and db.feed_images == []
+    assert db.uploads[2]["status"] == FeedUploadStatus.FINISHED_ERROR
+    assert db.uploads[2]["error"].startswith("FeedParsingException: Unable to download image")
+    assert not (tmp_path / "2").exists()
+
+
+def test_duplicate_message_does_not_process_job_claimed_by_another_consumer(tmp_path):
+    items = [("I0", "a"), ("I1", "b")]
+
+    async def run():
+        db = StubDB(max_size=2)
+        async with ImageServer(delay=0) as server:
+            feed_upload_id = db.create_upload()
+            message = partial(
+                process_feeds, feed_upload_id, feed(server.url, items), str(tmp_path), logging.getLogger(__name__), db
+            )
+            # both messages of the job are delivered at once
+            results = await asyncio.gather(message(), message(), return_exceptions=True)
+            # message delivered once the job is finished is skipped
+            await message()
+        return db, results
+
+    db, results = asyncio.run(run())
+
+    assert None in results
+    assert any(isinstance(result, FeedUploadInProgressException) for result in results)
+    assert db.uploads[1]["status"] == FeedUploadStatus.FINISHED
+    assert [item["feed_item_id"] for item in db.feed_items] == ["I0", "I1"]
+
+
+def test_message_with_feed_instead_of_spool_reference_finishes_job_with_error(tmp_path):
+    # /feeds-v2 messages published before claim check carry the feed itself as the second argument
+    xml = feed("http://localhost/images", [("I0", "a")])
+
+    async def run():
+        db = StubDB()
+        feed_upload_id = db.create_upload()
+        await process_spooled_feeds(
+            feed_upload_id, xml, SpoolStore(tmp_path), str(tmp_path), logging.getLogger(__name__), db
+        )
+        return db
+
+    db = asyncio.run(run())
+
+    assert db.uploads[1]["status"] == FeedUploadStatus.FINISHED_ERROR
+    assert db.uploads[1]["error"] == f"Invalid spool reference {xml[:64]!r}"
+    assert db.feed_items == []
@@ -1,11 +1,15 @@
+import asyncio
 import os
+from typing import Optional
 
 import dramatiq
 
+from dramatiq.asyncio import get_event_loop_thread
 from dramatiq.middleware import AsyncIO
 from dramatiq.brokers.rabbitmq import RabbitmqBroker
 from clients.db_client import DBClient
-from consumer.processing_utils import process_feeds
+from clients.spool_store import SpoolStore
+from consumer.processing_utils import process_spooled_feeds
 from logger import get_logger
 
 
@@ -22,44 +26,89 @@ pg_password = os.getenv("POSTGRES_PASSWORD", "pass")
 pg_port = os.getenv("POSTGRES_PORT", "5432")
 
 images_dir = os.getenv("SHARED_IMAGES_DIR", "./app/images")
+spool_dir = os.getenv("SHARED_SPOOL_DIR", "./app/spool")
+migrations_dir = os.getenv("MIGRATIONS_DIR", "./db_init/migrations")
+
+# db connections the whole consumer_v2 service (all its worker processes) may hold,
+# processes count has to match dramatiq's --processes
+db_connection_budget = int(os.getenv("DB_CONNECTION_BUDGET", "32"))
+dramatiq_processes = int(os.getenv("DRAMATIQ_PROCESSES", "4"))
+db_pool_stats_interval = float(os.getenv("DB_POOL_STATS_INTERVAL", "60"))
 
 
 db = DBClient(dsn=f"postgresql://{pg_user}:{pg_password}@{db_host}:{pg_port}/{pg_db}")
-db_connected = False
+spool_store = SpoolStore(spool_dir)
+# confirm_delivery - api's outbox relay marks messages as sent only once the broker confirmed them
 rabbitmq_broker = RabbitmqBroker(
-    url=f"amqp://{rabbit_mq_user}:{rabbit_mq_pass}@{rabbit_mq_host}/"
+    url=f"amqp://{rabbit_mq_user}:{rabbit_mq_pass}@{rabbit_mq_host}/",
+    confirm_delivery=True,
 )
 
-#keeping here just for reference - didn't work because another event loop was being used
-
-# class DBConnectionMiddleware(dramatiq.Middleware):
-#     def __init__(self, db):
-#         self.db: DBClient = db
-#         self.started = False
-
-#     def before_worker_boot(self, broker, worker):
-#         if not self.started:
-#             loop = asyncio.get_event_loop()
-#             loop.run_until_complete(self.db.connect())
-#             self.started = True
 
-#     def after_worker_stops(self, broker, worker):
-#         loop = asyncio.get_event_loop()
-#         loop.run_until_complete(self.db.close())
+class DBPoolMiddleware(dramatiq.Middleware):
+    """
+    Owns db connection pool of the worker process - the pool is created on the event loop of AsyncIO
+    middleware (async actors run there) when the worker boots and closed before the loop stops.
+
+    Pool size is derived from the connection budget of the whole service. Every worker thread processes
+    one feed at a time and a feed holds at most one connection at a time - the writer of the feed pipeline
+    keeps its connection until the feed is finished, while the claim, lookup of previous upload (done before
+    the writer connects, see FeedItemsDiff.for_upload) and error status update acquire one only while the
+    writer holds none. More connections than threads are therefore never needed, fewer (budget too small
+    for processes x threads) make feeds wait for a connection, but never deadlock.
+    """
+
+    def __init__(self, db: DBClient, connection_budget: int, processes: int, stats_interval: float):
+        self.db = db
+        self.connection_budget = connection_budget
+        self.processes = processes
+        self.stats_interval = stats_interval
+        self.stats_task: Optional[asyncio.Task] = None
+
+    def pool_size(self, threads: int) -> int:
+        return max(1, min(threads, self.connection_budget // self.processes))
+
+    def before_worker_boot(self, broker, worker):
+        max_size = self.pool_size(worker.worker_threads)
+        logger.info(
+            f"Connection budget {self.connection_budget} for {self.processes} processes x "
+            f"{worker.worker_threads} threads, pool of {max_size} connections per process"
+        )
+        get_event_loop_thread().run_coroutine(self._start(max_size))
+
+    def after_worker_shutdown(self, broker, worker):
+        # after_* hooks run in reverse order, so the event loop of AsyncIO middleware still runs
+        get_event_loop_thread().run_coroutine(self._stop())
+
+    async def _start(self, max_size: int):
+        await self.db.connect(min_size=1, max_size=max_size)
+        await self.db.apply_migrations(migrations_dir)
+        self.stats_task = asyncio.create_task(self._log_pool_stats())
+
+    async def _stop(self):
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+        await self.db.close()
+
+    async def _log_pool_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.info(f"DB pool stats: {self.db.pool_stats()}")
 
 
-# rabbitmq_broker.add_middleware(DBConnectionMiddleware(db))
-
 rabbitmq_broker.add_middleware(AsyncIO())
+rabbitmq_broker.add_middleware(
+    DBPoolMiddleware(db, db_connection_budget, dramatiq_processes, db_pool_stats_interval)
+)
 dramatiq.set_broker(rabbitmq_broker)
 
 
 @dramatiq.actor
-async def process_feeds_v2(feed_upload_id: int, xml_string: str):
-    global db_connected
+async def process_feeds_v2(
+    feed_upload_id: int, spool_ref: str, content_encoding: Optional[str] = None, profile: bool = False
+):
     logger.info(f"Started processing feed upload with id {feed_upload_id}")
 
-    if not db_connected:
-        await db.connect()
-        db_connected = True
-    await process_feeds(feed_upload_id, xml_string, images_dir, logger, db)
+    await process_spooled_feeds(
+        feed_upload_id, spool_ref, spool_store, images_dir, logger, db, content_encoding, profile
+    )
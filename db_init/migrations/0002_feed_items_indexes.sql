@@ -0,0 +1,4 @@
+-- item lookups of /feeds/{id}/items and /feeds/{id}/items/{item_id} were sequential scans,
+-- leading feed_upload_id column serves lookups of whole feed as well
+CREATE INDEX IF NOT EXISTS feed_items_feed_upload_id_feed_item_id_idx
+    ON feed_items (feed_upload_id, feed_item_id);
@@ -0,0 +1,3 @@
+-- keyset pagination of feed items - WHERE feed_upload_id = $1 AND id > $2 ORDER BY id
+CREATE INDEX IF NOT EXISTS feed_items_feed_upload_id_id_idx
+    ON feed_items (feed_upload_id, id);
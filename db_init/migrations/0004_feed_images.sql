@@ -0,0 +1,9 @@
+-- index of stored feed images written by consumers, so images can be served without scanning feed dirs
+CREATE TABLE IF NOT EXISTS feed_images (
+    feed_upload_id INTEGER NOT NULL REFERENCES feed_uploads (id),
+    image_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    PRIMARY KEY (feed_upload_id, image_id)
+);
@@ -0,0 +1,18 @@
+-- every status/error change of feed upload is announced to listeners of feed_upload_status channel
+-- (delivered on commit), e.g. api service invalidates its caches based on them
+CREATE OR REPLACE FUNCTION notify_feed_upload_status() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(
+        'feed_upload_status',
+        json_build_object('id', NEW.id, 'status', NEW.status)::text
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS feed_uploads_status_notify ON feed_uploads;
+CREATE TRIGGER feed_uploads_status_notify
+    AFTER UPDATE ON feed_uploads
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.error IS DISTINCT FROM NEW.error)
+    EXECUTE FUNCTION notify_feed_upload_status();
@@ -0,0 +1,12 @@
+-- transactional outbox - messages of feed upload jobs are written in the same transaction as the job
+-- and published to the broker afterwards by api's outbox relay, sent_at is set once the broker confirmed them
+CREATE TABLE IF NOT EXISTS feed_upload_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    feed_upload_id INTEGER NOT NULL REFERENCES feed_uploads (id),
+    message JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS feed_upload_outbox_unsent_idx
+    ON feed_upload_outbox (id) WHERE sent_at IS NULL;
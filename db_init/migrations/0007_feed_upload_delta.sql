@@ -0,0 +1,13 @@
+-- delta uploads - uploads of the same merchant feed share feed_key, items are diffed against
+-- the previous finished upload of the key by their content_hash and unchanged ones are carried over
+ALTER TABLE feed_uploads
+    ADD COLUMN IF NOT EXISTS feed_key TEXT,
+    ADD COLUMN IF NOT EXISTS items_added INTEGER,
+    ADD COLUMN IF NOT EXISTS items_changed INTEGER,
+    ADD COLUMN IF NOT EXISTS items_removed INTEGER,
+    ADD COLUMN IF NOT EXISTS items_unchanged INTEGER;
+
+CREATE INDEX IF NOT EXISTS feed_uploads_finished_feed_key_idx
+    ON feed_uploads (feed_key, id) WHERE status = 3 AND feed_key IS NOT NULL;
+
+ALTER TABLE feed_items ADD COLUMN IF NOT EXISTS content_hash BYTEA;
@@ -0,0 +1,5 @@
+-- processing_started_at - when a consumer claimed the job, created_at..processing_started_at is time spent queued
+-- stage_seconds - busy seconds of the processing stages of finished upload, e.g. {"parse": 1.2, "download": 3.4, "insert": 0.8}
+ALTER TABLE feed_uploads
+    ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS stage_seconds JSONB;
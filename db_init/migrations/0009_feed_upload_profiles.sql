@@ -0,0 +1,6 @@
+-- on-demand profiles of feed upload processing (sampled stacks and stage timeline), see consumer/profiling.py
+CREATE TABLE IF NOT EXISTS feed_upload_profiles (
+    feed_upload_id INTEGER PRIMARY KEY REFERENCES feed_uploads (id),
+    profile JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -1,15 +1,28 @@
+import asyncio
+import json
+import mimetypes
+import re
+import time
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Optional
 import aio_pika
-from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
 import os
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from contextlib import asynccontextmanager
 
+from clients.cached_db_client import CachedDBClient
 from clients.db_client import DBClient
+from clients.feed_status_listener import FeedStatusListener
+from clients.lru_cache import LRUCache
+from clients.outbox_relay import OutboxRelay
 from clients.rabbitmq_client import RabbitMQClient
+from clients.spool_store import SpoolStore
 from consumer_v2.consumer_v2 import process_feeds_v2
+from metrics import PUBLISH_DURATION, RequestMetricsMiddleware, latest_metrics
+from models.FeedImage import FeedImage
 from models.FeedItem import FeedItem
+from models.FeedUpload import FeedUpload
 from models.feeds_api_response.FeedUploadResponse import FeedUploadResponse
 from models.feeds_api_response.FeedUploadStatusResponse import FeedUploadStatusResponse
 
@@ -27,6 +40,39 @@ rabbit_mq_queue = os.getenv("RABBIT_MQ_QUEUE", "feeds_queue")
 rabbit_mq_rt_key = os.getenv("RABBIT_MQ_RT_KEY", "feeds_queue")
 
 images_dir = os.getenv("SHARED_IMAGES_DIR", "./app/images")
+spool_dir = os.getenv("SHARED_SPOOL_DIR", "./app/spool")
+feeds_cache_size = int(os.getenv("FEEDS_CACHE_SIZE", "10000"))
+feeds_cache_in_flight_ttl = float(os.getenv("FEEDS_CACHE_IN_FLIGHT_TTL", "1.0"))
+migrations_dir = os.getenv("MIGRATIONS_DIR", "./db_init/migrations")
+db_pool_min_size = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+db_pool_max_size = int(os.getenv("DB_POOL_MAX_SIZE", "8"))
+outbox_relay_batch_size = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", "100"))
+outbox_relay_poll_interval = float(os.getenv("OUTBOX_RELAY_POLL_INTERVAL", "1.0"))
+# opt-in coalescing of feed upload job inserts, 0 means every upload inserts its own job
+feed_upload_job_batch_window = float(os.getenv("FEED_UPLOAD_JOB_BATCH_WINDOW", "0"))
+feed_upload_job_batch_max_size = int(os.getenv("FEED_UPLOAD_JOB_BATCH_MAX_SIZE", "100"))
+
+# outbox message destinations
+FEEDS_QUEUE = "feeds"
+FEEDS_V2_QUEUE = "feeds-v2"
+
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# below nginx's default proxy_read_timeout (60s)
+MAX_WAIT_SECONDS = 50
+SSE_KEEP_ALIVE_SECONDS = 15
+
+# stored images never change, their id is the hash of their content
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+feed_images_cache: LRUCache[FeedImage] = LRUCache(
+    max_size=int(os.getenv("FEED_IMAGES_CACHE_SIZE", "10000"))
+)
+# (feed_id, image_id) of images not found, so repeated requests for them do not hit the db
+missing_feed_images_cache: LRUCache[bool] = LRUCache(
+    max_size=int(os.getenv("FEED_IMAGES_CACHE_SIZE", "10000"))
+)
+spool_store = SpoolStore(spool_dir)
 
 
 @asynccontextmanager
@@ -40,22 +86,47 @@ async def lifespan(app: FastAPI):
         routing_key=rabbit_mq_rt_key,
     )
     db = DBClient(
-        dsn=f"postgresql://{pg_user}:{pg_password}@{db_host}:{pg_port}/{pg_db}"
+        dsn=f"postgresql://{pg_user}:{pg_password}@{db_host}:{pg_port}/{pg_db}",
+        job_batch_window=feed_upload_job_batch_window,
+        job_batch_max_size=feed_upload_job_batch_max_size,
     )
 
     await rabbitmq_client.connect_for_publishing()
-    await db.connect()
+    await db.connect(min_size=db_pool_min_size, max_size=db_pool_max_size)
+    await db.apply_migrations(migrations_dir)
+
+    cached_db = CachedDBClient(
+        db, max_size=feeds_cache_size, in_flight_ttl=feeds_cache_in_flight_ttl
+    )
+    feed_status_listener = FeedStatusListener(db.dsn)
+    feed_status_listener.subscribe(cached_db.invalidate_feed_upload)
+    await feed_status_listener.connect()
+
+    outbox_relay = OutboxRelay(
+        db,
+        publish_outbox_messages,
+        batch_size=outbox_relay_batch_size,
+        poll_interval=outbox_relay_poll_interval,
+    )
 
     app.state.rabbitmq_client = rabbitmq_client
     app.state.db = db
+    app.state.cached_db = cached_db
+    app.state.feed_status_listener = feed_status_listener
+    app.state.outbox_relay = outbox_relay
+
+    outbox_relay.start()
 
     yield
 
+    await outbox_relay.close()
+    await feed_status_listener.close()
     await rabbitmq_client.close()
     await db.close()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 
 
 def rabbitmq_client() -> RabbitMQClient:
@@ -66,88 +137,341 @@ def db_client() -> DBClient:
     return app.state.db
 
 
-@app.post("/feeds", response_model=FeedUploadResponse)
-async def upload_feed(request: Request, content_type: Optional[str] = Header(None)):
-    if content_type != "application/xml":
+def cached_db_client() -> CachedDBClient:
+    return app.state.cached_db
+
+
+def outbox_relay() -> OutboxRelay:
+    return app.state.outbox_relay
+
+
+def feed_status_listener() -> FeedStatusListener:
+    return app.state.feed_status_listener
+
+
+def parse_content_encoding(content_encoding: Optional[str]) -> str:
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding not in SpoolStore.CONTENT_ENCODINGS:
         raise HTTPException(
-            status_code=415, detail="Unsupported Media Type. Expected 'application/xml'"
+            status_code=415,
+            detail=f"Unsupported Content-Encoding. Expected one of {', '.join(SpoolStore.CONTENT_ENCODINGS)}",
         )
+    return encoding
+
+
+async def spool_request_body(request: Request) -> str:
+    """
+    Streams request body chunk by chunk into the spool store, so the feed is never held in memory whole.
+    Compressed body is stored as it is, consumers decompress it while parsing.
 
+    :return: spool reference of the stored feed
+    """
     try:
-        request_xml = await request.body()
+        return await spool_store.write(request.stream())
     except Exception as e:
         raise HTTPException(
             status_code=400, detail=f"Error reading request body: {str(e)}"
         )
 
-    feed_upload_id = await db_client().create_feed_upload_job()
+
+def parse_profile_header(x_profile: Optional[str]) -> bool:
+    return (x_profile or "").strip().lower() in ("1", "true", "yes")
+
+
+async def create_feed_upload_job(
+    request: Request,
+    content_encoding: Optional[str],
+    feed_key: Optional[str],
+    queue: str,
+    profile: bool = False,
+) -> int:
+    """
+    Spools the feed and creates feed upload job together with its outbox message in one transaction,
+    the message is published to provided queue by outbox relay afterwards
+
+    :param feed_key: stable key of merchant feed (X-Feed-Key header), keyed upload is processed as delta
+        against the previous upload of the same key
+    :param queue: FEEDS_QUEUE (consumer service) or FEEDS_V2_QUEUE (consumer_v2 service)
+    :param profile: whether the consumer should profile the processing (X-Profile header)
+    :return: id of created feed upload job
+    """
+    encoding = parse_content_encoding(content_encoding)
+    spool_ref = await spool_request_body(request)
 
     try:
-        message = aio_pika.Message(
-            request_xml,
-            delivery_mode=2,
-            headers={"feed_upload_id": feed_upload_id},
-            content_type="application/xml",
-        )
-        await rabbitmq_client().get_channel().default_exchange.publish(
-            message, routing_key=f"{rabbit_mq_rt_key}"
+        feed_upload_id = await db_client().create_feed_upload_job(
+            {"queue": queue, "spool_ref": spool_ref, "content_encoding": encoding, "profile": profile},
+            feed_key=feed_key or None,
         )
     except Exception as e:
+        spool_store.delete(spool_ref)
         raise HTTPException(
-            status_code=500, detail=f"Failed to send to RabbitMQ: {str(e)}"
+            status_code=500, detail=f"Failed to create feed upload job: {str(e)}"
         )
 
-    return FeedUploadResponse(id=feed_upload_id)
+    outbox_relay().wake()
+    return feed_upload_id
+
+
+async def publish_outbox_messages(messages: list[dict]):
+    """
+    Publishes batch of outbox messages, returns only after the broker confirmed all of them
+    """
+    feeds_messages = [m for m in messages if m["message"]["queue"] == FEEDS_QUEUE]
+    feeds_v2_messages = [m for m in messages if m["message"]["queue"] == FEEDS_V2_QUEUE]
+
+    # claim check - consumer reads the feed itself from the spool store
+    await asyncio.gather(
+        *(
+            rabbitmq_client().publish(
+                aio_pika.Message(
+                    b"",
+                    delivery_mode=2,
+                    headers={
+                        "feed_upload_id": m["feed_upload_id"],
+                        "spool_ref": m["message"]["spool_ref"],
+                        "profile": m["message"].get("profile", False),
+                    },
+                    content_type="application/xml",
+                    content_encoding=m["message"]["content_encoding"],
+                ),
+                routing_key=f"{rabbit_mq_rt_key}",
+            )
+            for m in feeds_messages
+        )
+    )
 
+    if feeds_v2_messages:
+        # dramatiq broker is blocking (pika)
+        def send_feeds_v2():
+            for m in feeds_v2_messages:
+                started = time.perf_counter()
+                process_feeds_v2.send(
+                    m["feed_upload_id"],
+                    m["message"]["spool_ref"],
+                    m["message"]["content_encoding"],
+                    m["message"].get("profile", False),
+                )
+                PUBLISH_DURATION.labels(process_feeds_v2.queue_name).observe(time.perf_counter() - started)
 
-@app.post("/feeds-v2", response_model=FeedUploadResponse)
-async def upload_feed_v2(request: Request, content_type: Optional[str] = Header(None)):
+        await asyncio.to_thread(send_feeds_v2)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    content, content_type = latest_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@app.post("/feeds", response_model=FeedUploadResponse)
+async def upload_feed(
+    request: Request,
+    content_type: Optional[str] = Header(None),
+    content_encoding: Optional[str] = Header(None),
+    x_feed_key: Optional[str] = Header(None),
+    x_profile: Optional[str] = Header(None),
+):
     if content_type != "application/xml":
         raise HTTPException(
             status_code=415, detail="Unsupported Media Type. Expected 'application/xml'"
         )
 
-    try:
-        request_xml = await request.body()
-    except Exception as e:
-        raise HTTPException(
-            status_code=400, detail=f"Error reading request body: {str(e)}"
-        )
+    feed_upload_id = await create_feed_upload_job(
+        request, content_encoding, x_feed_key, FEEDS_QUEUE, parse_profile_header(x_profile)
+    )
+    return FeedUploadResponse(id=feed_upload_id)
 
-    feed_upload_id = await db_client().create_feed_upload_job()
 
-    try:
-        process_feeds_v2.send(feed_upload_id, request_xml.decode())
-    except Exception as e:
+@app.post("/feeds-v2", response_model=FeedUploadResponse)
+async def upload_feed_v2(
+    request: Request,
+    content_type: Optional[str] = Header(None),
+    content_encoding: Optional[str] = Header(None),
+    x_feed_key: Optional[str] = Header(None),
+    x_profile: Optional[str] = Header(None),
+):
+    if content_type != "application/xml":
         raise HTTPException(
-            status_code=500, detail=f"Failed to create backround task: {str(e)}"
+            status_code=415, detail="Unsupported Media Type. Expected 'application/xml'"
         )
 
+    feed_upload_id = await create_feed_upload_job(
+        request, content_encoding, x_feed_key, FEEDS_V2_QUEUE, parse_profile_header(x_profile)
+    )
     return FeedUploadResponse(id=feed_upload_id)
 
 
-@app.get("/feeds/{feed_id}", response_model=FeedUploadStatusResponse)
-async def get_feed(feed_id: int):
-    feed_upload_job = await db_client().get_feed_upload_job(feed_id)
-    if feed_upload_job is None:
-        raise HTTPException(
-            status_code=404, detail=f"Feed upload with id {feed_id} was not found."
-        )
+def parse_wait(wait: str) -> float:
+    """
+    :param wait: duration like 30, 30s or 500ms
+    :return: duration in seconds capped by MAX_WAIT_SECONDS
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)(ms|s)?", wait)
+    if match is None:
+        raise HTTPException(status_code=400, detail=f"Invalid wait duration {wait}")
+    seconds = float(match.group(1)) / (1000 if match.group(2) == "ms" else 1)
+    return min(seconds, MAX_WAIT_SECONDS)
+
 
+def to_status_response(feed_upload_job: FeedUpload) -> FeedUploadStatusResponse:
     return FeedUploadStatusResponse(
-        id=feed_id,
+        id=feed_upload_job.id,
         status=feed_upload_job.status,
         error=feed_upload_job.error,
         feed_processing_started_at=feed_upload_job.created_at,
+        feed_processing_claimed_at=feed_upload_job.processing_started_at,
         feed_processing_successfully_finished_at=feed_upload_job.successfully_finished_at,
+        feed_key=feed_upload_job.feed_key,
+        items_added=feed_upload_job.items_added,
+        items_changed=feed_upload_job.items_changed,
+        items_removed=feed_upload_job.items_removed,
+        items_unchanged=feed_upload_job.items_unchanged,
+        stage_seconds=feed_upload_job.stage_seconds,
+    )
+
+
+async def get_existing_feed_upload_job(feed_id: int, fresh: bool = False) -> FeedUpload:
+    """
+    :param fresh: whether to bypass the cache - a status read after watching started must not be stale,
+        cache may still hold (or a concurrent request may have re-cached) the status before the change
+    """
+    if fresh:
+        feed_upload_job = await db_client().get_feed_upload_job(feed_id)
+    else:
+        feed_upload_job = await cached_db_client().get_feed_upload_job(feed_id)
+    if feed_upload_job is None:
+        raise HTTPException(
+            status_code=404, detail=f"Feed upload with id {feed_id} was not found."
+        )
+    return feed_upload_job
+
+
+@app.get("/feeds/{feed_id}", response_model=FeedUploadStatusResponse)
+async def get_feed(feed_id: int, wait: Optional[str] = None):
+    """
+    With wait (e.g. ?wait=30s) the request is held until the status of not yet finished feed upload changes
+    or the wait duration elapses (long-poll)
+    """
+    if wait is None:
+        return to_status_response(await get_existing_feed_upload_job(feed_id))
+
+    timeout = parse_wait(wait)
+    # watching starts before the status is read, so no change can be missed in between
+    with feed_status_listener().watch(feed_id) as status_changes:
+        feed_upload_job = await get_existing_feed_upload_job(feed_id, fresh=True)
+        if feed_upload_job.status in CachedDBClient.TERMINAL_STATUSES:
+            return to_status_response(feed_upload_job)
+
+        try:
+            await asyncio.wait_for(status_changes.get(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # re-read even on timeout, the notification could have been missed (e.g. listener reconnecting)
+    return to_status_response(await get_existing_feed_upload_job(feed_id, fresh=True))
+
+
+@app.get("/feeds/{feed_id}/events")
+async def get_feed_events(feed_id: int):
+    """
+    Server-Sent Events stream of feed upload status - current status first, then every status change.
+    Stream is closed once the feed upload reaches terminal status.
+    """
+    await get_existing_feed_upload_job(feed_id)  # 404 before the stream starts
+
+    async def events() -> AsyncIterator[str]:
+        with feed_status_listener().watch(feed_id) as status_changes:
+            feed_upload_job = await get_existing_feed_upload_job(feed_id, fresh=True)
+            while True:
+                response = to_status_response(feed_upload_job)
+                yield f"event: status\ndata: {response.model_dump_json()}\n\n"
+                if feed_upload_job.status in CachedDBClient.TERMINAL_STATUSES:
+                    return
+
+                sent_status = feed_upload_job.status
+                while True:
+                    try:
+                        await asyncio.wait_for(status_changes.get(), SSE_KEEP_ALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        # status is re-checked on every tick, so a missed notification cannot hang the stream
+                        feed_upload_job = await get_existing_feed_upload_job(feed_id, fresh=True)
+                        if feed_upload_job.status != sent_status:
+                            break
+                        yield ": keep-alive\n\n"
+                    else:
+                        feed_upload_job = await get_existing_feed_upload_job(feed_id, fresh=True)
+                        break
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+async def encode_json_array(values: AsyncIterator) -> AsyncIterator[str]:
+    """
+    Method incrementally encodes values as one JSON array, values are written in batches
+    """
+    yield "["
+    separator = ""
+    batch = []
+    async for value in values:
+        batch.append(json.dumps(value))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield separator + ",".join(batch)
+            separator = ","
+            batch = []
+    if batch:
+        yield separator + ",".join(batch)
+    yield "]"
+
+
+@app.get("/feeds/{feed_id}/profile")
+async def get_feed_profile(feed_id: int, format: Optional[str] = None):
+    """
+    Profile of feed upload processing (uploaded with X-Profile header or sampled by PROFILE_SAMPLE_RATE) -
+    stage timeline and sampled stacks, with format=folded only the stacks in collapsed format of flame graph tools
+    """
+    profile = await db_client().get_feed_upload_profile(feed_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=404, detail=f"Profile of feed upload {feed_id} not found"
+        )
+
+    if format == "folded":
+        return Response(
+            content="".join(f"{stack} {count}\n" for stack, count in profile["stacks"].items()),
+            media_type="text/plain",
+        )
+    return profile
+
+
 @app.get("/feeds/{feed_id}/items", response_model=list[str])
-async def get_feed_item_ids(feed_id: int):
+async def get_feed_item_ids(
+    feed_id: int,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+):
+    """
+    Without limit all item ids are streamed, otherwise one page is returned and the cursor
+    of the next page (value for `after`) is provided in X-Next-Cursor header
+    """
     # maybe add check whether feed_id is even present as feed_upload?
-    items = await db_client().get_feed_upload_items(feed_id)
-    return [item.feed_item_id for item in items]
+    if limit is None:
+        item_ids = (
+            row["feed_item_id"]
+            async for row in db_client().iter_feed_item_ids(feed_id, after=after, chunk_size=STREAM_BATCH_SIZE)
+        )
+        return StreamingResponse(
+            encode_json_array(item_ids), media_type="application/json"
+        )
+
+    rows = await cached_db_client().get_feed_item_ids(feed_id, limit=limit, after=after)
+    if len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(rows[-1]["id"])
+    return [row["feed_item_id"] for row in rows]
 
 
 @app.get(
@@ -156,7 +480,7 @@ async def get_feed_item_ids(feed_id: int):
     response_model_exclude={"id"},
 )
 async def get_feed_item(feed_id: int, item_id: str):
-    items = await db_client().get_feed_upload_items(feed_id, item_id)
+    items = await cached_db_client().get_feed_upload_items(feed_id, item_id)
     if len(items) < 1:
         raise HTTPException(
             status_code=404,
@@ -165,34 +489,113 @@ async def get_feed_item(feed_id: int, item_id: str):
     return items[0]
 
 
-@app.get("/feeds/{feed_id}/images", response_model=list[str])
-async def get_feed_images(feed_id: int):
-    items = await db_client().get_feed_upload_items(feed_id)
-
-    # feed may contain 0 images, so no 404 is returned
+def parse_image_cursor(after: Optional[str]) -> tuple[int, int]:
+    """
+    :param after: image cursor in {feed_items.id}-{position} format, position 0 belongs to image_link
+    :return: tuple of feed_items.id and position
+    """
+    if after is None:
+        return 0, -1
+    try:
+        after_item_id, after_position = (int(part) for part in after.split("-"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor {after}")
+    return after_item_id, after_position
 
-    image_ids = []
-    for item in items:  # no list comprehension because it was hard to read
-        if item.image_link is not None:
-            image_ids.append(item.image_link)
-        if item.additional_image_link is not None:
-            image_ids.extend(item.additional_image_link)
 
-    return image_ids
+@app.get("/feeds/{feed_id}/images", response_model=list[str])
+async def get_feed_images(
+    feed_id: int,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    """
+    Without limit all image ids are streamed, otherwise one page is returned and the cursor
+    of the next page (value for `after`) is provided in X-Next-Cursor header
+    """
+    # feed may contain 0 images, so no 404 is returned
+    cursor = parse_image_cursor(after)
 
+    if limit is None:
+        image_ids = (
+            row["image_id"]
+            async for row in db_client().iter_feed_image_ids(feed_id, after=cursor, chunk_size=STREAM_BATCH_SIZE)
+        )
+        return StreamingResponse(
+            encode_json_array(image_ids), media_type="application/json"
+        )
 
-@app.get("/feeds/{feed_id}/images/{image_id}")
-async def get_feed_image(feed_id: int, image_id: str):
+    rows = await cached_db_client().get_feed_image_ids(feed_id, limit=limit, after=cursor)
+    if len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = f"{rows[-1]['id']}-{rows[-1]['position']}"
+    return [row["image_id"] for row in rows]
+
+
+async def find_feed_image(feed_id: int, image_id: str) -> Optional[FeedImage]:
+    key = (feed_id, image_id)
+    image = feed_images_cache.get(key)
+    if image is not None or missing_feed_images_cache.get(key):
+        return image
+
+    # status has to be known before the lookup, images of not yet finished feed upload may still appear
+    feed_upload_job = await cached_db_client().get_feed_upload_job(feed_id)
+    image = await db_client().get_feed_image(feed_id, image_id)
+    if image is None and not await db_client().has_feed_images(feed_id):
+        image = find_unindexed_feed_image(feed_id, image_id)
+
+    if image is not None:
+        feed_images_cache.set(key, image)
+    elif feed_upload_job is not None and feed_upload_job.status in CachedDBClient.TERMINAL_STATUSES:
+        missing_feed_images_cache.set(key, True)
+    else:
+        missing_feed_images_cache.set(key, True, ttl=feeds_cache_in_flight_ttl)
+    return image
+
+
+def find_unindexed_feed_image(feed_id: int, image_id: str) -> Optional[FeedImage]:
+    """
+    Feeds uploaded before feed_images index was introduced (without any indexed image) are still looked up
+    in their dir
+    """
     feed_path = Path(images_dir) / str(feed_id)
-
     if not feed_path.exists():
-        raise HTTPException(status_code=404, detail=f"Feed {feed_id} not found")
+        return None
 
     image_files = list(feed_path.glob(f"{image_id}*"))
-
     if not image_files:
+        return None
+
+    return FeedImage(
+        feed_upload_id=feed_id,
+        image_id=image_id,
+        path=str(image_files[0].relative_to(images_dir)),
+        content_type=mimetypes.guess_type(image_files[0].name)[0]
+        or "application/octet-stream",
+        size=image_files[0].stat().st_size,
+    )
+
+
+@app.get("/feeds/{feed_id}/images/{image_id}")
+async def get_feed_image(
+    feed_id: int, image_id: str, if_none_match: Optional[str] = Header(None)
+):
+    image = await find_feed_image(feed_id, image_id)
+
+    if image is None:
         raise HTTPException(
             status_code=404, detail=f"Image {image_id} not found in feed {feed_id}"
         )
 
-    return FileResponse(image_files[0])
+    etag = f'"{image.image_id}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+
+    if if_none_match is not None:
+        client_etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in client_etags or "*" in client_etags:
+            return Response(status_code=304, headers=headers)
+
+    # FileResponse handles Range requests on its own
+    return FileResponse(
+        Path(images_dir) / image.path, media_type=image.content_type, headers=headers
+    )
@@ -0,0 +1,113 @@
+"""
+Prometheus metrics shared by api and consumers, every service exposes only the ones it updates.
+
+Api serves them on /metrics, consumer by start_metrics_server(). Worker processes of consumer_v2
+write them into PROMETHEUS_MULTIPROC_DIR (it has to be set before prometheus_client is imported)
+and dramatiq's Prometheus middleware serves them together with its own metrics.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+# seconds, from sub-millisecond queries up to feeds processed for minutes
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_DURATION = Histogram(
+    "feeds_api_request_duration_seconds",
+    "Api request latency by route template",
+    ["method", "route", "status"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_ACQUIRE_WAIT = Histogram(
+    "feeds_db_pool_acquire_wait_seconds", "Time spent waiting for a pool connection", buckets=FAST_BUCKETS
+)
+DB_QUERY_DURATION = Histogram(
+    "feeds_db_query_duration_seconds", "Query execution time by SQL command", ["command"], buckets=FAST_BUCKETS
+)
+PUBLISH_DURATION = Histogram(
+    "feeds_publish_duration_seconds", "Broker publish latency (incl. confirm)", ["queue"], buckets=FAST_BUCKETS
+)
+STAGE_DURATION = Histogram(
+    "feeds_stage_duration_seconds",
+    "Busy seconds of feed processing stage (parse, download, insert) and whole processing (total)",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+FEED_UPLOADS = Counter("feeds_uploads_processed", "Processed feed uploads by final status", ["status"])
+FEED_ITEMS = Counter("feeds_items_saved", "Saved feed items")
+FEED_IMAGES = Counter(
+    "feeds_images", "Images referenced by processed feeds by their source", ["source"]
+)  # downloaded, revalidated, cached, carried_over
+IMAGE_BYTES = Counter("feeds_image_bytes", "Image bytes downloaded or reused from cache", ["kind"])
+FEED_UPLOADS_IN_PROGRESS = Gauge(
+    "feeds_uploads_in_progress", "Feed uploads being processed", multiprocess_mode="livesum"
+)
+
+
+def start_metrics_server(port: int):
+    """
+    Serves metrics of the process on :port/metrics from a background thread
+    """
+    start_http_server(port)
+
+
+def latest_metrics() -> tuple[bytes, str]:
+    """
+    :return: metrics in exposition format (of all processes, if PROMETHEUS_MULTIPROC_DIR is set) and their content type
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware observing latency of http requests (until the response starts) labelled by route template,
+    so path parameters do not blow up the label cardinality
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        responded = False
+
+        def observe(status: int):
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                scope["method"], route.path if route is not None else "unmatched", status
+            ).observe(time.perf_counter() - started)
+
+        async def send_observed(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_observed)
+        except BaseException:
+            if not responded:
+                observe(500)
+            raise
@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+
+
+class FeedImage(BaseModel):
+    feed_upload_id: int
+    image_id: str
+    path: str  # relative to the shared images dir
+    content_type: str
+    size: int
+
+    @classmethod
+    def db_columns(cls) -> list[str]:
+        return list(cls.model_fields.keys())
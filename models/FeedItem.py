@@ -1,5 +1,7 @@
-from typing import Optional
-from pydantic import BaseModel, Field
+from functools import cache
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field, TypeAdapter
+from typing_extensions import NotRequired, TypedDict
 
 
 class FeedItem(BaseModel):
@@ -24,13 +26,7 @@ class FeedItem(BaseModel):
 
     @classmethod
     def db_columns(cls, include_id: bool = False) -> list[str]:
-        columns = list(cls.model_fields.keys())
-        if not include_id and "id" in columns:
-            columns.remove("id")
-        return columns
-
-    def to_db_dict(self) -> dict:
-        return self.model_dump(by_alias=False, exclude_none=True)
+        return list(_db_columns(cls, include_id))
 
     def to_model_dict(self) -> dict:
         return self.model_dump(by_alias=True, exclude_none=True)
@@ -38,3 +34,32 @@ class FeedItem(BaseModel):
 
 class FeedItemWithUploadReference(FeedItem):
     feed_upload_id: int
+    # hash of source item fields (before image links are replaced by image ids), see validate_feed_rows
+    content_hash: Optional[bytes] = None
+
+
+@cache
+def _db_columns(model: type[FeedItem], include_id: bool) -> tuple[str, ...]:
+    return tuple(column for column in model.model_fields if include_id or column != "id")
+
+
+def _row_type(model: type[FeedItem]) -> type:
+    """
+    :return: TypedDict with the same validation (incl. aliases and required fields) as db columns of the model,
+        validating into plain dicts is several times cheaper than building models
+    """
+    fields = {}
+    for name in _db_columns(model, False):
+        field = model.model_fields[name]
+        annotation = Annotated[field.annotation, Field(validation_alias=field.validation_alias)]
+        fields[name] = annotation if field.is_required() else NotRequired[annotation]
+    return TypedDict(f"{model.__name__}Row", fields)
+
+
+FeedItemRow = _row_type(FeedItem)
+# whole batches of parsed items are validated by single call, first error is reported with the index of the item
+FEED_ITEM_ROWS_ADAPTER = TypeAdapter(list[FeedItemRow])
+# feed items flow from parsing into db writes as rows - lists of values of these columns in this order
+FEED_ITEM_ROW_COLUMNS = [*FeedItem.db_columns(), "content_hash"]
+# feed items are read back by the api with their upload reference and id, without content_hash
+FEED_ITEM_READ_COLUMNS = ["feed_upload_id", *FeedItem.db_columns(include_id=True)]
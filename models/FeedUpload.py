@@ -17,4 +17,11 @@ class FeedUpload(BaseModel):
     status: FeedUploadStatus
     error: Optional[str] = None
     created_at: Optional[datetime] = None
+    processing_started_at: Optional[datetime] = None
     successfully_finished_at: Optional[datetime] = None
+    feed_key: Optional[str] = None
+    items_added: Optional[int] = None
+    items_changed: Optional[int] = None
+    items_removed: Optional[int] = None
+    items_unchanged: Optional[int] = None
+    stage_seconds: Optional[dict[str, float]] = None
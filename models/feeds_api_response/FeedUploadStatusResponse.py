@@ -8,7 +8,14 @@ class FeedUploadStatusResponse(FeedUploadResponse):
     status: FeedUploadStatus
     error: Optional[str]
     feed_processing_started_at: Optional[datetime]
+    feed_processing_claimed_at: Optional[datetime] = None
     feed_processing_successfully_finished_at: Optional[datetime]
+    feed_key: Optional[str] = None
+    items_added: Optional[int] = None
+    items_changed: Optional[int] = None
+    items_removed: Optional[int] = None
+    items_unchanged: Optional[int] = None
+    stage_seconds: Optional[dict[str, float]] = None
 
     class Config:
         use_enum_values = False
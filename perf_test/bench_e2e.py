@@ -0,0 +1,256 @@
+"""
+End-to-end benchmark of running services - uploads synthetic feeds through `/feeds` and/or `/feeds-v2`
+at given concurrency, waits until every upload finishes and reports throughput and p50/p95/p99 of
+every stage as JSON:
+
+- enqueue - upload request latency measured by the client
+- queue - created_at until a consumer claimed the job
+- parse, download, insert - busy seconds of consumer's pipeline stages (stage_seconds of the upload)
+- end_to_end - created_at until successfully_finished_at
+
+Images of the feeds are served by local image server with configurable latency and size, consumers
+have to be able to reach it on --image-host (e.g. `host.docker.internal` for services run by docker compose).
+
+Run from the root of the project, with the services running:
+`python -m perf_test.bench_e2e --endpoints /feeds /feeds-v2 --uploads 20 --concurrency 20 --output results.json`
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import random
+import time
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+ITEM_TEMPLATE = """
+        <item>
+            <g:id>ID{i}</g:id>
+            <title>Bodylab Men's T-shirt - Black {i}</title>
+            <description>{description}</description>
+            <link>https://bodylab.no/shop/mens-t-shirt-black-{i}.html</link>{images}
+            <g:price>299.00 NOK</g:price>
+            <g:condition>new</g:condition>
+            <g:availability>in stock</g:availability>
+            <g:brand>Bodylab</g:brand>
+            <g:gtin>5711657018069</g:gtin>
+            <g:item_group_id>M{i}</g:item_group_id>
+        </item>"""
+STAGES = ["enqueue", "queue", "parse", "download", "insert", "end_to_end"]
+TERMINAL_STATUSES = ("FINISHED", "FINISHED_ERROR")
+
+
+def generate_feed(
+    items: int,
+    images_per_item: int,
+    duplicate_ratio: float,
+    image_base_url: str,
+    description_size: int = 600,
+    seed: int = 0,
+) -> str:
+    """
+    :param images_per_item: first image is g:image_link, the rest are g:additional_image_link
+    :param duplicate_ratio: share of image urls pointing to an image already used by another item of the feed
+    """
+    rnd = random.Random(seed)
+    description = ("Release the Feeling " * (description_size // 20 + 1))[:description_size]
+    urls: list[str] = []
+    body = []
+    for i in range(items):
+        item_urls = []
+        for _ in range(images_per_item):
+            if urls and rnd.random() < duplicate_ratio:
+                item_urls.append(rnd.choice(urls))
+            else:
+                urls.append(f"{image_base_url}/{seed}-{len(urls)}.jpg")
+                item_urls.append(urls[-1])
+        images = "".join(
+            f"\n            <g:{tag}>{url}</g:{tag}>"
+            for tag, url in zip(["image_link", *["additional_image_link"] * (len(item_urls) - 1)], item_urls)
+        )
+        body.append(ITEM_TEMPLATE.format(i=i, description=description, images=images))
+    return (
+        '<?xml version="1.0"?>\n'
+        '<rss xmlns:g="http://base.google.com/ns/1.0" version="2.0">\n'
+        f"    <channel>\n        <title>Synthetic feed</title>{''.join(body)}\n    </channel>\n</rss>\n"
+    )
+
+
+class ImageServer:
+    """
+    Stand-in for merchants' image hosts - every /images/{name} is a jpeg of `size` bytes served after `latency` seconds
+    """
+
+    def __init__(self, host: str, port: int, latency: float, size: int):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.body = bytes(size)
+        self.requests = 0
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(body=self.body, content_type="image/jpeg")
+
+    async def __aenter__(self) -> "ImageServer":
+        app = web.Application()
+        app.router.add_get("/images/{name}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+def percentiles(values: list[float]) -> Optional[dict[str, float]]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def nearest_rank(p: float) -> float:
+        return round(values[min(len(values) - 1, max(0, int(len(values) * p + 0.5) - 1))], 3)
+
+    return {"p50": nearest_rank(0.50), "p95": nearest_rank(0.95), "p99": nearest_rank(0.99)}
+
+
+def parse_datetime(value: str) -> datetime:
+    # fromisoformat of python < 3.11 does not accept Z suffix
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def seconds_between(start: Optional[str], end: Optional[str]) -> Optional[float]:
+    if start is None or end is None:
+        return None
+    return (parse_datetime(end) - parse_datetime(start)).total_seconds()
+
+
+async def upload(
+    session: aiohttp.ClientSession, api_url: str, endpoint: str, feed: bytes, wait: float
+) -> dict:
+    """
+    Uploads the feed and long-polls its status until it finishes
+
+    :return: final status of the upload with client-side enqueue seconds
+    """
+    started = time.perf_counter()
+    async with session.post(
+        f"{api_url}{endpoint}", data=feed, headers={"Content-Type": "application/xml"}
+    ) as resp:
+        resp.raise_for_status()
+        feed_upload_id = (await resp.json())["id"]
+    enqueue = time.perf_counter() - started
+
+    while True:
+        async with session.get(f"{api_url}/feeds/{feed_upload_id}", params={"wait": f"{wait}s"}) as resp:
+            resp.raise_for_status()
+            status = await resp.json()
+        if status["status"] in TERMINAL_STATUSES:
+            return {**status, "enqueue": enqueue}
+
+
+def summarize(statuses: list[dict], items: int) -> dict:
+    finished = [status for status in statuses if status["status"] == "FINISHED"]
+    stage_values = {stage: [] for stage in STAGES}
+    for status in finished:
+        stage_values["enqueue"].append(status["enqueue"])
+        stage_values["queue"].append(
+            seconds_between(status["feed_processing_started_at"], status["feed_processing_claimed_at"])
+        )
+        for stage, seconds in (status["stage_seconds"] or {}).items():
+            stage_values.setdefault(stage, []).append(seconds)
+        stage_values["end_to_end"].append(
+            seconds_between(
+                status["feed_processing_started_at"], status["feed_processing_successfully_finished_at"]
+            )
+        )
+
+    # wall clock of the whole run from the first created upload to the last finished one
+    elapsed = None
+    if finished:
+        elapsed = seconds_between(
+            min((status["feed_processing_started_at"] for status in finished), key=parse_datetime),
+            max((status["feed_processing_successfully_finished_at"] for status in finished), key=parse_datetime),
+        )
+    return {
+        "uploads": len(statuses),
+        "finished": len(finished),
+        "failed": len(statuses) - len(finished),
+        "errors": sorted({status["error"] for status in statuses if status["error"]}),
+        "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+        "uploads_per_sec": round(len(finished) / elapsed, 2) if elapsed else None,
+        "items_per_sec": round(len(finished) * items / elapsed, 1) if elapsed else None,
+        "stages": {
+            stage: percentiles([value for value in values if value is not None])
+            for stage, values in stage_values.items()
+        },
+    }
+
+
+async def run_endpoint(args: argparse.Namespace, endpoint: str, image_base_url: str) -> dict:
+    # every upload gets its own image urls (seed), so image cache of consumers does not skew the results
+    run_seed = int(time.time())
+    feeds = [
+        generate_feed(
+            args.items, args.images_per_item, args.duplicate_ratio, image_base_url, seed=run_seed * 1000 + i
+        ).encode()
+        for i in range(args.uploads)
+    ]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited_upload(feed: bytes) -> dict:
+        async with semaphore:
+            return await upload(session, args.api_url, endpoint, feed, args.wait)
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        statuses = await asyncio.gather(*(limited_upload(feed) for feed in feeds))
+    return summarize(statuses, args.items)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://localhost:4444")
+    parser.add_argument("--endpoints", nargs="+", default=["/feeds", "/feeds-v2"])
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--images-per-item", type=int, default=3)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--image-latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--image-size", type=int, default=20 * 1024, help="bytes")
+    parser.add_argument("--image-bind", default="0.0.0.0")
+    parser.add_argument("--image-host", default="localhost", help="host of image server as seen by consumers")
+    parser.add_argument("--image-port", type=int, default=0)
+    parser.add_argument("--wait", type=float, default=30, help="long-poll seconds of status requests")
+    parser.add_argument("--output", help="file the JSON results are written to, stdout if not provided")
+    args = parser.parse_args()
+
+    async with ImageServer(args.image_bind, args.image_port, args.image_latency, args.image_size) as image_server:
+        image_base_url = f"http://{args.image_host}:{image_server.port}/images"
+        results = {}
+        for endpoint in args.endpoints:
+            results[endpoint] = await run_endpoint(args, endpoint, image_base_url)
+        image_requests = image_server.requests
+
+    output = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "image_requests": image_requests,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
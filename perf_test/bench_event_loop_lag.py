@@ -0,0 +1,81 @@
+"""
+Measures event loop lag (how late a 10ms ticker wakes up) while a feed is parsed on the event loop
+compared to parsing in the process pool used by consumers (PARSING_PROCESSES).
+
+Run from the root of the project: `python -m perf_test.bench_event_loop_lag --items 10000 100000`
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from functools import partial
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from typing import Optional
+
+from consumer.processing_utils import iter_feed_batches
+from perf_test.bench_parsing import generate_feed
+
+TICK_SECONDS = 0.01
+
+
+async def measure_lag(stop: asyncio.Event) -> list[float]:
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK_SECONDS)
+        lags.append(time.perf_counter() - started - TICK_SECONDS)
+    return lags
+
+
+async def measure(feed_path: str, executor: Optional[ProcessPoolExecutor]) -> dict:
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    await asyncio.sleep(TICK_SECONDS * 2)
+
+    started = time.perf_counter()
+    items = 0
+    async with aclosing(iter_feed_batches(partial(open, feed_path, "rb"), executor)) as batches:
+        async for batch in batches:
+            items += len(batch)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    lags = sorted(await lag_task)
+    return {
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "max_lag_ms": round(lags[-1] * 1000, 1),
+        "p99_lag_ms": round(lags[int(len(lags) * 0.99)] * 1000, 1),
+        "mean_lag_ms": round(statistics.mean(lags) * 1000, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(
+        args.processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor, tempfile.TemporaryDirectory() as tmp_dir:
+        # warm up the pool, so process start is not measured
+        await asyncio.get_running_loop().run_in_executor(executor, int)
+
+        for items in args.items:
+            feed_path = os.path.join(tmp_dir, f"feed_{items}.xml")
+            with open(feed_path, "w", encoding="utf-8") as f:
+                f.write(generate_feed(items))
+
+            for name, pool in (("event loop", None), ("process pool", executor)):
+                print(json.dumps({"parsing": name, **await measure(feed_path, pool)}))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+"""
+Compares memory and throughput of the streaming feed parser with the previous xmltodict based one.
+
+Run from the root of the project: `python -m perf_test.bench_parsing --items 10000 100000`
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable
+
+import xmltodict
+
+from consumer.processing_utils import iter_feed_items
+from models.FeedItem import FeedItem
+
+ITEM_TEMPLATE = """
+        <item>
+            <g:id>ID{i}</g:id>
+            <title>Bodylab Men's T-shirt - Black {i}</title>
+            <description>{description}</description>
+            <link>https://bodylab.no/shop/mens-t-shirt-black-{i}.html</link>
+            <g:image_link>https://www.bodylab.no/images/products/{i}-p.jpg</g:image_link>
+            <g:additional_image_link>https://www.bodylab.no/images/products/{i}-a.jpg</g:additional_image_link>
+            <g:additional_image_link>https://www.bodylab.no/images/products/{i}-b.png</g:additional_image_link>
+            <g:price>299.00 NOK</g:price>
+            <g:condition>new</g:condition>
+            <g:availability>in stock</g:availability>
+            <g:brand>Bodylab</g:brand>
+            <g:gtin>5711657018069</g:gtin>
+            <g:item_group_id>M{i}</g:item_group_id>
+            <g:sale_price></g:sale_price>
+        </item>"""
+
+
+def generate_feed(items: int, description_size: int = 600) -> str:
+    description = ("Release the Feeling " * (description_size // 20 + 1))[
+        :description_size
+    ]
+    body = "".join(
+        ITEM_TEMPLATE.format(i=i, description=description) for i in range(items)
+    )
+    return (
+        '<?xml version="1.0"?>\n'
+        '<rss xmlns:g="http://base.google.com/ns/1.0" version="2.0">\n'
+        f"    <channel>\n        <title>Synthetic feed</title>{body}\n    </channel>\n</rss>\n"
+    )
+
+
+def legacy_parse(xml: str) -> int:
+    """previous implementation - whole document dict first, then a list of all validated items"""
+    items = xmltodict.parse(xml)["rss"]["channel"]["item"]
+    if isinstance(items, dict):
+        items = [items]
+    for item in items:
+        additional_image_link = item.get("g:additional_image_link")
+        if isinstance(additional_image_link, str):
+            item["g:additional_image_link"] = [additional_image_link]
+    return len([FeedItem(**item) for item in items])
+
+
+def streaming_parse(xml: str) -> int:
+    """items are consumed one by one, as a streaming consumer would do"""
+    return sum(1 for _ in iter_feed_items(xml))
+
+
+def measure(parse: Callable[[str], int], xml: str) -> dict:
+    gc.collect()
+    started = time.perf_counter()
+    count = parse(xml)
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    tracemalloc.start()
+    parse(xml)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "items": count,
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(count / elapsed),
+        "peak_mem_mb": round(peak / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    results = []
+    for items in args.items:
+        xml = generate_feed(items)
+        for name, parse in (("xmltodict", legacy_parse), ("streaming", streaming_parse)):
+            result = {
+                "parser": name,
+                "payload_mb": round(len(xml) / 2**20, 1),
+                **measure(parse, xml),
+            }
+            results.append(result)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
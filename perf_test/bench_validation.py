@@ -0,0 +1,109 @@
+"""
+Compares CPU cost per item of turning parsed feed items into records written by COPY - the previous per-item
+path (FeedItem(**item) dumped into row in parsing process, model_construct of every row and rows dumped from
+the models again in consumer) with the single-pass one (single TypeAdapter call per batch validating straight
+into rows, which are written as they are). XML parsing is excluded, items are parsed once up front.
+The previous path also hashes the rows the previous way (JSON encoding), so outputs are compared without hashes.
+
+Run from the root of the project: `python -m perf_test.bench_validation --items 100000`
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+from operator import attrgetter
+import time
+from typing import Callable
+
+from consumer.processing_utils import VALIDATION_BATCH_SIZE, _iter_parsed_items, validate_feed_rows
+from models.FeedItem import FEED_ITEM_ROW_COLUMNS, FeedItem, FeedItemWithUploadReference
+from perf_test.bench_parsing import generate_feed
+
+
+def per_item_content_hash(row: tuple) -> bytes:
+    """previous implementation - hash of JSON encoded row, json.dumps builds a new encoder on every call"""
+    return hashlib.blake2b(json.dumps(row, ensure_ascii=False).encode(), digest_size=16).digest()
+
+
+def per_item_rows(items: list[dict]) -> list[tuple]:
+    """previous implementation of parsing process - model of every item dumped into row"""
+    to_row = attrgetter(*FeedItem.db_columns())
+    rows = []
+    for item in items:
+        row = to_row(FeedItem(**item))
+        rows.append((*row, per_item_content_hash(row)))
+    return rows
+
+
+def per_item_records(rows: list[tuple]) -> list[tuple]:
+    """previous implementation of consumer - model_construct of every row, dumped into COPY record by the writer"""
+    feed_items = [
+        FeedItemWithUploadReference.model_construct(feed_upload_id=1, **dict(zip(FEED_ITEM_ROW_COLUMNS, row)))
+        for row in rows
+    ]
+    to_record = attrgetter(*FEED_ITEM_ROW_COLUMNS, "feed_upload_id")
+    return [to_record(feed_item) for feed_item in feed_items]
+
+
+def single_pass_rows(items: list[dict]) -> list[list]:
+    rows = []
+    for i in range(0, len(items), VALIDATION_BATCH_SIZE):
+        rows.extend(validate_feed_rows(items[i : i + VALIDATION_BATCH_SIZE], i))
+    return rows
+
+
+def single_pass_records(rows: list[list]) -> list[tuple]:
+    """same as FeedItemsWriter.write"""
+    return [(*row, 1) for row in rows]
+
+
+def measure(fn: Callable, data: list, repeat: int) -> tuple[float, list]:
+    """
+    :return: best CPU seconds of repeated runs and the result of the last one
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.process_time()
+        result = fn(data)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for count in args.items:
+        items = list(_iter_parsed_items(generate_feed(count)))
+        results = {}
+        for name, to_rows, to_records in (
+            ("per_item", per_item_rows, per_item_records),
+            ("single_pass", single_pass_rows, single_pass_records),
+        ):
+            rows_seconds, rows = measure(to_rows, items, args.repeat)
+            records_seconds, records = measure(to_records, rows, args.repeat)
+            results[name] = {"rows": rows_seconds, "records": records_seconds, "output": records}
+
+        without_hash = [[(*record[:-2], record[-1]) for record in result["output"]] for result in results.values()]
+        assert without_hash[0] == without_hash[1]
+        for name, result in results.items():
+            print(
+                json.dumps(
+                    {
+                        "path": name,
+                        "items": count,
+                        "rows_us_per_item": round(result["rows"] / count * 1e6, 2),
+                        "records_us_per_item": round(result["records"] / count * 1e6, 2),
+                        "total_us_per_item": round((result["rows"] + result["records"]) / count * 1e6, 2),
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
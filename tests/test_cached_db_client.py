@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+from clients.cached_db_client import CachedDBClient
+from clients.feed_status_listener import FeedStatusListener
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+
+
+class StubDB:
+    def __init__(self):
+        self.reads = 0
+
+    async def get_feed_upload_job(self, feed_upload_id):
+        self.reads += 1
+        return FeedUpload(id=feed_upload_id, status=FeedUploadStatus.FINISHED)
+
+    async def get_feed_upload_items(self, feed_upload_id, item_id=None):
+        self.reads += 1
+        return [f"{feed_upload_id}-{item_id}"]
+
+    async def get_feed_item_ids(self, feed_upload_id, limit, after=None):
+        self.reads += 1
+        return [f"{feed_upload_id}-item"]
+
+    async def get_feed_image_ids(self, feed_upload_id, limit, after=(0, -1)):
+        self.reads += 1
+        return [f"{feed_upload_id}-image"]
+
+
+def test_invalidation_removes_only_entries_of_the_feed_upload():
+    async def run():
+        db = StubDB()
+        cached = CachedDBClient(db)
+        for feed_upload_id in (1, 2):
+            await cached.get_feed_upload_items(feed_upload_id)
+            await cached.get_feed_upload_items(feed_upload_id, "I0")
+        reads = db.reads
+
+        cached.invalidate_feed_upload(1, FeedUploadStatus.FINISHED)
+        await cached.get_feed_upload_items(2)
+        await cached.get_feed_upload_items(2, "I0")
+        assert db.reads == reads
+        await cached.get_feed_upload_items(1, "I0")
+        # job and items of the invalidated feed upload are loaded again
+        assert db.reads == reads + 2
+        return cached
+
+    cached = asyncio.run(run())
+    assert cached.feed_upload_keys == {
+        1: {(1, "job"), (1, "items", "I0")},
+        2: {(2, "job"), (2, "items", None), (2, "items", "I0")},
+    }
+
+
+def test_evicted_entries_are_removed_from_feed_upload_index():
+    async def run():
+        cached = CachedDBClient(StubDB(), max_size=2)
+        for feed_upload_id in (1, 2, 3):
+            await cached.get_feed_upload_job(feed_upload_id)
+        return cached
+
+    cached = asyncio.run(run())
+    assert cached.feed_upload_keys == {2: {(2, "job")}, 3: {(3, "job")}}
+
+
+def test_status_notification_evicts_items_and_images_of_the_feed_upload():
+    db = StubDB()
+    cached = CachedDBClient(db)
+    listener = FeedStatusListener("stub")
+    listener.subscribe(cached.invalidate_feed_upload)
+
+    async def load(feed_upload_id):
+        await cached.get_feed_upload_items(feed_upload_id, "I0")
+        await cached.get_feed_item_ids(feed_upload_id, limit=10)
+        await cached.get_feed_image_ids(feed_upload_id, limit=10, after=(5, 1))
+
+    async def run():
+        for feed_upload_id in (1, 2):
+            await load(feed_upload_id)
+        reads = db.reads
+
+        # as delivered by feed_uploads_status_notify trigger on the listening connection
+        payload = json.dumps({"id": 1, "status": FeedUploadStatus.FINISHED.value})
+        listener._on_notification(None, 0, FeedStatusListener.CHANNEL, payload)
+        invalidated_keys = dict(cached.feed_upload_keys)
+
+        await load(2)
+        assert db.reads == reads
+        await load(1)
+        # job, items, item ids and image ids of the notified feed upload are loaded again
+        assert db.reads == reads + 4
+        return invalidated_keys
+
+    invalidated_keys = asyncio.run(run())
+    assert invalidated_keys == {
+        2: {(2, "job"), (2, "items", "I0"), (2, "item_ids", 10, None), (2, "image_ids", 10, (5, 1))},
+    }
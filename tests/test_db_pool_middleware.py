@@ -0,0 +1,80 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from dramatiq.middleware import AsyncIO
+
+from consumer_v2 import consumer_v2
+from consumer_v2.consumer_v2 import DBPoolMiddleware
+
+
+class StubPoolDB:
+    """
+    Records the pool lifecycle calls of DBPoolMiddleware together with the thread they were made on
+    """
+
+    def __init__(self):
+        self.calls: list[str] = []
+        self.threads: set[threading.Thread] = set()
+
+    def record(self, call: str):
+        self.calls.append(call)
+        self.threads.add(threading.current_thread())
+
+    async def connect(self, min_size, max_size):
+        self.record(f"connect {min_size}-{max_size}")
+
+    async def apply_migrations(self, migrations_dir):
+        self.record(f"migrate {migrations_dir}")
+
+    def pool_stats(self):
+        self.record("stats")
+        return {}
+
+    async def close(self):
+        self.record("close")
+
+
+@pytest.mark.parametrize(
+    "budget, processes, threads, pool_size",
+    [
+        (32, 4, 8, 8),  # budget split among processes
+        (32, 4, 16, 8),
+        (32, 4, 4, 4),  # no more connections than threads
+        (10, 4, 8, 2),  # budget rounded down
+        (3, 4, 8, 1),  # budget smaller than processes, every process still gets a connection
+        (0, 1, 8, 1),
+    ],
+)
+def test_pool_size_splits_connection_budget_among_processes(budget, processes, threads, pool_size):
+    middleware = DBPoolMiddleware(StubPoolDB(), connection_budget=budget, processes=processes, stats_interval=60)
+    assert middleware.pool_size(threads) == pool_size
+
+
+def test_pool_is_opened_on_boot_and_closed_on_shutdown_on_asyncio_event_loop():
+    db = StubPoolDB()
+    worker = SimpleNamespace(worker_threads=8)
+    asyncio_middleware = AsyncIO()
+    middleware = DBPoolMiddleware(db, connection_budget=10, processes=4, stats_interval=0.01)
+
+    # the same order as dramatiq runs the hooks of middlewares added in this order
+    asyncio_middleware.before_worker_boot(None, worker)
+    try:
+        middleware.before_worker_boot(None, worker)
+        calls_after_boot = list(db.calls)
+        time.sleep(0.1)
+        middleware.after_worker_shutdown(None, worker)
+    finally:
+        asyncio_middleware.after_worker_shutdown(None, worker)
+
+    assert calls_after_boot == ["connect 1-2", f"migrate {consumer_v2.migrations_dir}"]
+    assert "stats" in db.calls
+    assert db.calls[-1] == "close"
+    stats_calls = db.calls.count("stats")
+    time.sleep(0.05)
+    # stats logging stopped together with the pool
+    assert db.calls.count("stats") == stats_calls
+    assert middleware.stats_task.cancelled()
+    (thread,) = db.threads
+    assert thread is not threading.current_thread()
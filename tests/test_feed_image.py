@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import main
+from clients.db_client import DBClient
+from clients.lru_cache import LRUCache
+from models.FeedImage import FeedImage
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+from tests.test_feed_listing import api_client
+
+CONTENT = b"0123456789"
+
+
+class StubImagesDB(DBClient):
+    """
+    DBClient of feed uploads with provided statuses and indexed images, every image lookup is counted
+    """
+
+    def __init__(self, statuses: dict[int, FeedUploadStatus], images: list[FeedImage]):
+        super().__init__("stub")
+        self.statuses = statuses
+        self.images = {(image.feed_upload_id, image.image_id): image for image in images}
+        self.lookups = 0
+
+    async def get_feed_upload_job(self, feed_upload_id):
+        if feed_upload_id not in self.statuses:
+            return None
+        return FeedUpload(id=feed_upload_id, status=self.statuses[feed_upload_id])
+
+    async def get_feed_image(self, feed_upload_id, image_id):
+        self.lookups += 1
+        return self.images.get((feed_upload_id, image_id))
+
+    async def has_feed_images(self, feed_upload_id):
+        return any(id == feed_upload_id for id, _ in self.images)
+
+
+@pytest.fixture
+def images_dir(tmp_path, monkeypatch):
+    """
+    Feed upload 1 with indexed image "img" and unindexed file "stray", feed upload 2 uploaded before the index
+    """
+    for path in ["1/img.jpg", "1/stray.jpg", "2/legacy.jpg"]:
+        (tmp_path / path).parent.mkdir(exist_ok=True)
+        (tmp_path / path).write_bytes(CONTENT)
+    monkeypatch.setattr(main, "images_dir", str(tmp_path))
+    monkeypatch.setattr(main, "feed_images_cache", LRUCache(max_size=10))
+    monkeypatch.setattr(main, "missing_feed_images_cache", LRUCache(max_size=10))
+    return tmp_path
+
+
+def images_db(status=FeedUploadStatus.FINISHED) -> StubImagesDB:
+    image = FeedImage(feed_upload_id=1, image_id="img", path="1/img.jpg", content_type="image/jpeg", size=10)
+    return StubImagesDB({1: status, 2: FeedUploadStatus.FINISHED}, [image])
+
+
+def get_all(db: DBClient, requests: list[tuple[str, dict]]) -> list:
+    async def run():
+        async with api_client(db) as client:
+            return [await client.get(path, headers=headers) for path, headers in requests]
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "if_none_match, status_code",
+    [
+        ('"img"', 304),
+        ('W/"img"', 304),
+        ('"other", "img"', 304),
+        ("*", 304),
+        ('"other"', 200),
+    ],
+)
+def test_matching_etag_results_in_not_modified(images_dir, if_none_match, status_code):
+    plain, conditional = get_all(
+        images_db(), [("/feeds/1/images/img", {}), ("/feeds/1/images/img", {"If-None-Match": if_none_match})]
+    )
+
+    assert (plain.status_code, plain.content, plain.headers["ETag"]) == (200, CONTENT, '"img"')
+    assert plain.headers["Cache-Control"] == main.IMAGE_CACHE_CONTROL
+    assert conditional.status_code == status_code
+    assert conditional.headers["ETag"] == '"img"'
+    assert conditional.content == (b"" if status_code == 304 else CONTENT)
+
+
+def test_range_request_returns_partial_content(images_dir):
+    (resp,) = get_all(images_db(), [("/feeds/1/images/img", {"Range": "bytes=2-5"})])
+
+    assert resp.status_code == 206
+    assert resp.content == CONTENT[2:6]
+    assert resp.headers["Content-Range"] == f"bytes 2-5/{len(CONTENT)}"
+    assert resp.headers["Content-Type"] == "image/jpeg"
+
+
+def test_missing_image_of_finished_feed_upload_is_remembered(images_dir):
+    db = images_db()
+    responses = get_all(db, [("/feeds/1/images/stray", {})] * 3 + [("/feeds/1/images/img", {})] * 2)
+
+    # file not in the index of indexed feed upload is not looked up in its dir
+    assert [resp.status_code for resp in responses] == [404] * 3 + [200] * 2
+    assert db.lookups == 2
+
+
+def test_missing_image_of_feed_upload_in_progress_is_looked_up_again(images_dir, monkeypatch):
+    monkeypatch.setattr(main, "feeds_cache_in_flight_ttl", 0.05)
+    db = images_db(FeedUploadStatus.PROCESSING)
+
+    async def run():
+        async with api_client(db) as client:
+            first = await client.get("/feeds/1/images/new")
+            await client.get("/feeds/1/images/new")
+            lookups = db.lookups
+            await asyncio.sleep(0.1)
+            db.images[(1, "new")] = FeedImage(
+                feed_upload_id=1, image_id="new", path="1/img.jpg", content_type="image/jpeg", size=10
+            )
+            return first, lookups, await client.get("/feeds/1/images/new")
+
+    first, lookups, last = asyncio.run(run())
+
+    assert (first.status_code, lookups, last.status_code) == (404, 1, 200)
+
+
+def test_image_of_feed_upload_without_index_is_found_in_its_dir(images_dir):
+    db = images_db()
+    found, missing, missing_again = get_all(
+        db, [("/feeds/2/images/legacy", {}), ("/feeds/2/images/gone", {}), ("/feeds/2/images/gone", {})]
+    )
+
+    assert (found.status_code, found.content, found.headers["Content-Type"]) == (200, CONTENT, "image/jpeg")
+    assert (missing.status_code, missing_again.status_code) == (404, 404)
+    assert db.lookups == 2
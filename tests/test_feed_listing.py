@@ -0,0 +1,153 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+
+import main
+from clients.cached_db_client import CachedDBClient
+from clients.db_client import DBClient
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+
+
+class StubConnection:
+    """
+    Evaluates the keyset queries of DBClient (feed item ids, unnested image ids) over in-memory items
+    """
+
+    def __init__(self, items: list[tuple[int, str, str | None, list[str] | None]]):
+        self.items = items
+
+    async def fetch(self, sql, feed_upload_id, *args):
+        *after, limit = args
+        if "unnest" in sql:
+            rows = [
+                {"id": id, "position": position, "image_id": image_id}
+                for id, _, image_link, additional_image_link in self.items
+                for position, image_id in enumerate([image_link, *(additional_image_link or [])])
+                if image_id is not None and (id, position) > tuple(after)
+            ]
+        else:
+            rows = [{"id": id, "feed_item_id": feed_item_id} for id, feed_item_id, *_ in self.items if id > after[0]]
+        return rows[:limit]
+
+
+class StubPool:
+    def __init__(self, conn: StubConnection):
+        self.conn = conn
+        self.acquired = 0
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.acquired += 1
+        self.in_use += 1
+        try:
+            yield self.conn
+        finally:
+            self.in_use -= 1
+
+
+class StubFeedDB(DBClient):
+    """
+    DBClient of one finished feed upload with provided (id, feed_item_id, image_link, additional_image_link) items
+    """
+
+    def __init__(self, items=()):
+        super().__init__("stub")
+        self.pool = StubPool(StubConnection(list(items)))
+
+    async def get_feed_upload_job(self, feed_upload_id):
+        return FeedUpload(id=feed_upload_id, status=FeedUploadStatus.FINISHED)
+
+
+@asynccontextmanager
+async def api_client(db: DBClient):
+    """
+    Client of the api app with provided db (and its cache), lifespan connecting to the services is not run
+    """
+    main.app.state.db = db
+    main.app.state.cached_db = CachedDBClient(db)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+        yield client
+
+
+ITEMS = [(10, "I0", "img0", ["a0", "b0"]), (20, "I1", None, ["a1"]), (30, "I2", "img2", None)]
+
+
+def get_pages(db: DBClient, path: str, params: dict) -> list[tuple[list[str], str | None]]:
+    async def run(params):
+        pages = []
+        async with api_client(db) as client:
+            while True:
+                resp = await client.get(path, params=params)
+                assert resp.status_code == 200
+                pages.append((resp.json(), resp.headers.get(main.NEXT_CURSOR_HEADER)))
+                if main.NEXT_CURSOR_HEADER not in resp.headers:
+                    return pages
+                params = {**params, "after": resp.headers[main.NEXT_CURSOR_HEADER]}
+
+    return asyncio.run(run(params))
+
+
+def test_item_pages_end_with_page_without_next_cursor():
+    db = StubFeedDB(ITEMS)
+    assert get_pages(db, "/feeds/1/items", {"limit": 2}) == [(["I0", "I1"], "20"), (["I2"], None)]
+    # full last page still has a cursor, the page after it is empty
+    assert get_pages(db, "/feeds/1/items", {"limit": 3}) == [(["I0", "I1", "I2"], "30"), ([], None)]
+    assert get_pages(db, "/feeds/1/items", {"limit": 2, "after": 10}) == [(["I1", "I2"], "30"), ([], None)]
+
+
+def test_image_pages_continue_within_item_by_composite_cursor():
+    db = StubFeedDB(ITEMS)
+    assert get_pages(db, "/feeds/1/images", {"limit": 2}) == [
+        (["img0", "a0"], "10-1"),
+        (["b0", "a1"], "20-1"),
+        (["img2"], None),
+    ]
+    assert get_pages(db, "/feeds/1/images", {"limit": 10, "after": "10-0"}) == [(["a0", "b0", "a1", "img2"], None)]
+
+
+@pytest.mark.parametrize(
+    "path, after, expected, chunks",
+    [
+        ("/feeds/1/items", "10", ["I0", "I1", "I2"], 2 + 2),
+        ("/feeds/1/images", "10-0", ["img0", "a0", "b0", "a1", "img2"], 3 + 3),
+    ],
+)
+def test_listing_without_limit_is_streamed_page_by_page(monkeypatch, path, after, expected, chunks):
+    monkeypatch.setattr(main, "STREAM_BATCH_SIZE", 2)
+    db = StubFeedDB(ITEMS)
+
+    async def run():
+        async with api_client(db) as client:
+            return (await client.get(path)).json(), (await client.get(path, params={"after": after})).json()
+
+    everything, rest = asyncio.run(run())
+
+    assert everything == expected
+    assert rest == expected[1:]
+    # connection was acquired for every chunk of 2 and released in between, not held for the whole response
+    assert db.pool.acquired == chunks
+    assert db.pool.in_use == 0
+
+
+@pytest.mark.parametrize(
+    "path, params, status_code",
+    [
+        ("/feeds/1/images", {"after": "abc"}, 400),
+        ("/feeds/1/images", {"after": "10"}, 400),
+        ("/feeds/1/images", {"after": "10-x"}, 400),
+        ("/feeds/1/images", {"after": "10-0-1"}, 400),
+        ("/feeds/1/images", {"limit": 2, "after": "abc"}, 400),
+        ("/feeds/1/items", {"after": "10-0"}, 422),
+        ("/feeds/1/items", {"limit": main.MAX_PAGE_SIZE + 1}, 422),
+        ("/feeds/1/images", {"limit": 0}, 422),
+    ],
+)
+def test_malformed_cursor_or_page_size_is_rejected(path, params, status_code):
+    async def run():
+        async with api_client(StubFeedDB(ITEMS)) as client:
+            return await client.get(path, params=params)
+
+    assert asyncio.run(run()).status_code == status_code
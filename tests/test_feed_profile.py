@@ -0,0 +1,95 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+
+from clients.db_client import DBClient
+from consumer.profiling import FeedProfile, SamplingProfiler, fold_stack
+from tests.test_feed_listing import api_client
+
+
+class StubProfileDB(DBClient):
+    """
+    DBClient with stored profiles of feed uploads, serialized as the consumer stores them
+    """
+
+    def __init__(self, profiles: dict[int, dict]):
+        super().__init__("stub")
+        self.profiles = {feed_upload_id: json.dumps(profile) for feed_upload_id, profile in profiles.items()}
+
+    async def get_feed_upload_profile(self, feed_upload_id):
+        profile = self.profiles.get(feed_upload_id)
+        return json.loads(profile) if profile is not None else None
+
+
+def spin_in_known_function(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler_samples_stacks_of_running_function_root_first():
+    with SamplingProfiler(interval=0.001) as profiler:
+        spin_in_known_function(0.2)
+
+    assert profiler.samples > 0
+    spinning = [stack for stack in profiler.stacks if stack.endswith("test_feed_profile.py:spin_in_known_function")]
+    assert spinning
+    for stack in spinning:
+        frames = stack.split(";")
+        assert frames[0] == threading.current_thread().name
+        assert "test_feed_profile.py:test_profiler_samples_stacks_of_running_function_root_first" in frames
+    # the profiler does not sample its own thread
+    assert not any(stack.startswith("sampling-profiler;") for stack in profiler.stacks)
+
+
+def test_waiting_thread_is_folded_into_idle():
+    stop = threading.Event()
+    waiting = threading.Thread(target=stop.wait, name="waiting")
+    waiting.start()
+    try:
+        time.sleep(0.05)
+        stack = fold_stack(sys._current_frames()[waiting.ident], "waiting")
+    finally:
+        stop.set()
+        waiting.join()
+
+    assert stack == "waiting;<idle>"
+
+
+def get_folded(profile: dict, feed_upload_id: int = 1):
+    async def run():
+        async with api_client(StubProfileDB({1: profile})) as client:
+            return await client.get(f"/feeds/{feed_upload_id}/profile", params={"format": "folded"})
+
+    return asyncio.run(run())
+
+
+def test_folded_profile_has_stack_and_count_per_line():
+    profile = FeedProfile(1, interval=0.001)
+    profile.start()
+    spin_in_known_function(0.1)
+    profile.stop()
+    profile.add_stacks({"MainThread;parsing.py:parse": 3}, prefix="parser")
+
+    resp = get_folded(profile.to_dict())
+
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    assert resp.text.endswith("\n")
+    folded = {}
+    for line in resp.text.splitlines():
+        # frames may contain spaces (e.g. "<frozen runpy>"), the count is after the last one
+        stack, count = line.rsplit(" ", 1)
+        assert count.isdigit()
+        folded[stack] = int(count)
+    assert folded == dict(profile.profiler.stacks)
+    assert folded["parser;MainThread;parsing.py:parse"] == 3
+    assert any(stack.endswith("test_feed_profile.py:spin_in_known_function") for stack in folded)
+    # most sampled stacks first
+    assert list(folded.values()) == sorted(folded.values(), reverse=True)
+
+
+def test_profile_of_feed_upload_without_profile_is_not_found():
+    assert get_folded({"stacks": {}}, feed_upload_id=2).status_code == 404
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import main
+from clients.cached_db_client import CachedDBClient
+from clients.db_client import DBClient
+from clients.feed_status_listener import FeedStatusListener
+from models.FeedUpload import FeedUpload, FeedUploadStatus
+from tests.test_feed_listing import api_client
+
+
+class StubStatusDB(DBClient):
+    """
+    DBClient of feed uploads with provided statuses, every status read is counted
+    """
+
+    def __init__(self, statuses: dict[int, FeedUploadStatus]):
+        super().__init__("stub")
+        self.statuses = statuses
+        self.reads = 0
+
+    async def get_feed_upload_job(self, feed_upload_id):
+        self.reads += 1
+        if feed_upload_id not in self.statuses:
+            return None
+        return FeedUpload(id=feed_upload_id, status=self.statuses[feed_upload_id])
+
+
+def notify(listener: FeedStatusListener, db: StubStatusDB, feed_upload_id: int, status: FeedUploadStatus):
+    """
+    Changes the status and delivers its notification as feed_uploads_status_notify trigger would
+    """
+    db.statuses[feed_upload_id] = status
+    payload = json.dumps({"id": feed_upload_id, "status": status.value})
+    listener._on_notification(None, 0, FeedStatusListener.CHANNEL, payload)
+
+
+async def watched(listener: FeedStatusListener, feed_upload_id: int):
+    while feed_upload_id not in listener.watchers:
+        await asyncio.sleep(0.01)
+
+
+def long_poll(statuses: dict, wait: str, change=None) -> tuple[int, dict, float]:
+    """
+    :param change: status notified once the request watches the feed upload
+    :return: status code, body and seconds of the long-poll request of feed upload 1
+    """
+    db = StubStatusDB(statuses)
+    listener = FeedStatusListener("stub")
+    main.app.state.feed_status_listener = listener
+
+    async def run():
+        async with api_client(db) as client:
+            started = time.perf_counter()
+            request = asyncio.create_task(client.get("/feeds/1", params={"wait": wait}))
+            if change is not None:
+                await watched(listener, 1)
+                notify(listener, db, 1, change)
+            resp = await request
+            return resp.status_code, resp.json(), time.perf_counter() - started
+
+    result = asyncio.run(run())
+    assert listener.watchers == {}
+    return result
+
+
+def test_long_poll_wakes_up_on_status_notification():
+    status_code, body, seconds = long_poll({1: FeedUploadStatus.PROCESSING}, "10s", FeedUploadStatus.FINISHED)
+    assert (status_code, body["status"]) == (200, FeedUploadStatus.FINISHED.name)
+    assert seconds < 5
+
+
+def test_long_poll_returns_current_status_once_wait_elapses():
+    status_code, body, seconds = long_poll({1: FeedUploadStatus.PROCESSING}, "200ms")
+    assert (status_code, body["status"]) == (200, FeedUploadStatus.PROCESSING.name)
+    assert 0.2 <= seconds < 5
+
+
+def test_long_poll_of_finished_feed_upload_returns_right_away():
+    status_code, body, seconds = long_poll({1: FeedUploadStatus.FINISHED_ERROR}, "10s")
+    assert (status_code, body["status"]) == (200, FeedUploadStatus.FINISHED_ERROR.name)
+    assert seconds < 5
+
+
+def test_long_poll_of_missing_feed_upload_is_not_found():
+    assert long_poll({}, "10s")[0] == 404
+
+
+@pytest.mark.parametrize(
+    "wait, seconds",
+    [("30", 30), ("30s", 30), ("1.5s", 1.5), ("500ms", 0.5), ("3600s", main.MAX_WAIT_SECONDS)],
+)
+def test_wait_duration_is_parsed_and_capped(wait, seconds):
+    assert main.parse_wait(wait) == seconds
+
+
+@pytest.mark.parametrize("wait", ["", "abc", "-1", "5m", "1,5s"])
+def test_invalid_wait_duration_is_rejected(wait):
+    assert long_poll({1: FeedUploadStatus.PROCESSING}, wait)[0] == 400
+
+
+async def next_event(events) -> str:
+    return await asyncio.wait_for(anext(events), 5)
+
+
+def parse_status(event: str) -> FeedUploadStatus:
+    name, data = event.strip().split("\n")
+    assert name == "event: status"
+    return FeedUploadStatus[json.loads(data.removeprefix("data: "))["status"]]
+
+
+def test_events_stream_status_changes_until_terminal_status(monkeypatch):
+    monkeypatch.setattr(main, "SSE_KEEP_ALIVE_SECONDS", 10)
+    db = StubStatusDB({1: FeedUploadStatus.QUEUED})
+    listener = FeedStatusListener("stub")
+
+    async def run():
+        main.app.state.db = db
+        main.app.state.cached_db = CachedDBClient(db)
+        main.app.state.feed_status_listener = listener
+        events = (await main.get_feed_events(1)).body_iterator
+        statuses = [parse_status(await next_event(events))]
+        for status in (FeedUploadStatus.PROCESSING, FeedUploadStatus.FINISHED):
+            notify(listener, db, 1, status)
+            statuses.append(parse_status(await next_event(events)))
+        with pytest.raises(StopAsyncIteration):
+            await next_event(events)
+        return statuses
+
+    assert asyncio.run(run()) == [FeedUploadStatus.QUEUED, FeedUploadStatus.PROCESSING, FeedUploadStatus.FINISHED]
+    assert listener.watchers == {}
+
+
+def test_events_recheck_status_on_keep_alive_tick(monkeypatch):
+    monkeypatch.setattr(main, "SSE_KEEP_ALIVE_SECONDS", 0.05)
+    db = StubStatusDB({1: FeedUploadStatus.PROCESSING})
+    listener = FeedStatusListener("stub")
+
+    async def run():
+        main.app.state.db = db
+        main.app.state.cached_db = CachedDBClient(db)
+        main.app.state.feed_status_listener = listener
+        events = (await main.get_feed_events(1)).body_iterator
+        first = parse_status(await next_event(events))
+        keep_alive = await next_event(events)
+        reads = db.reads
+        # notification is missed (e.g. listening connection reconnecting), the tick still picks the change up
+        db.statuses[1] = FeedUploadStatus.FINISHED
+        last = parse_status(await next_event(events))
+        with pytest.raises(StopAsyncIteration):
+            await next_event(events)
+        return first, keep_alive, reads, last
+
+    first, keep_alive, reads, last = asyncio.run(run())
+
+    assert (first, keep_alive, last) == (FeedUploadStatus.PROCESSING, ": keep-alive\n\n", FeedUploadStatus.FINISHED)
+    # initial 404 check, status of the first event and the status re-read by the tick
+    assert reads == 3
+
+
+def test_events_of_missing_feed_upload_are_not_found():
+    async def run():
+        async with api_client(StubStatusDB({})) as client:
+            return await client.get("/feeds/1/events")
+
+    main.app.state.feed_status_listener = FeedStatusListener("stub")
+    assert asyncio.run(run()).status_code == 404
@@ -0,0 +1,142 @@
+import asyncio
+from contextlib import asynccontextmanager
+import json
+
+import pytest
+
+from clients.db_client import DBClient
+
+
+class StubConnection:
+    """
+    Inserts jobs of create_feed_upload_jobs, RETURNING rows come back in reverse order as nothing orders them
+    """
+
+    def __init__(self, db: "StubJobsDB"):
+        self.db = db
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch(self, sql, status, feed_keys):
+        if self.db.error is not None:
+            raise self.db.error
+        self.db.inserts.append(list(feed_keys))
+        rows = []
+        for feed_key in feed_keys:
+            self.db.jobs.append(feed_key)
+            rows.append({"id": len(self.db.jobs), "feed_key": feed_key})
+        return rows[::-1]
+
+    async def execute(self, sql, ids, messages):
+        self.db.outbox.extend(zip(ids, messages))
+
+
+class StubPool:
+    def __init__(self, conn: StubConnection):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+class StubJobsDB(DBClient):
+    def __init__(self, job_batch_window: float, job_batch_max_size: int = 100):
+        super().__init__("stub", job_batch_window=job_batch_window, job_batch_max_size=job_batch_max_size)
+        self.pool = StubPool(StubConnection(self))
+        # feed key of every inserted job, job id is its index + 1
+        self.jobs: list = []
+        self.inserts: list[list] = []
+        self.outbox: list[tuple] = []
+        self.error = None
+        self.resolve_errors: list[Exception] = []
+
+    async def _resolve_feed_upload_jobs(self, pending):
+        try:
+            await super()._resolve_feed_upload_jobs(pending)
+        except Exception as e:
+            self.resolve_errors.append(e)
+            raise
+
+    async def create(self, feed_key):
+        return await self.create_feed_upload_job({"feed_key": feed_key}, feed_key=feed_key)
+
+
+def test_calls_within_window_are_inserted_together_and_get_ids_of_their_jobs():
+    feed_keys = ["a", None, "b", None, "a"]
+
+    async def run():
+        db = StubJobsDB(job_batch_window=0.05)
+        ids = await asyncio.gather(*(db.create(feed_key) for feed_key in feed_keys))
+        return db, ids
+
+    db, ids = asyncio.run(run())
+
+    assert db.inserts == [feed_keys]
+    assert sorted(ids) == [1, 2, 3, 4, 5]
+    # every caller got id of a job with its feed key and its own outbox message
+    assert [db.jobs[feed_upload_id - 1] for feed_upload_id in ids] == feed_keys
+    assert sorted(db.outbox, key=str) == sorted(
+        ((feed_upload_id, json.dumps({"feed_key": feed_key})) for feed_upload_id, feed_key in zip(ids, feed_keys)),
+        key=str,
+    )
+
+
+def test_full_batch_is_inserted_without_waiting_for_window():
+    async def run():
+        db = StubJobsDB(job_batch_window=0.2, job_batch_max_size=2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = await asyncio.gather(db.create("a"), db.create("b"))
+        full_batch_seconds = loop.time() - started
+        rest = await asyncio.gather(*(db.create(feed_key) for feed_key in "cde"))
+        return db, first, full_batch_seconds, rest
+
+    db, first, full_batch_seconds, rest = asyncio.run(run())
+
+    assert full_batch_seconds < 0.1
+    assert db.inserts == [["a", "b"], ["c", "d"], ["e"]]
+    assert first == [1, 2] and rest == [3, 4, 5]
+
+
+def test_failed_insert_is_raised_to_every_caller_of_the_batch():
+    async def run():
+        db = StubJobsDB(job_batch_window=0.01)
+        db.error = RuntimeError("connection lost")
+        return await asyncio.gather(*(db.create(feed_key) for feed_key in "abc"), return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert [str(result) for result in results] == ["connection lost"] * 3
+
+
+def test_cancelled_caller_does_not_break_its_batch():
+    async def run():
+        db = StubJobsDB(job_batch_window=0.05)
+        callers = [asyncio.create_task(db.create(feed_key)) for feed_key in "abc"]
+        await asyncio.sleep(0)
+        # e.g. client disconnected while its upload waited for the window
+        callers[1].cancel()
+        await asyncio.wait_for(asyncio.gather(*callers, return_exceptions=True), 1)
+        return db, callers
+
+    db, callers = asyncio.run(run())
+
+    assert db.resolve_errors == []
+    assert callers[1].cancelled()
+    assert [db.jobs[callers[i].result() - 1] for i in (0, 2)] == ["a", "c"]
+    assert db.inserts == [["a", "b", "c"]]
+
+
+@pytest.mark.parametrize("job_batch_window", [None, 0])
+def test_every_job_is_inserted_on_its_own_without_window(job_batch_window):
+    async def run():
+        db = StubJobsDB(job_batch_window=job_batch_window)
+        return db, await asyncio.gather(*(db.create(feed_key) for feed_key in "ab"))
+
+    db, ids = asyncio.run(run())
+
+    assert db.inserts == [["a"], ["b"]]
+    assert ids == [1, 2]